@@ -1,17 +1,84 @@
+import concurrent.futures
 import multiprocessing as mp
+import threading
+import time
 from tqdm import tqdm
-from joblib import Parallel, delayed
+
+
+def _warm_up_worker():
+    return time.perf_counter()
 
 
 class Semaphore:
-    def __init__(self, n_processes=6):
-        self.n_processes = min(n_processes, mp.cpu_count())
+    """
+    A long-lived pool of thread or process workers. The workers are started once and kept warm, and at most
+    n_processes tasks are in flight: submit() blocks while all the workers are busy.
+    """
+    def __init__(self, n_processes=6, kind='process'):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f'Unknown worker kind: {kind}')
+        self.kind = kind
+        # threads mostly wait on I/O or on subprocesses so they are not bounded by the number of cores
+        self.n_processes = min(n_processes, mp.cpu_count()) if kind == 'process' else n_processes
+        self._slots = threading.BoundedSemaphore(self.n_processes)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                if self.kind == 'process':
+                    self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.n_processes)
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_processes)
+            return self._executor
+
+    def warm_up(self):
+        """
+        Start all the workers ahead of the first task.
+        :return: the worker startup time in seconds
+        """
+        start_time = time.perf_counter()
+        executor = self._get_executor()
+        futures = [executor.submit(_warm_up_worker) for _ in range(self.n_processes)]
+        concurrent.futures.wait(futures)
+        return time.perf_counter() - start_time
+
+    def submit(self, do_work, **parameters):
+        """
+        Run do_work(**parameters) on a warm worker, blocking until one is free.
+        :return: a concurrent.futures.Future of the result
+        """
+        self._slots.acquire()
+        try:
+            future = self._get_executor().submit(do_work, **parameters)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def imap(self, items, do_work):
+        """
+        Run do_work over a stream of parameter dicts with at most n_processes tasks in flight.
+        :return: a generator of the results in the order of the items
+        """
+        pending = []
+        for parameters in items:
+            pending.append(self.submit(do_work, **parameters))
+            while pending and pending[0].done():
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
 
     def parallelize(self, items, do_work, timeout=1*3600):
-        print(f'allocating {self.n_processes} processes to run {do_work.__name__} in parallel...')
+        print(f'allocating {self.n_processes} {self.kind} workers to run {do_work.__name__} in parallel...')
         try:
-            results = Parallel(n_jobs=self.n_processes, timeout=timeout, verbose=1)(delayed(do_work)(**parameters)
-                                                                                    for parameters in tqdm(items))
+            futures = [self.submit(do_work, **parameters) for parameters in tqdm(items)]
+            done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+            if not_done:
+                raise TimeoutError(f'{len(not_done)} of {len(futures)} tasks did not finish within {timeout} seconds')
+            results = [future.result() for future in futures]
             print(f'MP Semaphore is done running {do_work.__name__}!')
             return results
         except TimeoutError as toe:
@@ -20,3 +87,15 @@ class Semaphore:
         except Exception as e:
             print(f'MP parallelize has raised an exception: {e}')
             raise e
+
+    def close(self, wait=True):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
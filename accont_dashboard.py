@@ -1,11 +1,16 @@
+import asyncio
 import json
 import os
 
 from tqdm import tqdm
 from azure_data_explorer import AzureDataExplorerClient
+from incremental_sync import IncrementalSync, ChangeFeed, UPSERT
+from job_manifest import JobManifest
 from main import load_config
 from video_indexer_wrapper import VideoIndexerWrapper
 
+ADX_INGEST_STAGE = 'adx_ingest'
+
 
 class AccountDashboardUploader:
     def __init__(self, config):
@@ -14,31 +19,84 @@ class AccountDashboardUploader:
         self.table_name = config['adx']['table_name']
         self.mapping_name = config['adx']['mapping_name']
 
-    def _get_all_vi_index_jsons(self, insights_repo_path):
-        """Returns a list of all the video index JSONs for the given video."""
-        indexed_videos = self.video_indexer.list_all_indexed_videos()
-        print(f'Start downloading video insights for {len(indexed_videos)} videos...')
-        for video_id in tqdm(indexed_videos):
-            video_insights = self.video_indexer.get_video_index(video_id['id'])
-            with open(f'{insights_repo_path}/{video_id["id"]}.json', 'w') as f:
-                json.dump(video_insights, f)
+    def _get_all_vi_index_jsons(self, insights_repo_path, max_in_flight=16):
+        """Downloads the video index JSONs of all the account's videos, fetching up to max_in_flight concurrently."""
+        asyncio.run(self._get_all_vi_index_jsons_async(insights_repo_path, max_in_flight))
         return
 
-    def _upload_jsons_to_adx(self, jsons_repo: str):
-        for json_file_name in os.listdir(jsons_repo):
+    async def _get_all_vi_index_jsons_async(self, insights_repo_path, max_in_flight):
+        print(f'Start downloading video insights with {max_in_flight} concurrent requests...')
+        failed_video_ids = []
+        with tqdm() as bar:
+            async for video, video_insights in self.video_indexer.iter_video_indexes_async(max_in_flight):
+                bar.update(1)
+                if video_insights is None:
+                    failed_video_ids.append(video['id'])
+                    continue
+                with open(f'{insights_repo_path}/{video["id"]}.json', 'w') as f:
+                    json.dump(video_insights, f)
+        if failed_video_ids:
+            print(f'Failed to download video insights for {len(failed_video_ids)} videos: {failed_video_ids}')
+
+    def _upload_jsons_to_adx(self, jsons_repo: str, manifest: JobManifest):
+        n_skipped = 0
+        with os.scandir(jsons_repo) as entries:
+            # a JSON rewritten since its ingestion, e.g. the index of a re-indexed video, has a new key
+            json_files = [(entry.name, f'{entry.name}@{entry.stat().st_mtime_ns}') for entry in entries
+                          if entry.name.endswith('.json') and entry.is_file()]
+        for json_file_name, item_id in json_files:
+            # the JSONs ingested by a previous run are skipped
+            if manifest.is_done(item_id, ADX_INGEST_STAGE):
+                n_skipped += 1
+                continue
             json_file = os.path.join(jsons_repo, json_file_name)
             # with open(json_file) as f:
             #     data = json.load(f)
             #     self.adx_wrapper.ingest_data_from_json(data, self.table_name, self.mapping_name)
+            manifest.start(item_id, ADX_INGEST_STAGE)
             try:
                 self.adx_wrapper.ingest_data_from_json(json_file, self.table_name, self.mapping_name)
             except Exception as e:
                 print(f"Error during ingestion: {e}")
+                manifest.failed(item_id, ADX_INGEST_STAGE, e)
                 continue
+            manifest.done(item_id, ADX_INGEST_STAGE)
+        print(f'Processed {len(json_files) - n_skipped} JSONs, skipped {n_skipped} ingested by a previous run: '
+              f'{manifest.stats().get(ADX_INGEST_STAGE)}')
 
-    def ingest_videos(self, video_path: str):
+    def ingest_videos(self, video_path: str, manifest: JobManifest = None):
+        """
+        :param manifest: the checkpoint of the ingested JSONs, by default the one in video_path
+        """
         # self._get_all_vi_index_jsons(video_path)
-        self._upload_jsons_to_adx(video_path)
+        if manifest is not None:
+            self._upload_jsons_to_adx(video_path, manifest)
+            return
+        with JobManifest.in_directory(video_path) as manifest:
+            self._upload_jsons_to_adx(video_path, manifest)
+
+
+    def sync_videos(self, insights_repo_path: str, full: bool = None, max_in_flight: int = 16):
+        """
+        Fetch the indexes of the videos that are new or changed since the last sync and ingest them to ADX, instead of
+        downloading every video's index on every run.
+        :param full: scan the whole account, by default once a week
+        """
+        incremental_sync = IncrementalSync(self.video_indexer, insights_repo_path, max_in_flight=max_in_flight)
+        incremental_sync.sync(full)
+        self.ingest_changes(incremental_sync.change_feed)
+
+    def ingest_changes(self, change_feed: ChangeFeed, consumer: str = 'adx'):
+        """
+        Ingest the video indexes of the change feed that this consumer did not ingest yet.
+        """
+        def ingest(event):
+            # ADX tables are append only, the deleted videos are left to the table's retention
+            if event['op'] == UPSERT:
+                self.adx_wrapper.ingest_data_from_json(event['index_path'], self.table_name, self.mapping_name)
+
+        n_ingested = change_feed.consume(consumer, ingest)
+        print(f'Ingested {n_ingested} changes to ADX')
 
 
 def main_ingestion():
@@ -0,0 +1,170 @@
+"""
+Downloads Video Indexer artifacts, e.g. the KeyframesThumbnails zips, concurrently and resumably.
+Every transfer goes to a .part file that is renamed into place only once the zip is complete and valid, an
+interrupted transfer resumes from the bytes already on disk with an HTTP Range request, and zips already on disk are
+not downloaded again.
+"""
+import os
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from http_session import HttpSession
+from throttling import RetryPolicy
+
+
+def is_valid_zip(path: str) -> bool:
+    """
+    :return: whether the file is a readable zip whose members all pass their CRC check
+    """
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_file:
+            return zip_file.testzip() is None
+    except (zipfile.BadZipFile, OSError, EOFError):
+        return False
+
+
+def content_range_start(content_range: str):
+    """
+    :param content_range: a Content-Range header, e.g. 'bytes 1000-1999/2000'
+    :return: the position of the first byte sent, None when the header is missing or unreadable
+    """
+    match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', (content_range or '').strip())
+    return int(match.group(1)) if match is not None else None
+
+
+class ArtifactDownloader:
+    """
+    Downloads (key, destination path) items on a bounded pool of workers sharing one pooled HTTP session.
+    """
+    def __init__(self, http: HttpSession, resolve_url, n_workers: int = 4, chunk_size: int = 64 * 1024,
+                 retry_policy: RetryPolicy = None, validate=is_valid_zip):
+        """
+        :param http: the pooled session to download through
+        :param resolve_url: returns the download URL of a key, or None when the artifact is unavailable. Called again
+            when a URL was refused, as artifact URLs carry short-lived SAS tokens.
+        :param n_workers: the number of concurrent downloads
+        :param chunk_size: the size of the chunks written to disk, all that an interrupted transfer can lose
+        :param retry_policy: how many times and how long to wait before resuming a failed transfer
+        :param validate: checks a complete download, None to accept any file
+        """
+        self.http = http
+        self.resolve_url = resolve_url
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_attempts=4)
+        self.validate = validate
+        self.n_bytes = 0
+        self.n_downloaded = 0
+        self.n_skipped = 0
+        self.n_resumed = 0
+        self._lock = threading.Lock()
+        self._start_time = None
+
+    def download_all(self, items):
+        """
+        :param items: (key, destination path) pairs
+        :return: the destination path by key of the available artifacts, and the keys that failed
+        """
+        self._start_time = time.perf_counter()
+        paths, failed = dict(), []
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {executor.submit(self.download, key, path): key for key, path in items}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    path = future.result()
+                except Exception as e:
+                    print(f'Failed to download the artifact of {key}: {e}')
+                    path = None
+                if path is None:
+                    failed.append(key)
+                else:
+                    paths[key] = path
+        stats = self.stats()
+        print(f'Downloaded {stats["downloaded"]} artifacts ({stats["bytes"] / 2 ** 20:.1f}MB at '
+              f'{stats["mb_per_sec"]:.1f}MB/s), skipped {stats["skipped"]} valid ones, resumed {stats["resumed"]} '
+              f'transfers, {len(failed)} failed')
+        return paths, failed
+
+    def download(self, key, path: str):
+        """
+        :return: the destination path, None when the artifact is unavailable or failed validation
+        """
+        if os.path.isfile(path) and (self.validate is None or self.validate(path)):
+            with self._lock:
+                self.n_skipped += 1
+            return path
+        url = self.resolve_url(key)
+        if url is None:
+            return None
+        part_path = f'{path}.part'
+        for attempt in range(self.retry_policy.max_attempts):
+            if attempt > 0:
+                time.sleep(self.retry_policy.backoff_secs(attempt))
+            try:
+                status_code = self._transfer(url, part_path)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                print(f'Interrupted download of {key}: {e}')
+                continue
+            if status_code in (401, 403):
+                # the SAS token expired, get a fresh URL
+                url = self.resolve_url(key)
+                if url is None:
+                    return None
+                continue
+            if status_code >= 400:
+                print(f'Error: {status_code} downloading the artifact of {key}')
+                if status_code < 500 and status_code != 429:
+                    return None
+                continue
+            if self.validate is not None and not self.validate(part_path):
+                print(f'Downloaded an invalid artifact for {key}, starting over')
+                os.remove(part_path)
+                continue
+            os.replace(part_path, path)
+            with self._lock:
+                self.n_downloaded += 1
+            return path
+        return None
+
+    def _transfer(self, url: str, part_path: str) -> int:
+        """
+        Append the rest of the artifact to the .part file.
+        :return: the HTTP status code, 200 once the .part file is complete
+        """
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = dict(Range=f'bytes={offset}-') if offset else dict()
+        with self.http.request('GET', url, operation='download_artifact', headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # the .part file already holds the whole artifact
+                return 200
+            if response.status_code not in (200, 206):
+                return response.status_code
+            if response.status_code == 206:
+                if content_range_start(response.headers.get('Content-Range')) != offset:
+                    # appending another range would corrupt the artifact, download it from the start
+                    print(f'Unexpected Content-Range {response.headers.get("Content-Range")} resuming from byte '
+                          f'{offset}, restarting the download')
+                    response.close()
+                    os.remove(part_path)
+                    return self._transfer(url, part_path)
+                with self._lock:
+                    self.n_resumed += 1
+            # a 200 to a Range request means the server sends the whole artifact again
+            with open(part_path, 'ab' if response.status_code == 206 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    with self._lock:
+                        self.n_bytes += len(chunk)
+            return 200
+
+    def stats(self) -> dict:
+        elapsed_secs = time.perf_counter() - self._start_time if self._start_time is not None else 0.0
+        with self._lock:
+            return dict(downloaded=self.n_downloaded, skipped=self.n_skipped, resumed=self.n_resumed,
+                        bytes=self.n_bytes, mb_per_sec=self.n_bytes / 2 ** 20 / elapsed_secs if elapsed_secs else 0.0)
@@ -3,39 +3,187 @@ This file is a wrapper for the Azure AI Search service. It is used to search for
 The main implementation is to upload the PromptContent to the Azure AI Search service and Images to embedded with CLIP.
 """
 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.indexes import SearchIndexClient
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+
+from query_cache import QueryResultCache
+from search_batch_writer import SearchBatchWriter
 
 
 class AzureAISearchWrapper:
-    def __init__(self, key, endpoint, index_name, embeddings_mapping):
+    def __init__(self, key, endpoint, index_name, embeddings_mapping, cache_max_entries=0, cache_ttl_secs=300,
+                 cache_max_bytes=64 * 1024 * 1024):
         self.api_key = key
         self.endpoint = endpoint
+        self.index_name = index_name
         self.embeddings_mapping = embeddings_mapping
-        credential = DefaultAzureCredential()
-        self.client = SearchClient(endpoint=endpoint, index_name=index_name, credential=credential)
 
-    def upload_textual_content(self, prompt: str, item_index: dict):
+        # a single credential and a single client per index, so every index keeps one warm HTTP pipeline
+        self.credential = AzureKeyCredential(key) if key else DefaultAzureCredential()
+        self._async_credential = None
+        self._clients = dict()
+        self._async_clients = dict()
+        self._key_fields = dict()
+        self._clients_lock = threading.Lock()
+        self.client = self.get_client(index_name)
+
+        # popular queries are served from memory, disabled unless cache_max_entries is set
+        self.query_cache = None
+        if cache_max_entries > 0:
+            self.query_cache = QueryResultCache(max_entries=cache_max_entries, ttl_secs=cache_ttl_secs,
+                                                max_bytes=cache_max_bytes)
+
+    def invalidate_cached_queries(self, index_name: str = None):
+        """
+        Drops the cached search results of an index after new documents were uploaded to it.
+
+        Args:
+            index_name (str): The name of the index, the wrapper's index if not given.
+        """
+        if self.query_cache is not None:
+            self.query_cache.invalidate_index(index_name or self.index_name)
+
+    def cache_stats(self) -> dict:
+        """
+        Returns the query cache hit, miss and eviction counters, None when the cache is disabled.
+        """
+        return self.query_cache.stats() if self.query_cache is not None else None
+
+    def get_client(self, index_name: str = None) -> SearchClient:
+        """
+        Returns the cached SearchClient of an index, created on first use. Safe to call from multiple threads.
+
+        Args:
+            index_name (str): The name of the index, the wrapper's index if not given.
+        """
+        index_name = index_name or self.index_name
+        client = self._clients.get(index_name)
+        if client is None:
+            with self._clients_lock:
+                client = self._clients.get(index_name)
+                if client is None:
+                    client = SearchClient(endpoint=self.endpoint, index_name=index_name, credential=self.credential)
+                    self._clients[index_name] = client
+        return client
+
+    def get_key_field(self, index_name: str = None):
+        """
+        Returns the name of the key field of an index, read from the index definition on first use, None when the
+        definition cannot be read, e.g. with a query key.
+
+        Args:
+            index_name (str): The name of the index, the wrapper's index if not given.
+        """
+        index_name = index_name or self.index_name
+        if index_name not in self._key_fields:
+            key_field = None
+            try:
+                with SearchIndexClient(endpoint=self.endpoint, credential=self.credential) as index_client:
+                    key_field = next((field.name for field in index_client.get_index(index_name).fields
+                                      if field.key), None)
+            except Exception as e:
+                print(f"Failed to read the key field of index {index_name}: {e}")
+            self._key_fields[index_name] = key_field
+        return self._key_fields[index_name]
+
+    def get_async_client(self, index_name: str = None) -> AsyncSearchClient:
+        """
+        Returns the cached async SearchClient of an index, for high-QPS query serving. The async clients are bound to
+        the event loop they are first used in and are released with aclose().
+
+        Args:
+            index_name (str): The name of the index, the wrapper's index if not given.
+        """
+        index_name = index_name or self.index_name
+        with self._clients_lock:
+            client = self._async_clients.get(index_name)
+            if client is None:
+                if self._async_credential is None:
+                    self._async_credential = AzureKeyCredential(self.api_key) if self.api_key \
+                        else AsyncDefaultAzureCredential()
+                client = AsyncSearchClient(endpoint=self.endpoint, index_name=index_name,
+                                           credential=self._async_credential)
+                self._async_clients[index_name] = client
+            return client
+
+    def close(self):
+        """
+        Closes the cached clients.
+        """
+        with self._clients_lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """
+        Closes the cached async clients.
+        """
+        with self._clients_lock:
+            clients = list(self._async_clients.values())
+            self._async_clients.clear()
+            async_credential = self._async_credential
+            self._async_credential = None
+        for client in clients:
+            await client.close()
+        if isinstance(async_credential, AsyncDefaultAzureCredential):
+            await async_credential.close()
+
+    def batch_writer(self, index_name: str = None, **kwargs) -> SearchBatchWriter:
+        """
+        Creates a buffered batch writer for an index, to be closed once all the documents were added. The per-document
+        results are matched to the documents by the index key field.
+
+        Args:
+            index_name (str): The name of the index, the wrapper's index if not given.
+            kwargs: The SearchBatchWriter thresholds, and its key_field to skip reading the index definition.
+        """
+        on_flush = kwargs.pop('on_flush', None)
+        if 'key_field' not in kwargs:
+            kwargs['key_field'] = self.get_key_field(index_name)
+
+        def invalidate_and_notify(documents):
+            self.invalidate_cached_queries(index_name)
+            if on_flush is not None:
+                on_flush(documents)
+
+        return SearchBatchWriter(self.get_client(index_name), on_flush=invalidate_and_notify, **kwargs)
+
+    def upload_textual_content(self, prompt: str, item_index: dict, batch_writer: SearchBatchWriter = None):
         """
         Uploads the textual content to the Azure AI Search service.
 
         Args:
             prompt (str): The prompt to be uploaded.
             item_index (object): The index of the item.
+            batch_writer (SearchBatchWriter): If given, the document is buffered in it instead of uploaded at once.
         """
         # Prepare the document
         document = item_index
         document["content"] = prompt
+        if batch_writer is not None:
+            batch_writer.add(document)
+            return
 
         # Upload the document
         result = self.client.upload_documents(documents=[document])
+        self.invalidate_cached_queries()
 
         # Check if the upload was successful
         if not result[0].succeeded:
             print(f"Upload failed: {result[0].error.message}")
 
-    def upload_images(self, images: list[str], item_index: dict, index_name: str):
+    def upload_images(self, images: list[str], item_index: dict, index_name: str,
+                      batch_writer: SearchBatchWriter = None, vectors=None):
         """
         Uploads the images to the Azure AI Search service.
 
@@ -43,21 +191,25 @@ class AzureAISearchWrapper:
             images (list[str]): The images to be uploaded.
             item_index (str): The index of the item.
             index_name (str): The name of the index.
+            batch_writer (SearchBatchWriter): If given, the documents are buffered in it instead of uploaded at once.
+            vectors: The embedding of each image, uploaded as its content_vector.
         """
-        # Create a SearchClient
-        search_client = SearchClient(endpoint=self.endpoint,
-                                     index_name=index_name,  # use the provided index name
-                                     credential=AzureKeyCredential(self.api_key))
-
         # Prepare the documents
         documents = []
-        for image in images:
+        for i, image in enumerate(images):
             document = item_index.copy()  # create a copy of the item_index for each image
             document["image"] = image  # add the image data
+            if vectors is not None:
+                document["content_vector"] = [float(value) for value in vectors[i]]
             documents.append(document)
+        if batch_writer is not None:
+            batch_writer.add_many(documents)
+            return
 
         # Upload the documents
+        search_client = self.get_client(index_name)
         result = search_client.upload_documents(documents=documents)
+        self.invalidate_cached_queries(index_name)
 
         # Check if the upload was successful
         for res in result:
@@ -65,28 +217,143 @@ class AzureAISearchWrapper:
                 print(f"Upload failed: {res.error.message}")
 
 
-    def search(self, query: str, index_name: str):
+    def upload_segments(self, segments, index_name: str, batch_writer: SearchBatchWriter = None):
+        """
+        Uploads video segments to the Azure AI Search service in batches.
+
+        Args:
+            segments: A SegmentTable, or an iterable of VideoSegmentIndex objects.
+            index_name (str): The name of the index.
+            batch_writer (SearchBatchWriter): If given, the documents are buffered in it instead of a new writer.
+
+        Returns:
+            The (document, error message) pairs that failed, empty when a batch_writer was given.
+        """
+        if hasattr(segments, 'iter_documents'):
+            documents = segments.iter_documents()
+        else:
+            documents = (segment.to_dict() for segment in segments)
+        if batch_writer is not None:
+            batch_writer.add_many(documents)
+            return []
+        with self.batch_writer(index_name) as writer:
+            writer.add_many(documents)
+        return writer.failed
+
+    def search(self, query: str, index_name: str, **search_options):
         """
         Searches for similar examples in the Azure AI Search service.
 
         Args:
             query (str): The query to search for.
             index_name (str): The name of the index to search in.
+            search_options: Additional SearchClient.search arguments, e.g. top.
         """
-        # Create a SearchClient
-        search_client = SearchClient(endpoint=self.endpoint,
-                                     index_name=index_name,  # use the provided index name
-                                     credential=AzureKeyCredential(self.api_key))
+        cache_key = QueryResultCache.make_key(query, index_name, search_options)
+        if self.query_cache is not None:
+            results = self.query_cache.get(cache_key)
+            if results is not None:
+                return results
 
         # Search for similar faces
-        response = search_client.search(search_text=query)
+        response = self.get_client(index_name).search(search_text=query, **search_options)
 
         # Get the results
-        results = [res for res in response.get_results()]
+        results = [res for res in response]
+        if self.query_cache is not None:
+            self.query_cache.put(cache_key, results)
         return results
 
+    async def search_async(self, query: str, index_name: str, **search_options):
+        """
+        Searches for similar examples in the Azure AI Search service with the index's async client.
+
+        Args:
+            query (str): The query to search for.
+            index_name (str): The name of the index to search in.
+            search_options: Additional SearchClient.search arguments, e.g. top.
+        """
+        cache_key = QueryResultCache.make_key(query, index_name, search_options)
+        if self.query_cache is not None:
+            results = self.query_cache.get(cache_key)
+            if results is not None:
+                return results
+
+        response = await self.get_async_client(index_name).search(search_text=query, **search_options)
+        results = [res async for res in response]
+        if self.query_cache is not None:
+            self.query_cache.put(cache_key, results)
+        return results
+
+    def iter_fan_out_search(self, query: str, index_names: list[str], timeout_secs=5.0, fuse=None, **search_options):
+        """
+        Queries several indexes concurrently and yields as soon as each index answers, so a slow index does not hold
+        back the others. An index that does not answer within its timeout, or fails, is left out of the fusion.
+
+        Args:
+            query (str): The query to search for.
+            index_names (list[str]): The names of the indexes to search in.
+            timeout_secs (float | dict): The timeout of every index, or a dict of timeouts by index name.
+            fuse (callable): Called with a dict of the results received so far by index name, returns their fusion.
+            search_options: Additional SearchClient.search arguments, e.g. top.
+
+        Yields:
+            (index_name, results, fused) tuples in the order the indexes answered, fused being None without fuse.
+        """
+        start_time = time.monotonic()
+        deadlines = dict()
+        for index_name in index_names:
+            index_timeout_secs = timeout_secs.get(index_name, 5.0) if isinstance(timeout_secs, dict) else timeout_secs
+            deadlines[index_name] = start_time + index_timeout_secs
+
+        executor = ThreadPoolExecutor(max_workers=len(index_names))
+        pending = {executor.submit(self.search, query, index_name, **search_options): index_name
+                   for index_name in index_names}
+        results_by_index = dict()
+        try:
+            while pending:
+                next_deadline = min(deadlines[index_name] for index_name in pending.values())
+                done, _ = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    index_name = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        print(f"Search failed for index {index_name}: {e}")
+                        continue
+                    results_by_index[index_name] = results
+                    yield index_name, results, fuse(results_by_index) if fuse is not None else None
+                now = time.monotonic()
+                for future, index_name in list(pending.items()):
+                    if deadlines[index_name] <= now:
+                        print(f"Search timed out for index {index_name}, returning partial results.")
+                        future.cancel()
+                        del pending[future]
+        finally:
+            executor.shutdown(wait=False)
+
+    def fan_out_search(self, query: str, index_names: list[str], timeout_secs=5.0, fuse=None, **search_options):
+        """
+        Queries several indexes concurrently and returns the fusion of the results that arrived in time.
+
+        Returns:
+            A dict with the fused results, the results by index name and the names of the indexes left out.
+        """
+        results_by_index = dict()
+        fused = None
+        for index_name, results, fused in self.iter_fan_out_search(query, index_names, timeout_secs, fuse,
+                                                                     **search_options):
+            results_by_index[index_name] = results
+        missing = [index_name for index_name in index_names if index_name not in results_by_index]
+        return dict(fused=fused, by_index=results_by_index, missing=missing)
+
 
 class VideoSegmentIndex:
+    # no per-instance __dict__, millions of segments are kept in memory while indexing
+    __slots__ = ('location', 'account_id', 'video_id', 'segment_id', 'start_time', 'end_time', 'prompt',
+                 'image_path', 'content_vector')
+
     def __init__(self, location, account_id, video_id, thumbnail_id, start_time, end_time, prompt, image_path, content_vector):
         self.location = location
         self.account_id = account_id
@@ -0,0 +1,8 @@
+"""
+Rerunnable benchmarks of the optimized paths against the code they replaced. Every module runs standalone from the
+repository root, e.g.:
+
+    python -m benchmarks.rank_fusion_bench
+
+The services are replaced by local stub servers with injected latency, so the numbers compare the client code only.
+"""
@@ -0,0 +1,59 @@
+"""
+Upload of prompt content sections to a local stub Azure AI Search with injected latency: one upload_documents call
+per section, as upload_textual_content did, against the SearchBatchWriter with several batch sizes and concurrent
+flushes, and with a share of the documents rejected with a retriable status.
+"""
+from azure_ai_search_wrapper import AzureAISearchWrapper
+from benchmarks.stub_search import StubSearchServer
+from benchmarks.timing import best_of, print_table
+
+INDEX_NAME = 'prompt_content'
+
+
+def make_sections(n_sections: int, section_bytes: int = 1000):
+    return [(f'section {i} ' + 'x' * section_bytes, dict(id=str(i), video_id=f'video{i // 100}'))
+            for i in range(n_sections)]
+
+
+def upload_one_by_one(wrapper: AzureAISearchWrapper, sections):
+    for prompt, item_index in sections:
+        wrapper.upload_textual_content(prompt, dict(item_index))
+
+
+def upload_batched(wrapper: AzureAISearchWrapper, sections, **writer_options):
+    with wrapper.batch_writer(INDEX_NAME, retry_delay_secs=0.05, **writer_options) as batch_writer:
+        for prompt, item_index in sections:
+            wrapper.upload_textual_content(prompt, dict(item_index), batch_writer=batch_writer)
+    return batch_writer
+
+
+def run(n_sections: int = 1000, latency_secs: float = 0.02, retriable_failure_rate: float = 0.05):
+    sections = make_sections(n_sections)
+    rows = []
+    runs = [('one call per section', 0.0, None)]
+    runs += [(f'batches of {batch_size}, {n_flushes} concurrent', 0.0,
+              dict(max_batch_size=batch_size, max_concurrent_flushes=n_flushes))
+             for batch_size, n_flushes in ((100, 1), (100, 4), (1000, 1))]
+    runs.append((f'batches of 100, 4 concurrent, {retriable_failure_rate:.0%} retriable failures',
+                 retriable_failure_rate, dict(max_batch_size=100, max_concurrent_flushes=4)))
+    for name, failure_rate, writer_options in runs:
+        server = StubSearchServer(latency_secs=latency_secs, retriable_failure_rate=failure_rate).start()
+        try:
+            wrapper = AzureAISearchWrapper('key', server.endpoint, INDEX_NAME, None)
+            if writer_options is None:
+                secs, _ = best_of(lambda: upload_one_by_one(wrapper, sections), 1)
+                n_failed = n_sections - server.n_documents
+            else:
+                secs, batch_writer = best_of(lambda: upload_batched(wrapper, sections, **writer_options), 1)
+                n_failed = len(batch_writer.failed)
+            wrapper.close()
+            rows.append((name, server.n_requests, server.n_documents, n_failed, secs, n_sections / secs))
+        finally:
+            server.stop()
+    print(f'{n_sections} sections, {latency_secs * 1000:.0f}ms per request')
+    print_table(('upload', 'requests', 'uploaded', 'failed', 'secs', 'sections/sec'), rows)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
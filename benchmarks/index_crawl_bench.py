@@ -0,0 +1,46 @@
+"""
+Crawl of all the video indexes of an account from a local stub Video Indexer with injected latency: the original
+listing followed by one get_video_index call at a time, against iter_video_indexes_async with several in-flight
+limits. The wrapper's rate limit is raised so the client code, not the account quota, is measured.
+"""
+import asyncio
+
+from benchmarks.stub_video_indexer import StubVideoIndexerServer, StubVideoIndexerWrapper
+from benchmarks.timing import best_of, print_table
+
+
+def crawl_sequentially(vi_wrapper) -> int:
+    """
+    The original AccountDashboardUploader._get_all_vi_index_jsons, without writing the indexes.
+    """
+    indexed_videos = vi_wrapper.list_all_indexed_videos()
+    return sum(vi_wrapper.get_video_index(video['id']) is not None for video in indexed_videos)
+
+
+async def crawl_concurrently(vi_wrapper, max_in_flight: int) -> int:
+    n_fetched = 0
+    async for _, video_index in vi_wrapper.iter_video_indexes_async(max_in_flight):
+        n_fetched += video_index is not None
+    return n_fetched
+
+
+def run(n_videos: int = 500, latency_secs: float = 0.02, in_flight_limits=(4, 16, 64)):
+    server = StubVideoIndexerServer(n_videos=n_videos, latency_secs=latency_secs).start()
+    try:
+        vi_wrapper = StubVideoIndexerWrapper(server, requests_per_sec=10000, max_requests_per_sec=10000,
+                                             pool_size=max(in_flight_limits))
+        rows = []
+        secs, n_fetched = best_of(lambda: crawl_sequentially(vi_wrapper), 1)
+        rows.append(('sequential', n_fetched, secs, n_fetched / secs))
+        for max_in_flight in in_flight_limits:
+            secs, n_fetched = best_of(lambda: asyncio.run(crawl_concurrently(vi_wrapper, max_in_flight)), 1)
+            rows.append((f'async, {max_in_flight} in flight', n_fetched, secs, n_fetched / secs))
+    finally:
+        server.stop()
+    print(f'{n_videos} videos, {latency_secs * 1000:.0f}ms per request')
+    print_table(('crawl', 'indexes', 'secs', 'indexes/sec'), rows)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
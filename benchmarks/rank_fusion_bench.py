@@ -0,0 +1,59 @@
+"""
+Rank fusion of synthetic result sets with 10^5 and 10^6 hits: the heap-based fusions of rank_fusion against the
+original fuze_search_results, which concatenated the lists twice and sorted all the hits.
+"""
+import random
+
+import rank_fusion
+from benchmarks.timing import best_of, print_table
+
+
+def make_result_lists(n_hits: int, n_lists: int = 2, seed: int = 0):
+    """
+    :return: n_lists ranked lists of n_hits hits in total, with about 10 hits per video
+    """
+    rng = random.Random(seed)
+    n_videos = max(1, n_hits // 10)
+    result_lists = []
+    for _ in range(n_lists):
+        results = [dict(video_id=f'v{rng.randrange(n_videos)}', segment_id=str(rng.randrange(20)),
+                        relevance_score=rng.random()) for _ in range(n_hits // n_lists)]
+        results.sort(key=lambda result: result['relevance_score'], reverse=True)
+        result_lists.append(results)
+    return result_lists
+
+
+def legacy_fuze_search_results(search_results_kf, search_results_pc, search_k):
+    """
+    The original CoEmbeddingsIndexer.fuze_search_results, scoring into tuples instead of updating the input dicts so
+    the runs can be repeated.
+    """
+    video_occurrences = {}
+    for video in search_results_kf + search_results_pc:
+        video_id = video['video_id']
+        if video_id in video_occurrences:
+            video_occurrences[video_id] += 1
+        else:
+            video_occurrences[video_id] = 1
+    fused_search_results = []
+    for video in search_results_kf + search_results_pc:
+        fused_search_results.append((video['relevance_score'] * video_occurrences[video['video_id']], video))
+    fused_search_results = sorted(fused_search_results, key=lambda x: x[0], reverse=True)
+    return fused_search_results[:search_k]
+
+
+def run(hit_counts=(10 ** 5, 10 ** 6), top_k: int = 10, repeat: int = 3):
+    rows = []
+    for n_hits in hit_counts:
+        result_lists = make_result_lists(n_hits)
+        legacy_secs, _ = best_of(lambda: legacy_fuze_search_results(*result_lists, top_k), repeat)
+        rows.append((n_hits, 'legacy sort', legacy_secs, 1.0))
+        for method in rank_fusion.FUSIONS:
+            secs, _ = best_of(lambda: rank_fusion.fuse(result_lists, method, top_k=top_k), repeat)
+            rows.append((n_hits, method, secs, legacy_secs / secs))
+    print_table(('hits', 'fusion', 'secs', 'speedup'), rows)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,109 @@
+"""
+Worker startup and dispatch cost of the warm Utils.Semaphore pool against the original one-item joblib Parallel per
+task, and the gap between consecutive chunks of the live stream recorders, with a simulated streamlink that takes
+startup_secs to connect before recording each chunk.
+"""
+import functools
+import time
+
+from joblib import Parallel, delayed
+
+import video_streamer
+from benchmarks.timing import print_table
+from Utils import Semaphore
+
+
+def _no_op():
+    return time.perf_counter()
+
+
+class SimulatedStreamer:
+    """
+    Stands in for video_streamer.Streamer: connecting to the stream takes startup_secs, then the chunk is recorded in
+    real time.
+    """
+    def __init__(self, streamlink_id: int, stream_url, video_repo, video_duration, startup_secs: float = 0.5,
+                 log: list = None):
+        hours, minutes, seconds = (int(part) for part in video_duration.split(':'))
+        self.chunk_secs = hours * 3600 + minutes * 60 + seconds
+        self.startup_secs = startup_secs
+        self.log = log
+
+    def stream_video_and_chunk_files(self):
+        time.sleep(self.startup_secs)
+        recording = (time.time(), time.time() + self.chunk_secs)
+        time.sleep(self.chunk_secs)
+        if self.log is not None:
+            self.log.append(recording)
+        return recording
+
+
+def chunk_gaps(recordings):
+    """
+    :param recordings: the (start, end) times of the recorded chunks
+    :return: the time between the end of a chunk and the start of the next one, negative when they overlap
+    """
+    recordings = sorted(recordings)
+    return [later[0] - earlier[1] for earlier, later in zip(recordings, recordings[1:])]
+
+
+def record_like_before(n_chunks: int, video_duration: str, total_seconds: int, startup_secs: float):
+    """
+    The original serialize_live_stream: every chunk runs in a new one-item joblib Parallel, one after the other.
+    """
+    recordings = []
+    for i in range(n_chunks):
+        start_time = time.time()
+        streamer = SimulatedStreamer((i % 2) + 1, None, None, video_duration, startup_secs)
+        recordings += Parallel(n_jobs=2)(delayed(streamer.stream_video_and_chunk_files)() for _ in [dict()])
+        streaming_time = time.time() - start_time
+        if streaming_time < total_seconds:
+            time.sleep(total_seconds - streaming_time)
+    return recordings
+
+
+def record_double_buffered(n_chunks: int, video_duration: str, total_seconds: int, startup_secs: float):
+    recordings = []
+    original_streamer = video_streamer.Streamer
+    video_streamer.Streamer = functools.partial(SimulatedStreamer, startup_secs=startup_secs, log=recordings)
+    try:
+        video_streamer.serialize_live_stream(None, video_duration, total_seconds, None, n_chunks)
+    finally:
+        video_streamer.Streamer = original_streamer
+    return recordings
+
+
+def measure_dispatch(n_tasks: int):
+    rows = []
+    start_time = time.perf_counter()
+    for _ in range(n_tasks):
+        Parallel(n_jobs=2)(delayed(_no_op)() for _ in [dict()])
+    rows.append(('joblib Parallel per task', '-', (time.perf_counter() - start_time) / n_tasks * 1000))
+    for kind in ('thread', 'process'):
+        with Semaphore(2, kind=kind) as pool:
+            startup_secs = pool.warm_up()
+            start_time = time.perf_counter()
+            for _ in range(n_tasks):
+                pool.submit(_no_op).result()
+            rows.append((f'warm {kind} pool', f'{startup_secs * 1000:.1f}',
+                         (time.perf_counter() - start_time) / n_tasks * 1000))
+    print_table(('workers', 'startup ms', 'ms/task'), rows)
+    return rows
+
+
+def run(n_tasks: int = 50, n_chunks: int = 5, chunk_secs: int = 2, startup_secs: float = 0.5):
+    dispatch_rows = measure_dispatch(n_tasks)
+
+    video_duration = time.strftime('%H:%M:%S', time.gmtime(chunk_secs))
+    rows = []
+    for name, record in (('sequential joblib', record_like_before), ('double-buffered pool', record_double_buffered)):
+        start_time = time.time()
+        gaps = chunk_gaps(record(n_chunks, video_duration, chunk_secs, startup_secs))
+        rows.append((name, len(gaps) + 1, time.time() - start_time, sum(gaps) / len(gaps), max(gaps)))
+    print(f'{n_chunks} chunks of {chunk_secs}s, {startup_secs}s streamlink startup, negative gaps are overlaps')
+    print_table(('recorders', 'chunks', 'secs', 'avg gap secs', 'max gap secs'), rows)
+    return dispatch_rows, rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,59 @@
+"""
+Per-query latency of AzureAISearchWrapper.search against a local stub server: a new SearchClient per query, as the
+wrapper used to build, against the cached client per index, and the async client with concurrent queries.
+"""
+import asyncio
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+from azure_ai_search_wrapper import AzureAISearchWrapper
+from benchmarks.stub_search import StubSearchServer
+from benchmarks.timing import best_of, print_table
+
+INDEX_NAME = 'keyframes'
+
+
+def search_with_new_client(endpoint: str, key: str, query: str):
+    """
+    The original AzureAISearchWrapper.search, closing the client so the benchmark does not leak connections.
+    """
+    with SearchClient(endpoint=endpoint, index_name=INDEX_NAME, credential=AzureKeyCredential(key)) as search_client:
+        return [result for result in search_client.search(search_text=query)]
+
+
+async def search_concurrently(wrapper: AzureAISearchWrapper, n_queries: int):
+    try:
+        return await asyncio.gather(*[wrapper.search_async(f'query {i}', INDEX_NAME) for i in range(n_queries)])
+    finally:
+        await wrapper.aclose()
+
+
+def run(n_queries: int = 200, latencies_secs=(0.0, 0.005), repeat: int = 3):
+    rows = []
+    for latency_secs in latencies_secs:
+        server = StubSearchServer(latency_secs=latency_secs).start()
+        try:
+            wrapper = AzureAISearchWrapper('key', server.endpoint, INDEX_NAME, None)
+            # the first query opens the cached client's connection
+            wrapper.search('warm up', INDEX_NAME)
+            new_client_secs, _ = best_of(
+                lambda: [search_with_new_client(server.endpoint, 'key', f'query {i}') for i in range(n_queries)],
+                repeat)
+            cached_secs, _ = best_of(lambda: [wrapper.search(f'query {i}', INDEX_NAME) for i in range(n_queries)],
+                                     repeat)
+            wrapper.close()
+            async_secs, _ = best_of(lambda: asyncio.run(search_concurrently(
+                AzureAISearchWrapper('key', server.endpoint, INDEX_NAME, None), n_queries)), repeat)
+        finally:
+            server.stop()
+        latency_ms = latency_secs * 1000
+        rows.append((latency_ms, 'new client per query', new_client_secs / n_queries * 1000))
+        rows.append((latency_ms, 'cached client', cached_secs / n_queries * 1000))
+        rows.append((latency_ms, 'async client, concurrent', async_secs / n_queries * 1000))
+    print_table(('server ms', 'client', 'ms/query'), rows)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,109 @@
+"""
+Memory and serialization throughput of video segments held as the original VideoSegmentIndex objects with a
+per-instance __dict__, as the __slots__ records, and as a SegmentTable. The vectors of the objects are lists, as
+returned by the embedding services.
+"""
+import gc
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from azure_ai_search_wrapper import VideoSegmentIndex
+from benchmarks.timing import best_of, print_table
+from segment_table import SegmentTable
+
+
+class LegacyVideoSegmentIndex:
+    """
+    The original VideoSegmentIndex.
+    """
+    def __init__(self, location, account_id, video_id, thumbnail_id, start_time, end_time, prompt, image_path, content_vector):
+        self.location = location
+        self.account_id = account_id
+        self.video_id = video_id
+        self.segment_id = thumbnail_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.prompt = prompt
+        self.image_path = image_path
+        self.content_vector = content_vector
+
+    def to_dict(self):
+        return dict(video_id=self.video_id, segment_id=self.segment_id, start_time=self.start_time,
+                    end_time=self.end_time, prompt=self.prompt, image_path=self.image_path,
+                    content_vector=self.content_vector, location=self.location, account_id=self.account_id)
+
+
+def segment_fields(i: int):
+    return 'eastus', 'account', f'video{i // 200}', f'thumbnail-{i}', i * 2.0, i * 2.0 + 2, f'prompt {i}', f'/kf/{i}.jpg'
+
+
+def traced_bytes(build):
+    """
+    :return: the bytes allocated by build() and still held by its result, and the result
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+
+def build_table(vectors: np.ndarray) -> SegmentTable:
+    table = SegmentTable(vectors.shape[1])
+    for i, vector in enumerate(vectors):
+        table.append(*segment_fields(i), vector)
+    return table
+
+
+def run(n_segments: int = 50_000, dim: int = 512):
+    vectors = np.random.default_rng(0).normal(size=(n_segments, dim)).astype(np.float32)
+    legacy_bytes, legacy = traced_bytes(
+        lambda: [LegacyVideoSegmentIndex(*segment_fields(i), vector.tolist()) for i, vector in enumerate(vectors)])
+    slots_bytes, slots = traced_bytes(
+        lambda: [VideoSegmentIndex(*segment_fields(i), vector.tolist()) for i, vector in enumerate(vectors)])
+    table_bytes, table = traced_bytes(lambda: build_table(vectors))
+    print_table(('records', 'MiB', 'bytes/segment'),
+                [(name, n_bytes / 2 ** 20, n_bytes // n_segments) for name, n_bytes in
+                 (('legacy objects', legacy_bytes), ('__slots__ objects', slots_bytes), ('SegmentTable', table_bytes))])
+    del slots
+
+    rows = []
+    legacy_dict_secs, _ = best_of(lambda: [segment.to_dict() for segment in legacy], 1)
+    rows.append(('legacy to_dict', legacy_dict_secs, n_segments / legacy_dict_secs))
+    legacy_json_secs, _ = best_of(lambda: [json.dumps(segment.to_dict()) for segment in legacy], 1)
+    rows.append(('legacy to_dict + json', legacy_json_secs, n_segments / legacy_json_secs))
+    table_json_secs, _ = best_of(lambda: [json.dumps(document) for document in table.iter_documents()], 1)
+    rows.append(('table iter_documents + json', table_json_secs, n_segments / table_json_secs))
+
+    folder = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(folder, 'segments.json')
+
+        def dump_json():
+            with open(json_path, 'w') as f:
+                json.dump([segment.to_dict() for segment in legacy], f)
+
+        def load_json():
+            with open(json_path) as f:
+                return json.load(f)
+
+        for name, do_work in (('legacy json dump', dump_json), ('legacy json load', load_json),
+                              ('table save', lambda: table.save(os.path.join(folder, 'table'))),
+                              ('table load, mmap', lambda: SegmentTable.load(os.path.join(folder, 'table')))):
+            secs, _ = best_of(do_work, 1)
+            rows.append((name, secs, n_segments / secs))
+    finally:
+        shutil.rmtree(folder)
+    print_table(('path', 'secs', 'segments/sec'), rows)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,92 @@
+"""
+A local stand-in for the Azure AI Search REST API: document searches return a few fixed hits, document uploads
+succeed and every index is keyed by its 'id' field, every request after an injected latency.
+"""
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubSearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the concurrent benchmarks open many connections at once
+    request_queue_size = 1024
+
+    def __init__(self, latency_secs: float = 0.0, retriable_failure_rate: float = 0.0, seed: int = 0):
+        """
+        :param latency_secs: the delay of every response
+        :param retriable_failure_rate: the share of uploaded documents rejected with a 503 status
+        """
+        super().__init__(('127.0.0.1', 0), _StubSearchHandler)
+        self.latency_secs = latency_secs
+        self.retriable_failure_rate = retriable_failure_rate
+        self.n_requests = 0
+        self.n_documents = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self) -> 'StubSearchServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def upload_results(self, documents: list) -> list:
+        with self._lock:
+            self.n_requests += 1
+            failures = [self._random.random() < self.retriable_failure_rate for _ in documents]
+            self.n_documents += failures.count(False)
+        return [dict(key=str(document.get('id', '')), status=not failed, statusCode=503 if failed else 201,
+                     errorMessage='Service unavailable' if failed else None)
+                for document, failed in zip(documents, failures)]
+
+    def search_results(self, query: str) -> list:
+        with self._lock:
+            self.n_requests += 1
+        return [{'@search.score': 1.0 / (i + 1), 'video_id': f'v{i}', 'segment_id': str(i), 'prompt': query}
+                for i in range(5)]
+
+
+class _StubSearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # the index definition, e.g. /indexes('keyframes')?api-version=...
+        index_name = self.path.split("('")[-1].split("')")[0]
+        payload = json.dumps(dict(name=index_name, fields=[dict(name='id', type='Edm.String', key=True),
+                                                           dict(name='content', type='Edm.String')])).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.server.latency_secs)
+        if 'value' in body:
+            results = self.server.upload_results(body['value'])
+            # a batch with rejected documents is answered with a 207 multi-status, as the service does
+            status = 207 if any(not result['status'] for result in results) else 200
+        else:
+            results = self.server.search_results(body.get('search', ''))
+            status = 200
+        payload = json.dumps(dict(value=results)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
@@ -0,0 +1,98 @@
+"""
+A local stand-in for the Video Indexer account API: the access token, the paged video listing and the video indexes,
+every request after an injected latency.
+"""
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from video_indexer_wrapper import VideoIndexerWrapper
+
+
+class StubVideoIndexerServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the concurrent benchmarks open many connections at once
+    request_queue_size = 1024
+
+    def __init__(self, n_videos: int = 1000, latency_secs: float = 0.0):
+        """
+        :param n_videos: the number of videos in the account
+        :param latency_secs: the delay of every GET response
+        """
+        super().__init__(('127.0.0.1', 0), _StubVideoIndexerHandler)
+        self.n_videos = n_videos
+        self.latency_secs = latency_secs
+        self.n_requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self) -> 'StubVideoIndexerServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_request(self):
+        with self._lock:
+            self.n_requests += 1
+
+
+class _StubVideoIndexerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status: int, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlparse(self.path).path.endswith('generateAccessToken'):
+            return self._send_json(200, dict(accessToken='stub-token'))
+        return self._send_json(404, dict(ErrorType='NOT_FOUND'))
+
+    def do_GET(self):
+        self.server.count_request()
+        time.sleep(self.server.latency_secs)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts[-1] == 'Videos':
+            skip = int(query.get('skip', ['0'])[0])
+            page_size = int(query.get('pageSize', ['25'])[0])
+            n_videos = self.server.n_videos
+            videos = [dict(id=f'video{i}', name=f'video {i}', state='Processed') for i in
+                      range(skip, min(skip + page_size, n_videos))]
+            return self._send_json(200, dict(results=videos, nextPage=dict(
+                done=skip + page_size >= n_videos, skip=skip, pageSize=page_size)))
+        if parts[-1] == 'Index':
+            return self._send_json(200, dict(id=parts[-2], state='Processed',
+                                             videos=[dict(insights=dict(faces=[], labels=[]))]))
+        return self._send_json(404, dict(ErrorType='NOT_FOUND'))
+
+
+class StubVideoIndexerWrapper(VideoIndexerWrapper):
+    """
+    A VideoIndexerWrapper of the stub server, which needs no Azure credentials.
+    """
+    def __init__(self, server: StubVideoIndexerServer, **kwargs):
+        super().__init__(location='trial', account_id='account', api_url=server.url, management_url=server.url,
+                         background_token_refresh=False, **kwargs)
+
+    def get_azure_access_token(self):
+        self.azure_access_token = 'Bearer stub-token'
+        self.azure_token_expires_on = time.time() + 3600
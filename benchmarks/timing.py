@@ -0,0 +1,25 @@
+import time
+
+
+def best_of(do_work, repeat: int = 3):
+    """
+    :param do_work: called without arguments
+    :return: the best wall time of repeat calls in seconds, and the result of the last call
+    """
+    best_secs, result = float('inf'), None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = do_work()
+        best_secs = min(best_secs, time.perf_counter() - start_time)
+    return best_secs, result
+
+
+def print_table(header, rows):
+    """
+    Print rows of values as aligned columns, floats with 3 decimals.
+    """
+    cells = [[f'{value:.3f}' if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max(len(str(title)), *(len(row[i]) for row in cells)) for i, title in enumerate(header)]
+    print('  '.join(str(title).rjust(width) for title, width in zip(header, widths)))
+    for row in cells:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
@@ -0,0 +1,74 @@
+"""
+Recall and latency of the LocalVectorIndex searches against brute force, on clustered synthetic embeddings: the
+batched exact search, one query at a time, a naive full argsort per query, and the IVF search by nprobe.
+"""
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.timing import best_of, print_table
+from vector_index import LocalVectorIndex, _normalize_rows
+
+
+def make_vectors(n_vectors: int, n_queries: int, dim: int, n_centers: int = 2000, seed: int = 1):
+    """
+    :return: the (n_vectors, dim) data and the (n_queries, dim) queries, both drawn around the same random centers
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_centers, dim)).astype(np.float32)
+    data = centers[rng.integers(0, n_centers, n_vectors)] + rng.normal(size=(n_vectors, dim)).astype(np.float32)
+    queries = centers[rng.integers(0, n_centers, n_queries)] + rng.normal(size=(n_queries, dim)).astype(np.float32)
+    return data, queries
+
+
+def recall_at_k(results, truth, top_k: int) -> float:
+    return float(np.mean([len({item_id for item_id, _ in found} & {item_id for item_id, _ in expected}) / top_k
+                          for found, expected in zip(results, truth)]))
+
+
+def run(n_vectors: int = 200_000, dim: int = 512, n_queries: int = 1000, top_k: int = 10,
+        nprobes=(1, 4, 8, 16, 32), n_single_queries: int = 100):
+    data, queries = make_vectors(n_vectors, n_queries, dim)
+    index = LocalVectorIndex(dim)
+    add_secs, _ = best_of(lambda: index.add(range(n_vectors), data), 1)
+    print(f'Added {n_vectors} vectors of {dim} dims in {add_secs:.2f}s')
+
+    rows = []
+    exact_secs, truth = best_of(lambda: index.search(queries, top_k, exact=True), 1)
+    rows.append(('exact, batched', 1.0, exact_secs / n_queries * 1000))
+    single_secs, _ = best_of(lambda: [index.search(query, top_k, exact=True) for query in queries[:n_single_queries]],
+                             1)
+    rows.append(('exact, one query at a time', 1.0, single_secs / n_single_queries * 1000))
+
+    # what a caller without the index would write: score every vector and sort all of them
+    vectors = _normalize_rows(data)
+    normalized_queries = _normalize_rows(queries[:n_single_queries])
+    naive_secs, _ = best_of(lambda: [np.argsort(-(vectors @ query))[:top_k] for query in normalized_queries], 1)
+    rows.append(('naive argsort', 1.0, naive_secs / n_single_queries * 1000))
+
+    train_secs, _ = best_of(index.train_ivf, 1)
+    print(f'Trained {len(index._centroids)} IVF clusters in {train_secs:.2f}s')
+    for nprobe in nprobes:
+        ivf_secs, results = best_of(lambda: index.search(queries, top_k, nprobe=nprobe), 1)
+        rows.append((f'ivf, nprobe={nprobe}', recall_at_k(results, truth, top_k), ivf_secs / n_queries * 1000))
+    print_table(('search', f'recall@{top_k}', 'ms/query'), rows)
+
+    # a saved index is searched from memory-mapped files
+    folder = tempfile.mkdtemp()
+    try:
+        index.save(folder)
+        start_time = time.perf_counter()
+        loaded = LocalVectorIndex.load(folder)
+        load_secs = time.perf_counter() - start_time
+        mmap_secs, results = best_of(lambda: loaded.search(queries, top_k, exact=True), 1)
+        print(f'Loaded with mmap in {load_secs * 1000:.1f}ms, first batched exact search {mmap_secs:.2f}s, '
+              f'recall@{top_k} {recall_at_k(results, truth, top_k):.3f}')
+    finally:
+        shutil.rmtree(folder)
+    return rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,145 @@
+"""
+Uploads in-memory blobs, e.g. keyframes and prompt section JSONs, to Blob Storage on a bounded pool of workers.
+The container clients are created once per container and shared by the workers, and a blob whose sha256 metadata
+already matches its content is not uploaded again, so re-indexing a video only uploads what changed.
+"""
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from Utils import Semaphore
+
+SHA256_METADATA_KEY = 'sha256'
+
+
+class BlobUploadStage:
+    def __init__(self, blob_service_client, n_workers: int = 8, skip_unchanged: bool = True,
+                 create_containers: bool = True):
+        """
+        :param blob_service_client: the azure.storage.blob.BlobServiceClient to upload through
+        :param n_workers: the number of concurrent uploads, submit() blocks while all of them are busy
+        :param skip_unchanged: skip the blobs whose sha256 metadata matches their content. The sha256 of a container's
+            blobs are listed the first time it is uploaded to and kept in memory for the life of the stage, one entry
+            of about 200 bytes per blob of the container.
+        :param create_containers: create the containers that do not exist yet
+        """
+        self.blob_service_client = blob_service_client
+        self.skip_unchanged = skip_unchanged
+        self.create_containers = create_containers
+        self.n_uploaded = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+        # futures of the client and the sha256 of the blobs of each container, the first submit() to a container
+        # initializes it while the ones to other containers go on
+        self._containers = dict()
+        self._uploaders = Semaphore(n_workers, kind='thread')
+        self._start_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_container(self, container: str):
+        """
+        :return: the container's client and the sha256 of its blobs by name
+        """
+        with self._lock:
+            container_future = self._containers.get(container)
+            owner = container_future is None
+            if owner:
+                container_future = self._containers[container] = Future()
+        if not owner:
+            return container_future.result()
+
+        try:
+            container_client = self.blob_service_client.get_container_client(container)
+            hashes = dict()
+            try:
+                if self.skip_unchanged:
+                    for blob in container_client.list_blobs(include=['metadata']):
+                        if blob.metadata and SHA256_METADATA_KEY in blob.metadata:
+                            hashes[blob.name] = blob.metadata[SHA256_METADATA_KEY]
+                elif self.create_containers:
+                    container_client.create_container()
+            except ResourceNotFoundError:
+                if self.create_containers:
+                    container_client.create_container()
+            except ResourceExistsError:
+                pass
+        except Exception as e:
+            # the next submit() to the container tries again
+            with self._lock:
+                del self._containers[container]
+            container_future.set_exception(e)
+            raise
+        container_future.set_result((container_client, hashes))
+        return container_client, hashes
+
+    def submit(self, container: str, blob_name: str, data: bytes):
+        """
+        Start uploading a blob, blocking while all the workers are busy.
+        :return: a future of whether the blob was uploaded, False when it was unchanged. It raises the upload error
+            when the upload failed.
+        """
+        if self._start_time is None:
+            self._start_time = time.perf_counter()
+        container_client, hashes = self._get_container(container)
+        content_hash = hashlib.sha256(data).hexdigest()
+        if self.skip_unchanged and hashes.get(blob_name) == content_hash:
+            with self._lock:
+                self.n_skipped += 1
+            return _done_future(False)
+        return self._uploaders.submit(self._upload, container_client=container_client, hashes=hashes,
+                                      blob_name=blob_name, data=data, content_hash=content_hash)
+
+    def upload_all(self, items):
+        """
+        :param items: (container, blob name, bytes) triplets
+        :return: the number of uploaded blobs, the failed ones are counted in the stats
+        """
+        futures = [self.submit(container, blob_name, data) for container, blob_name, data in items]
+        return sum(future.exception() is None and future.result() for future in futures)
+
+    def _upload(self, container_client, hashes: dict, blob_name: str, data: bytes, content_hash: str) -> bool:
+        try:
+            container_client.upload_blob(blob_name, data, overwrite=True,
+                                         metadata={SHA256_METADATA_KEY: content_hash})
+        except Exception as e:
+            print(f'Failed to upload blob {container_client.container_name}/{blob_name}: {e}')
+            with self._lock:
+                self.n_failed += 1
+            raise
+        hashes[blob_name] = content_hash
+        with self._lock:
+            self.n_uploaded += 1
+            self.n_bytes += len(data)
+        return True
+
+    def stats(self) -> dict:
+        elapsed_secs = time.perf_counter() - self._start_time if self._start_time is not None else 0.0
+        with self._lock:
+            return dict(uploaded=self.n_uploaded, skipped=self.n_skipped, failed=self.n_failed, bytes=self.n_bytes,
+                        mb_per_sec=self.n_bytes / 2 ** 20 / elapsed_secs if elapsed_secs else 0.0,
+                        blobs_per_sec=self.n_uploaded / elapsed_secs if elapsed_secs else 0.0)
+
+    def report(self):
+        stats = self.stats()
+        print(f'Uploaded {stats["uploaded"]} blobs ({stats["bytes"] / 2 ** 20:.1f}MB at {stats["mb_per_sec"]:.1f}MB/s, '
+              f'{stats["blobs_per_sec"]:.0f} blobs/s), skipped {stats["skipped"]} unchanged ones, '
+              f'{stats["failed"]} failed')
+
+    def close(self):
+        self._uploaders.close()
+
+
+def _done_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
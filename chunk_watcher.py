@@ -0,0 +1,213 @@
+"""
+Detects complete video chunks written to a folder by an external recorder such as streamlink.
+On Linux the folder is watched with inotify and a chunk is emitted once its writer closes it. The files found at startup
+or after the inotify queue overflowed are emitted at once unless a process has them open for writing, in which case
+their close event is waited for. Elsewhere, or when /proc cannot be read, a chunk is emitted once its size stops
+changing.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """
+    A minimal ctypes binding of inotify watching a single folder for closed-after-write and moved-in files.
+    """
+    def __init__(self, folder: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {folder}')
+
+    def read_names(self, timeout_secs: float):
+        """
+        :return: the names of the files closed or moved in within the timeout, and whether events were lost because
+            the kernel queue overflowed
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout_secs)
+        if not readable:
+            return [], False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+        names = []
+        overflowed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            else:
+                names.append(os.fsdecode(data[offset:offset + name_length].rstrip(b'\0')))
+            offset += name_length
+        return names, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _names_open_for_writing(folder: str):
+    """
+    :return: the names of the files in a folder that a process visible in /proc has open for writing, None when /proc
+        cannot be read
+    """
+    if not os.path.isdir('/proc/self/fdinfo'):
+        return None
+    folder = os.path.realpath(folder)
+    names = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except OSError:
+            # exited, or owned by another user
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f'/proc/{pid}/fd/{fd}')
+                if os.path.dirname(target) != folder:
+                    continue
+                with open(f'/proc/{pid}/fdinfo/{fd}') as f:
+                    flags = int(f.read().split('flags:')[1].split()[0], 8)
+            except (OSError, IndexError, ValueError):
+                continue
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                names.add(os.path.basename(target))
+    return names
+
+
+class ChunkWatcher:
+    """
+    Yields the path of every complete chunk in a folder exactly once.
+    """
+    def __init__(self, folder: str, suffix: str = '.ts', settle_secs: float = 2.0, poll_interval_secs: float = 0.5,
+                 use_inotify: bool = None):
+        """
+        :param folder: the folder the recorder writes to
+        :param suffix: the chunk file suffix
+        :param settle_secs: how long a polled file's size has to stay unchanged before it is considered complete
+        :param poll_interval_secs: the polling interval, and the inotify wait timeout
+        :param use_inotify: None to use inotify when available
+        """
+        self.folder = folder
+        self.suffix = suffix
+        self.settle_secs = settle_secs
+        self.poll_interval_secs = poll_interval_secs
+        self.use_inotify = sys.platform.startswith('linux') if use_inotify is None else use_inotify
+        self._emitted = set()
+        self._settling = dict()
+
+    def _scan(self):
+        """
+        Track the size of every unseen chunk, and forget the emitted chunks that were already deleted
+        """
+        existing = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(self.suffix) or not entry.is_file():
+                    continue
+                existing.add(entry.path)
+                if entry.path in self._emitted:
+                    continue
+                size = entry.stat().st_size
+                last_size, changed_at = self._settling.get(entry.path, (None, None))
+                if size != last_size:
+                    self._settling[entry.path] = (size, time.monotonic())
+        self._emitted &= existing
+
+    def _pop_settled(self):
+        now = time.monotonic()
+        settled = [path for path, (size, changed_at) in self._settling.items()
+                   if size > 0 and now - changed_at >= self.settle_secs]
+        for path in settled:
+            del self._settling[path]
+        return settled
+
+    def _pop_closed(self):
+        """
+        With inotify, split the unseen chunks of the last scan: the ones no process has open for writing are complete,
+        the others are emitted on their close event. Their sizes keep settling when /proc cannot be read.
+        :return: the complete chunks
+        """
+        names_open_for_writing = _names_open_for_writing(self.folder)
+        if names_open_for_writing is None:
+            return []
+        closed = [path for path, (size, _) in self._settling.items()
+                  if size > 0 and os.path.basename(path) not in names_open_for_writing]
+        self._settling.clear()
+        return closed
+
+    def _emit(self, path: str) -> bool:
+        self._settling.pop(path, None)
+        if path in self._emitted or not os.path.isfile(path):
+            return False
+        if len(self._emitted) >= 1024:
+            # uploaded chunks are deleted, only the ones still on disk can be reported again
+            self._emitted = {emitted for emitted in self._emitted if os.path.exists(emitted)}
+        self._emitted.add(path)
+        return True
+
+    def watch(self, stop_event=None):
+        """
+        Yield complete chunks until stop_event is set.
+        :param stop_event: a threading.Event, None to watch forever
+        :return: a generator of chunk paths
+        """
+        inotify = None
+        if self.use_inotify:
+            try:
+                inotify = _Inotify(self.folder)
+            except (OSError, AttributeError) as e:
+                print(f'inotify is not available, falling back to polling: {e}')
+
+        # the files written before the watch started, the watch is set first so their close events are not missed
+        self._scan()
+        try:
+            if inotify is not None:
+                for path in self._pop_closed():
+                    if self._emit(path):
+                        yield path
+            while stop_event is None or not stop_event.is_set():
+                if inotify is not None:
+                    if self._settling:
+                        # keep tracking the sizes of the files found at startup until they settle
+                        self._scan()
+                    names, overflowed = inotify.read_names(self.poll_interval_secs)
+                    for name in names:
+                        path = os.path.join(self.folder, name)
+                        if name.endswith(self.suffix) and self._emit(path):
+                            yield path
+                    if overflowed:
+                        print(f'Lost the inotify events of {self.folder}, rescanning it')
+                        self._scan()
+                        for path in self._pop_closed():
+                            if self._emit(path):
+                                yield path
+                else:
+                    time.sleep(self.poll_interval_secs)
+                    self._scan()
+                for path in self._pop_settled():
+                    if self._emit(path):
+                        yield path
+        finally:
+            if inotify is not None:
+                inotify.close()
@@ -4,149 +4,263 @@ Assuming the account has indexed videos, generate PromptContent and download key
 import json
 import os
 
-from config_manager import load_config
 from azure_ai_search_wrapper import AzureAISearchWrapper
+from image_embedding import ImageEmbeddingStage, create_image_embedder
+from incremental_sync import ChangeFeed, UPSERT
+from indexing_tracker import IndexingCompletionTracker
+from job_manifest import JobManifest
+from keyframe_reader import iter_zip_members
+from rank_fusion import fuse
 from video_indexer_wrapper import VideoIndexerWrapper
 
+# the stages of indexing a video in the job manifest
+KEYFRAMES_DOWNLOAD_STAGE = 'keyframes_download'
+PROMPT_CONTENT_STAGE = 'prompt_content'
+PROMPT_CONTENT_INDEX_STAGE = 'prompt_content_index'
+KEYFRAMES_INDEX_STAGE = 'keyframes_index'
+
 
 class CoEmbeddingsIndexer:
     """
     This class is used to index the keyframes of the videos with CLIP embeddings and upload them to Azure AI Search.
     """
-    def __init__(self, config, search_k: int = 10):
+    def __init__(self, config, search_k: int = 10, fusion_method: str = 'occurrence', image_embedder=None,
+                 embedding_batch_size: int = 32, n_decode_workers: int = 4):
+        """
+        :param config: the configuration dict
+        :param search_k: the number of fused search results
+        :param fusion_method: the rank_fusion method, by default the original ranking by the best score times the number
+            of results of the video. 'rrf' ranks by reciprocal rank instead, which changes the order of the results.
+        :param image_embedder: the keyframe embedder, by default the one named in config['embedding']['model'], CLIP
+            on CPU when not configured
+        :param embedding_batch_size: the number of keyframes per forward pass
+        :param n_decode_workers: the number of keyframe decoding threads
+        """
         self.video_indexer_wrapper = VideoIndexerWrapper(**config['vi'])
         self.azure_ai_search_wrapper = AzureAISearchWrapper(**config['ais'])
+        self.search_k = search_k
+        self.fusion_method = fusion_method
+
+        # the embedding model is only loaded once keyframes are indexed, searching does not need it
+        self.config = config
+        self.image_embedder = image_embedder
+        self.embedding_batch_size = embedding_batch_size
+        self.n_decode_workers = n_decode_workers
+        self._image_embedding_stage = None
+
+    def get_image_embedding_stage(self) -> ImageEmbeddingStage:
+        if self._image_embedding_stage is None:
+            embedding_config = dict(self.config.get('embedding', {}))
+            if self.image_embedder is None:
+                self.image_embedder = create_image_embedder(embedding_config.pop('model', 'clip'), **embedding_config)
+
+            # keyframe embeddings are cached by image content next to the downloaded keyframes
+            working_directory = self.config.get('main', {}).get('workingDir')
+            cache_path = None
+            if working_directory is not None:
+                cache_path = os.path.join(working_directory, f'image_embeddings_{self.image_embedder.name}.bin')
+            self._image_embedding_stage = ImageEmbeddingStage(self.image_embedder,
+                                                              batch_size=self.embedding_batch_size,
+                                                              n_decode_workers=self.n_decode_workers,
+                                                              cache_path=cache_path)
+        return self._image_embedding_stage
+
+    def save_image_embeddings(self):
+        """
+        Save the keyframe embeddings computed since the last save to the embedding cache.
+        """
+        if self._image_embedding_stage is not None:
+            self._image_embedding_stage.cache.save()
+
+    def close(self):
+        if self._image_embedding_stage is not None:
+            self._image_embedding_stage.close()
+            self._image_embedding_stage = None
 
     def upload_texts_to_azure_ai_search(self, prompt_content_json_path, video_id):
-        prompt_content_json = json.load(open(prompt_content_json_path))
-        for prompt_segment in prompt_content_json['sections']:
-            segment_id = prompt_segment['id']
-            start_time = prompt_segment['start']
-            end_time = prompt_segment['end']
-            prompt = prompt_segment['content']
-            item_index = dict(video_id=video_id, segment_id=segment_id, start_time=start_time, end_time=end_time)
-            self.azure_ai_search_wrapper.upload_textual_content(prompt, item_index)
+        with open(prompt_content_json_path) as f:
+            self.upload_prompt_content(json.load(f), video_id)
 
-    def index_image_zip(self, file, video_id, working_directory):
-        # unzip the file into a temp directory
-        temp_directory = f'{working_directory}/{file}'[:-4]
-        os.system(f'unzip {temp_directory}.zip -d {temp_directory}')
+    def upload_prompt_content(self, prompt_content_json: dict, video_id):
+        # the sections are uploaded in batches rather than one request per section
+        with self.azure_ai_search_wrapper.batch_writer() as batch_writer:
+            for prompt_segment in prompt_content_json['sections']:
+                segment_id = prompt_segment['id']
+                start_time = prompt_segment['start']
+                end_time = prompt_segment['end']
+                prompt = prompt_segment['content']
+                item_index = dict(video_id=video_id, segment_id=segment_id, start_time=start_time, end_time=end_time)
+                self.azure_ai_search_wrapper.upload_textual_content(prompt, item_index, batch_writer)
 
-        # upload images to Azure AI Search
-        images = [os.path.join(temp_directory, image) for image in os.listdir(temp_directory)]
+    def index_image_zip(self, file, video_id, working_directory):
+        # stream the keyframes out of the zip, nothing is extracted to disk
+        keyframes = iter_zip_members(os.path.join(working_directory, file))
+        return self.index_keyframes(keyframes, video_id)
 
-        # embed images with CLIP
-        # embeddings_dicts = [dict(video_id=video_id, clip_embeddings=self.clip_encode_image(image)) for image in range(len(images))]
+    def index_keyframes(self, keyframes, video_id):
+        """
+        Embed keyframes and upload them to the keyframes index as they arrive.
+        :param keyframes: (keyframe file name, image bytes) pairs, e.g. from VideoIndexerWrapper.iter_keyframes
+        :param video_id: the video id
+        :return: the number of indexed keyframes
+        """
+        # embed images in batches, unchanged keyframes are served from the embedding cache
+        image_embedding_stage = self.get_image_embedding_stage()
+        n_keyframes = 0
 
-        item_index = dict(video_id=video_id, start_time=0, end_time=0, )
-        self.azure_ai_search_wrapper.upload_images(images, item_index, 'keyframes')
+        # upload images with their embeddings to Azure AI Search, one document per keyframe
+        with self.azure_ai_search_wrapper.batch_writer('keyframes') as batch_writer:
+            for image, embedding in image_embedding_stage.embed(keyframes):
+                segment_id = os.path.splitext(os.path.basename(image))[0]
+                item_index = dict(video_id=video_id, segment_id=segment_id, start_time=0, end_time=0)
+                self.azure_ai_search_wrapper.upload_images([f'{video_id}/{image}'], item_index, 'keyframes',
+                                                           batch_writer, vectors=[embedding])
+                n_keyframes += 1
+        print(f'Indexed {n_keyframes} keyframes of video {video_id}: {image_embedding_stage.stats()}')
+        return n_keyframes
 
-    def main_co_embeddings_indexing(self):
-        # load configuration
-        config = load_config()
-        working_directory = config['main']['workingDir']
+    def main_co_embeddings_indexing(self, manifest: JobManifest = None):
+        """
+        :param manifest: the checkpoint of the indexed videos, by default the one in the working directory. A restart
+            skips the stages the videos already went through.
+        """
+        working_directory = self.config['main']['workingDir']
+        owns_manifest = manifest is None
+        manifest = manifest if manifest is not None else JobManifest.in_directory(working_directory)
 
         # list indexed videos
         indexed_videos = self.video_indexer_wrapper.list_all_indexed_videos()
 
-        # download keyframes
-        self.video_indexer_wrapper.download_keyframes(indexed_videos, working_directory)
+        # download keyframes, the zips of a previous run are not validated again
+        videos_to_download = [indexed_video for indexed_video in indexed_videos
+                              if not manifest.is_done(indexed_video['id'], KEYFRAMES_DOWNLOAD_STAGE)]
+        kf_video_id_to_zip, failed_video_ids = self.video_indexer_wrapper.download_keyframes(videos_to_download,
+                                                                                               working_directory)
+        for video_id in kf_video_id_to_zip:
+            manifest.done(video_id, KEYFRAMES_DOWNLOAD_STAGE)
+        for video_id in failed_video_ids:
+            manifest.failed(video_id, KEYFRAMES_DOWNLOAD_STAGE)
 
         # generate PromptContent
-        for indexed_video in indexed_videos:
-            self.video_indexer_wrapper.create_prompt_content(indexed_video['id'])
+        videos_to_prompt = [indexed_video['id'] for indexed_video in indexed_videos
+                            if not manifest.is_done(indexed_video['id'], PROMPT_CONTENT_STAGE)]
+        for video_id in videos_to_prompt:
+            self.video_indexer_wrapper.create_prompt_content(video_id)
 
         # get PromptContent
         prompts_failures = []
-        for indexed_video in indexed_videos:
-            prompt_content_response = self.video_indexer_wrapper.get_prompt_content(indexed_videos)
+        for video_id in videos_to_prompt:
+            prompt_content_response = self.video_indexer_wrapper.get_prompt_content(video_id)
 
             # validate response code 200
-            if prompt_content_response.status_code != 200:
-                print(f'Failed to get prompt content for video: {indexed_video}')
-                prompts_failures.append(indexed_video)
+            if prompt_content_response is None or prompt_content_response.status_code != 200:
+                print(f'Failed to get prompt content for video: {video_id}')
+                prompts_failures.append(video_id)
+                manifest.failed(video_id, PROMPT_CONTENT_STAGE)
                 continue
 
-            with open(f'{working_directory}/{indexed_video}_prompt_content.json', 'w') as f:
+            with open(f'{working_directory}/{video_id}_prompt_content.json', 'w') as f:
                 f.write(prompt_content_response.text)
+            manifest.done(video_id, PROMPT_CONTENT_STAGE)
 
         if prompts_failures:
             print(f'Failed to get prompt content for videos: {prompts_failures}')
 
-        # upload PromptContent to Azure AI Search
-        azure_ai_search_wrapper = AzureAISearchWrapper(**config['ais'])
-        for file in os.listdir(working_directory):
-            video_id = file.split('_')[0]
-            if file.endswith('_prompt_content.json'):
-                self.upload_texts_to_azure_ai_search(f'{working_directory}/{file}', video_id)
-
-            if file.endswith('.zip'):
-                self.index_image_zip(file, video_id, working_directory, azure_ai_search_wrapper)
-
-    # def clip_encode_image(self, image_path):
-    #     """
-    #     Embed the image with CLIP.
-    #     :param image_path: a path to the image.
-    #     :return: the image's CLIP embeddings.
-    #     """
-    #
-    #     # Load your image
-    #     image = Image.open(image_path)
-    #
-    #     # Preprocess the image
-    #     preprocessed_image = self.preprocess(image).unsqueeze(0).to('cuda')
-    #
-    #     # Calculate image features
-    #     with torch.no_grad():
-    #         image_features = self.model.encode_image(preprocessed_image)
-    #
-    #     # image_features now contains the embedded representation of the image
-    #     return image_features.tolist()
-
-    def fuze_search_results(self, search_results_kf, search_results_pc):
+        # upload PromptContent and keyframes to Azure AI Search
+        for indexed_video in indexed_videos:
+            video_id = indexed_video['id']
+            if manifest.is_done(video_id, PROMPT_CONTENT_STAGE) and \
+                    not manifest.is_done(video_id, PROMPT_CONTENT_INDEX_STAGE):
+                self._run_stage(manifest, video_id, PROMPT_CONTENT_INDEX_STAGE, self.upload_texts_to_azure_ai_search,
+                                f'{working_directory}/{video_id}_prompt_content.json', video_id)
+
+            if manifest.is_done(video_id, KEYFRAMES_DOWNLOAD_STAGE) and \
+                    not manifest.is_done(video_id, KEYFRAMES_INDEX_STAGE):
+                self._run_stage(manifest, video_id, KEYFRAMES_INDEX_STAGE, self.index_image_zip, f'{video_id}.zip',
+                                video_id, working_directory)
+
+        self.save_image_embeddings()
+        print(f'Manifest: {manifest.stats()}')
+        if owns_manifest:
+            manifest.close()
+
+    @staticmethod
+    def _run_stage(manifest: JobManifest, video_id: str, stage: str, do_work, *args):
+        manifest.start(video_id, stage)
+        try:
+            do_work(*args)
+        except Exception as e:
+            print(f'Failed {stage} of video {video_id}: {e}')
+            manifest.failed(video_id, stage, e)
+            return
+        manifest.done(video_id, stage)
+
+    def index_changes(self, change_feed: ChangeFeed, consumer: str = 'search'):
         """
-        Fuse the search results from keyframes and prompt content by counting the number of occurrences and updating the
-         relevance scores.
-        :param search_results_kf:
-        :param search_results_pc:
-        :return: a unified list of search results.
+        Index the PromptContent and the keyframes of the new and changed videos of the change feed that this consumer
+        did not index yet.
+        :return: the number of handled changes
         """
-        # Initialize the fused search results
-        fused_search_results = []
+        with IndexingCompletionTracker(self.video_indexer_wrapper) as completion_tracker:
+            def index_change(event):
+                video_id = event['video_id']
+                if event['op'] != UPSERT:
+                    print(f'Skipping the {event["op"]} of video {video_id}, its documents are left in the indexes')
+                    return
+                prompt_content_response = self.video_indexer_wrapper.get_prompt_content(video_id)
+                if prompt_content_response is not None and prompt_content_response.status_code == 200:
+                    prompt_content = prompt_content_response.json()
+                else:
+                    self.video_indexer_wrapper.create_prompt_content(video_id)
+                    prompt_content = completion_tracker.track_prompt_content(video_id).result()
+                self.upload_prompt_content(prompt_content, video_id)
+                self.index_keyframes(self.video_indexer_wrapper.iter_keyframes(video_id), video_id)
 
-        # Count the number of occurrences of each video in the search results
-        video_occurrences = {}
-        for video in search_results_kf + search_results_pc:
-            video_id = video['video_id']
-            if video_id in video_occurrences:
-                video_occurrences[video_id] += 1
-            else:
-                video_occurrences[video_id] = 1
+            try:
+                n_indexed = change_feed.consume(consumer, index_change)
+            finally:
+                self.save_image_embeddings()
+        print(f'Indexed {n_indexed} changes to Azure AI Search')
+        return n_indexed
 
-        # Update the relevance scores of the search results
-        for video in search_results_kf + search_results_pc:
-            video_id = video['video_id']
-            video['relevance_score'] = video['relevance_score'] * video_occurrences[video_id]
-            fused_search_results.append(video)
-
-        # Sort the fused search results by relevance score
-        fused_search_results = sorted(fused_search_results, key=lambda x: x['relevance_score'], reverse=True)
+    def fuze_index_results(self, results_by_index: dict):
+        """
+        Fuse the raw Azure AI Search results of any number of indexes, e.g. the partial results of a fan-out search.
+        The results are copied so they can be fused again as more indexes answer.
+        :param results_by_index: the search results by index name
+        :return: a unified list of search results.
+        """
+        search_results = [[dict(result, relevance_score=result.get('relevance_score', result.get('@search.score', 0.0)))
+                           for result in results] for results in results_by_index.values()]
+        return self.fuze_search_results(*search_results)
 
-        # return the top k search results
-        return fused_search_results[:self.search_k]
+    def fuze_search_results(self, *search_results_lists):
+        """
+        Fuse the search results from keyframes and prompt content with the indexer's fusion method, merging the
+        duplicates of a video segment and keeping the top k.
+        :param search_results_lists: the search results of each index, e.g. keyframes and prompt content
+        :return: a unified list of search results.
+        """
+        return fuse(search_results_lists, method=self.fusion_method, top_k=self.search_k)
 
 
 def run_azure_search_indexing(config):
     co_embedder = CoEmbeddingsIndexer(config)
-    co_embedder.main_co_embeddings_indexing()
+    try:
+        co_embedder.main_co_embeddings_indexing()
+    finally:
+        co_embedder.close()
     print("done indexing...")
 
 
-def run_query_search(config, search_query):
+def run_query_search(config, search_query, timeout_secs=5.0):
     co_embedder = CoEmbeddingsIndexer(config)
 
-    # query Azure AI Search
-    search_results_kf = co_embedder.azure_ai_search_wrapper.search(search_query, "keyframes")
-    print("Search results key frames", search_results_kf)
-    search_results_pc = co_embedder.azure_ai_search_wrapper.search(search_query, "prompt_content")
-    print("Search results prompt content", search_results_pc)
+    # query Azure AI Search indexes concurrently and fuse their results as they arrive
+    fused_results = []
+    for index_name, results, fused_results in co_embedder.azure_ai_search_wrapper.iter_fan_out_search(
+            search_query, ["keyframes", "prompt_content"], timeout_secs=timeout_secs, fuse=co_embedder.fuze_index_results,
+            top=co_embedder.search_k):
+        print(f"Search results {index_name}", results)
+    print("Fused search results", fused_results)
+    return fused_results
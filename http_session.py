@@ -0,0 +1,91 @@
+"""
+A shared, connection-pooled HTTP transport for the Azure wrappers.
+All requests of a wrapper go through a single requests.Session so TCP/TLS connections are kept alive and reused,
+and every call is timed so the reuse rate can be verified against a mock API server.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpStats:
+    """
+    Thread-safe per-operation call counters and latencies.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = dict()
+
+    def record(self, operation: str, latency_secs: float, status_code):
+        with self._lock:
+            stats = self.operations.setdefault(operation, dict(calls=0, errors=0, total_secs=0.0, max_secs=0.0))
+            stats['calls'] += 1
+            stats['total_secs'] += latency_secs
+            stats['max_secs'] = max(stats['max_secs'], latency_secs)
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = dict()
+            for operation, stats in self.operations.items():
+                snapshot[operation] = dict(stats, avg_secs=stats['total_secs'] / stats['calls'])
+            return snapshot
+
+
+class HttpSession:
+    """
+    Wraps a requests.Session mounted with a pooled adapter for both http and https.
+    """
+    def __init__(self, pool_size: int = 10, connect_timeout_secs: float = 5, read_timeout_secs: float = 60,
+                 keep_alive: bool = True):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout_secs, read_timeout_secs)
+        self.stats = HttpStats()
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def request(self, method: str, url: str, operation: str = None, **kwargs) -> requests.Response:
+        """
+        Send a request through the shared pool and record its latency.
+        :param method: the HTTP method
+        :param url: the request URL
+        :param operation: a name to aggregate the latency under, defaults to the HTTP method
+        :param kwargs: forwarded to requests.Session.request
+        :return: the response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        status_code = None
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            self.stats.record(operation or method, time.perf_counter() - start_time, status_code)
+
+    def connection_stats(self) -> dict:
+        """
+        Aggregate the urllib3 pool counters: every request that did not open a new connection reused one.
+        :return: a dict with the number of requests, opened connections and the reuse rate
+        """
+        num_requests = 0
+        num_connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        reuse_rate = (num_requests - num_connections) / num_requests if num_requests else 0.0
+        return dict(requests=num_requests, connections_opened=num_connections, reuse_rate=reuse_rate)
+
+    def close(self):
+        self.session.close()
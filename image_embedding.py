@@ -0,0 +1,278 @@
+"""
+A batch image embedding stage for keyframes, on CPU.
+Images are decoded and preprocessed on a pool of workers, embedded in batches with one forward pass per batch, and
+cached by content hash so re-indexing a video skips the keyframes that did not change.
+"""
+import hashlib
+import io
+import json
+import os
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from Utils import Semaphore
+
+
+def _tiny_preprocess(image: Image.Image, size: int) -> np.ndarray:
+    return np.asarray(image.resize((size, size), Image.BILINEAR), dtype=np.float32).ravel() / 255.0
+
+
+def _decode(data, preprocess, draft_size=None):
+    """
+    :param data: the encoded image bytes or its path
+    :param draft_size: the smallest size the model needs, JPEGs are decoded straight to a reduced scale above it
+    :return: the preprocessed image
+    """
+    source = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    with Image.open(source) as image:
+        if draft_size is not None:
+            image.draft('RGB', draft_size)
+        return preprocess(image.convert('RGB'))
+
+
+class TinyImageEmbedder:
+    """
+    A deterministic stand-in for CLIP: a fixed random projection of a downscaled RGB thumbnail. It needs no model
+    download, so it serves tests and GPU-less boxes, but its vectors are not comparable to text embeddings.
+    """
+    def __init__(self, dim: int = 128, thumbnail_size: int = 16, seed: int = 0):
+        self.dim = dim
+        self.name = f'tiny-{dim}-{thumbnail_size}-{seed}'
+        self.draft_size = (thumbnail_size, thumbnail_size)
+        self.preprocess = partial(_tiny_preprocess, size=thumbnail_size)
+        rng = np.random.default_rng(seed)
+        n_inputs = thumbnail_size * thumbnail_size * 3
+        self._projection = (rng.standard_normal((n_inputs, dim)) / np.sqrt(n_inputs)).astype(np.float32)
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        """
+        :param batch: a (n, thumbnail_size ** 2 * 3) stack of preprocessed images
+        :return: the (n, dim) L2-normalized embeddings
+        """
+        embeddings = (batch - batch.mean(axis=1, keepdims=True)) @ self._projection
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+
+class ClipImageEmbedder:
+    """
+    OpenAI CLIP on CPU. Needs the torch and clip packages, which are not in requirements.txt.
+    """
+    def __init__(self, model_name: str = 'ViT-B/32', device: str = 'cpu', n_threads: int = None):
+        """
+        :param model_name: the CLIP model to load
+        :param device: 'cpu', or 'cuda' when a GPU is available
+        :param n_threads: the number of intra-op torch threads, torch's default when not given
+        """
+        try:
+            import clip
+            import torch
+        except ImportError as e:
+            raise ImportError(f'CLIP embeddings need torch and clip (pip install torch '
+                              f'git+https://github.com/openai/CLIP.git): {e}')
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        self._torch = torch
+        self.device = device
+        self.model, clip_preprocess = clip.load(model_name, device=device)
+        self.model.eval()
+        self.dim = self.model.visual.output_dim
+        self.name = f'clip-{model_name.replace("/", "-")}'
+        self.draft_size = (self.model.visual.input_resolution, self.model.visual.input_resolution)
+        self.preprocess = partial(_clip_preprocess, clip_preprocess=clip_preprocess)
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        with self._torch.no_grad():
+            features = self.model.encode_image(self._torch.from_numpy(batch).to(self.device))
+            features = features / features.norm(dim=-1, keepdim=True)
+        return features.float().cpu().numpy()
+
+
+def _clip_preprocess(image: Image.Image, clip_preprocess) -> np.ndarray:
+    return clip_preprocess(image).numpy()
+
+
+def create_image_embedder(model: str = 'clip', **kwargs):
+    """
+    :param model: 'clip' or 'tiny'
+    """
+    if model == 'clip':
+        return ClipImageEmbedder(**kwargs)
+    if model == 'tiny':
+        return TinyImageEmbedder(**kwargs)
+    raise ValueError(f'Unknown image embedding model: {model}')
+
+
+class EmbeddingCache:
+    """
+    Embeddings by the sha256 of the image bytes, of a single embedder, kept in one float32 block. Persisted when given
+    a path as a JSON header line followed by fixed-size (hash, embedding) records: saving appends only the embeddings
+    added since the last save, so the cost of a save does not grow with the size of the cache.
+    """
+    def __init__(self, embedder_name: str, cache_path: str = None):
+        self.embedder_name = embedder_name
+        self.cache_path = cache_path
+        self._rows = dict()
+        self._hashes = []
+        self._embeddings = None
+        self._n_saved = 0
+        # whether the file holds this embedder's records, so new ones can be appended to it
+        self._can_append = False
+        if cache_path is not None and os.path.isfile(cache_path):
+            self.load()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @property
+    def n_unsaved(self) -> int:
+        return len(self._hashes) - self._n_saved
+
+    @staticmethod
+    def _record_dtype(dim: int) -> np.dtype:
+        # a hex sha256 is 64 characters
+        return np.dtype([('hash', 'S64'), ('embedding', '<f4', (dim,))])
+
+    def get(self, content_hash: str):
+        row = self._rows.get(content_hash)
+        return None if row is None else self._embeddings[row].copy()
+
+    def put(self, content_hash: str, embedding: np.ndarray):
+        if content_hash in self._rows:
+            # the same content always has the same embedding
+            return
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        n_rows = len(self._hashes)
+        if self._embeddings is None:
+            self._embeddings = np.empty((1024, len(embedding)), dtype=np.float32)
+        elif n_rows == len(self._embeddings):
+            embeddings = np.empty((2 * n_rows, self._embeddings.shape[1]), dtype=np.float32)
+            embeddings[:n_rows] = self._embeddings
+            self._embeddings = embeddings
+        self._embeddings[n_rows] = embedding
+        self._rows[content_hash] = n_rows
+        self._hashes.append(content_hash)
+
+    def load(self):
+        with open(self.cache_path, 'rb') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = dict()
+            if header.get('embedder_name') != self.embedder_name:
+                print(f'Ignoring the embedding cache {self.cache_path} of {header.get("embedder_name")}')
+                return
+            header_size = f.tell()
+            data = f.read()
+        record_dtype = self._record_dtype(header['dim'])
+        n_records = len(data) // record_dtype.itemsize
+        if len(data) % record_dtype.itemsize:
+            # drop the record being appended when the previous run stopped
+            os.truncate(self.cache_path, header_size + n_records * record_dtype.itemsize)
+        records = np.frombuffer(data, dtype=record_dtype, count=n_records)
+        self._hashes = [content_hash.decode() for content_hash in records['hash'].tolist()]
+        self._rows = {content_hash: row for row, content_hash in enumerate(self._hashes)}
+        self._embeddings = np.array(records['embedding']) if n_records else None
+        self._n_saved = len(self._hashes)
+        self._can_append = True
+
+    def save(self):
+        """
+        Append the embeddings added since the last save to the file.
+        """
+        if self.cache_path is None or self.n_unsaved == 0:
+            return
+        dim = self._embeddings.shape[1]
+        records = np.empty(self.n_unsaved, dtype=self._record_dtype(dim))
+        records['hash'] = [content_hash.encode() for content_hash in self._hashes[self._n_saved:]]
+        records['embedding'] = self._embeddings[self._n_saved:len(self._hashes)]
+        with open(self.cache_path, 'ab' if self._can_append else 'wb') as f:
+            if not self._can_append:
+                f.write((json.dumps(dict(embedder_name=self.embedder_name, dim=dim)) + '\n').encode())
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._can_append = True
+        self._n_saved = len(self._hashes)
+
+
+class ImageEmbeddingStage:
+    """
+    Embeds a stream of images in batches: the cache hits are returned as is, the misses are decoded on a pool of
+    workers and embedded with one forward pass per batch.
+    """
+    def __init__(self, embedder=None, batch_size: int = 32, n_decode_workers: int = 4, decode_kind: str = 'thread',
+                 cache_path: str = None, save_every: int = 1024):
+        """
+        :param embedder: a TinyImageEmbedder, a ClipImageEmbedder or any object with name, dim, draft_size, preprocess
+            and forward
+        :param batch_size: the number of images per forward pass
+        :param n_decode_workers: the number of image decoding workers
+        :param decode_kind: 'thread', or 'process' when the decoding starves the forward pass
+        :param cache_path: a file the embeddings are cached in, in memory only when not given
+        :param save_every: the number of new embeddings between two saves of the cache, which is also saved on close()
+        """
+        self.embedder = embedder if embedder is not None else TinyImageEmbedder()
+        self.batch_size = batch_size
+        self.cache = EmbeddingCache(self.embedder.name, cache_path)
+        self.save_every = save_every
+        self._decoders = Semaphore(n_decode_workers, kind=decode_kind)
+        self.n_embedded = 0
+        self.n_cached = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def embed(self, images):
+        """
+        :param images: (name, data) pairs, where data is the encoded image bytes or its path
+        :return: a generator of (name, embedding) pairs in the order of the images
+        """
+        batch = []
+        for name, data in images:
+            if not isinstance(data, (bytes, bytearray, memoryview)):
+                with open(data, 'rb') as f:
+                    data = f.read()
+            batch.append((name, data))
+            if len(batch) == self.batch_size:
+                yield from self._embed_batch(batch)
+                batch = []
+        if batch:
+            yield from self._embed_batch(batch)
+
+    def embed_files(self, image_paths):
+        """
+        :return: the (n, dim) embeddings of the image files
+        """
+        embeddings = [embedding for _, embedding in self.embed((path, path) for path in image_paths)]
+        return np.stack(embeddings) if embeddings else np.empty((0, self.embedder.dim), dtype=np.float32)
+
+    def _embed_batch(self, batch: list):
+        hashes = [hashlib.sha256(data).hexdigest() for _, data in batch]
+        embeddings = [self.cache.get(content_hash) for content_hash in hashes]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        self.n_cached += len(batch) - len(misses)
+        if misses:
+            preprocessed = self._decoders.imap((dict(data=batch[i][1], preprocess=self.embedder.preprocess,
+                                                     draft_size=self.embedder.draft_size) for i in misses), _decode)
+            new_embeddings = self.embedder.forward(np.stack(list(preprocessed)))
+            for i, embedding in zip(misses, new_embeddings):
+                embeddings[i] = embedding
+                self.cache.put(hashes[i], embedding)
+            self.n_embedded += len(misses)
+            if self.cache.n_unsaved >= self.save_every:
+                self.cache.save()
+        return [(name, embedding) for (name, _), embedding in zip(batch, embeddings)]
+
+    def stats(self) -> dict:
+        return dict(embedded=self.n_embedded, cached=self.n_cached, cache_size=len(self.cache))
+
+    def close(self):
+        self.cache.save()
+        self._decoders.close()
@@ -0,0 +1,296 @@
+"""
+Incremental sync of a Video Indexer account: only the videos that are new or changed since the last sync have their
+index fetched, and every change is appended to a change feed that the ADX and Azure AI Search uploaders consume.
+The account listing is newest first, so paging stops at the first page of videos created before the watermark that
+are all unchanged. A periodic full scan also catches the re-indexed old videos and the deleted ones.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+# the states a video can stay in, the videos still uploading or processing are listed again on the next sync
+FINAL_STATES = {'Processed', 'Failed', 'Quarantined'}
+
+
+def parse_timestamp(timestamp: str):
+    """
+    :param timestamp: an ISO 8601 timestamp as returned by Video Indexer, e.g. '2024-01-31T10:20:30.1234567+00:00'
+    :return: the aware datetime, None when missing or unreadable
+    """
+    if not timestamp:
+        return None
+    # .NET writes up to 7 fractional digits and a Z suffix, which older fromisoformat() versions reject
+    timestamp = re.sub(r'(\.\d{6})\d+', r'\1', timestamp.replace('Z', '+00:00'))
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+class ChangeFeed:
+    """
+    An append-only JSON lines file of video changes. Every consumer reads it from its own committed byte offset, so
+    the ADX and the search uploaders progress independently and resume where they stopped. Delivery is at least
+    once: a consumer that crashes before committing sees the same changes again.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets_path = f'{path}.offsets'
+        self._lock = threading.Lock()
+
+    def append(self, events):
+        if not events:
+            return
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_offsets(self) -> dict:
+        if not os.path.isfile(self.offsets_path):
+            return dict()
+        with open(self.offsets_path) as f:
+            return json.load(f)
+
+    def offset(self, consumer: str) -> int:
+        return self._read_offsets().get(consumer, 0)
+
+    def commit(self, consumer: str, offset: int):
+        with self._lock:
+            offsets = self._read_offsets()
+            offsets[consumer] = offset
+            temp_path = f'{self.offsets_path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(offsets, f)
+            os.replace(temp_path, self.offsets_path)
+
+    def read(self, consumer: str):
+        """
+        :return: a generator of (offset after the event, event) from the consumer's committed offset
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset(consumer))
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # an event still being appended
+                    return
+                yield f.tell(), json.loads(line)
+
+    def consume(self, consumer: str, handle, commit_every: int = 100) -> int:
+        """
+        Handle the consumer's pending events in order, committing its offset as it goes. The first event that fails
+        stops the consumption, so it is handled again on the next call.
+        :param handle: called with every event dict
+        :return: the number of handled events
+        """
+        n_handled = 0
+        committed_offset = offset = self.offset(consumer)
+        try:
+            for offset_after, event in self.read(consumer):
+                try:
+                    handle(event)
+                except Exception as e:
+                    print(f'Consumer {consumer} failed on {event}, will retry from it: {e}')
+                    break
+                offset = offset_after
+                n_handled += 1
+                if n_handled % commit_every == 0:
+                    self.commit(consumer, offset)
+                    committed_offset = offset
+        finally:
+            if offset != committed_offset:
+                self.commit(consumer, offset)
+        return n_handled
+
+
+class IncrementalSync:
+    def __init__(self, vi_wrapper, insights_repo_path: str, change_feed: ChangeFeed = None, state_path: str = None,
+                 max_in_flight: int = 16, overlap_secs: float = 24 * 3600, full_scan_every_secs: float = 7 * 24 * 3600,
+                 flush_every: int = 100):
+        """
+        :param vi_wrapper: the VideoIndexerWrapper of the account
+        :param insights_repo_path: where the {video_id}.json indexes are written
+        :param change_feed: the feed the changes are appended to, by default changes.jsonl in insights_repo_path
+        :param state_path: the sync state file, by default .vi_sync_state in insights_repo_path. The videos synced
+            since its last snapshot are appended to the state_path.log file.
+        :param max_in_flight: the maximal number of concurrent index requests
+        :param overlap_secs: how long before the watermark the videos are still checked, as the listing order of
+            videos created at about the same time is not guaranteed
+        :param full_scan_every_secs: list the whole account when the last full scan is older than this, None to only
+            scan the whole account when asked to
+        :param flush_every: the number of fetched indexes between two checkpoints of the feed and the state
+        """
+        self.vi_wrapper = vi_wrapper
+        self.insights_repo_path = insights_repo_path
+        os.makedirs(insights_repo_path, exist_ok=True)
+        self.change_feed = change_feed if change_feed is not None else \
+            ChangeFeed(os.path.join(insights_repo_path, 'changes.jsonl'))
+        self.state_path = state_path if state_path is not None else os.path.join(insights_repo_path, '.vi_sync_state')
+        self.max_in_flight = max_in_flight
+        self.overlap_secs = overlap_secs
+        self.full_scan_every_secs = full_scan_every_secs
+        self.flush_every = flush_every
+        self.log_path = f'{self.state_path}.log'
+        self._unlogged = []
+        self.state = self._load_state()
+
+    def _load_state(self) -> dict:
+        self.state = dict(watermark=None, last_full_scan=0, videos=dict())
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                self.state.update(json.load(f))
+        # replay the videos synced by an interrupted sync since the last snapshot
+        if os.path.isfile(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # the entry being written when the sync stopped
+                        break
+                    video_id, last_modified, created = json.loads(line)
+                    self._apply_synced(video_id, last_modified, created)
+        return self.state
+
+    def _save_state(self):
+        """
+        Write the whole state and drop the log it includes. A crash between the two replays the log over the new
+        snapshot, which only brings back the videos deleted by this sync until the next full scan.
+        """
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+        self._unlogged = []
+        if os.path.isfile(self.log_path):
+            os.remove(self.log_path)
+
+    def _checkpoint(self):
+        """
+        Append the videos synced since the last checkpoint to the log, so the cost of a checkpoint does not grow with
+        the number of synced videos.
+        """
+        if not self._unlogged:
+            return
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in self._unlogged))
+            f.flush()
+            os.fsync(f.fileno())
+        self._unlogged = []
+
+    def _is_unchanged(self, video: dict) -> bool:
+        return self.state['videos'].get(video['id']) == video.get('lastModified')
+
+    def list_changes(self, full: bool = False):
+        """
+        :param full: list the whole account instead of stopping at the already synced videos
+        :return: the new or changed videos, the ids of the deleted videos (on a complete full scan only), and the
+            number of listed pages
+        """
+        watermark = parse_timestamp(self.state['watermark'])
+        stop_before = watermark - timedelta(seconds=self.overlap_secs) if watermark is not None else None
+        changed_videos, listed_ids = [], set()
+        n_pages, is_complete = 0, False
+        skip = 0
+        while True:
+            page = self.vi_wrapper.list_videos_single_page(skip)
+            n_pages += 1
+            if not isinstance(page, dict) or 'results' not in page:
+                print(f'Failed to list the videos after {skip}, stopping the listing')
+                break
+            videos = page['results']
+            for video in videos:
+                listed_ids.add(video['id'])
+                if not self._is_unchanged(video):
+                    changed_videos.append(video)
+            skip += len(videos)
+            if not videos or page.get('nextPage', {}).get('done', True):
+                is_complete = True
+                break
+            if not full and stop_before is not None and all(
+                    self._is_unchanged(video) and (parse_timestamp(video.get('created')) or watermark) < stop_before
+                    for video in videos):
+                break
+
+        deleted_ids = []
+        if full and is_complete:
+            deleted_ids = [video_id for video_id in self.state['videos'] if video_id not in listed_ids]
+        return changed_videos, deleted_ids, n_pages
+
+    def sync(self, full: bool = None) -> dict:
+        """
+        Fetch the indexes of the new and changed videos into insights_repo_path and append their changes to the feed.
+        :param full: scan the whole account, by default when the last full scan is older than full_scan_every_secs
+        :return: the sync stats
+        """
+        if full is None:
+            full = self.full_scan_every_secs is not None and \
+                time.time() - self.state['last_full_scan'] > self.full_scan_every_secs
+        start_time = time.perf_counter()
+        changed_videos, deleted_ids, n_pages = self.list_changes(full)
+
+        # the videos that failed or are still processing are not fetched, the ones in a final state are synced
+        to_fetch = [video for video in changed_videos if video.get('state') == 'Processed']
+        for video in changed_videos:
+            if video.get('state') in FINAL_STATES and video.get('state') != 'Processed':
+                self._mark_synced(video)
+
+        n_fetched, n_failed = asyncio.run(self._fetch_indexes(to_fetch))
+
+        events = [dict(op=DELETE, video_id=video_id, synced_at=time.time()) for video_id in deleted_ids]
+        for video_id in deleted_ids:
+            del self.state['videos'][video_id]
+        self.change_feed.append(events)
+        if full:
+            self.state['last_full_scan'] = time.time()
+        self._save_state()
+        stats = dict(full=full, pages=n_pages, changed=len(changed_videos), fetched=n_fetched, failed=n_failed,
+                     deleted=len(deleted_ids), watermark=self.state['watermark'],
+                     elapsed_secs=time.perf_counter() - start_time)
+        print(f'Synced {n_fetched} new or changed videos from {n_pages} pages ({n_failed} failed, '
+              f'{len(deleted_ids)} deleted) in {stats["elapsed_secs"]:.1f}s')
+        return stats
+
+    def _mark_synced(self, video: dict):
+        self._apply_synced(video['id'], video.get('lastModified'), video.get('created'))
+        self._unlogged.append([video['id'], video.get('lastModified'), video.get('created')])
+
+    def _apply_synced(self, video_id: str, last_modified: str, created: str):
+        self.state['videos'][video_id] = last_modified
+        created_at = parse_timestamp(created)
+        if created_at is not None and (self.state['watermark'] is None or
+                                       created_at > parse_timestamp(self.state['watermark'])):
+            self.state['watermark'] = created
+
+    async def _fetch_indexes(self, videos):
+        n_fetched, n_failed = 0, 0
+        events = []
+        async for video, video_index in self.vi_wrapper.iter_video_indexes_async(self.max_in_flight, videos=videos):
+            if video_index is None:
+                # not marked as synced, so fetched again on the next sync
+                n_failed += 1
+                continue
+            index_path = os.path.join(self.insights_repo_path, f'{video["id"]}.json')
+            temp_path = f'{index_path}.part'
+            with open(temp_path, 'w') as f:
+                json.dump(video_index, f)
+            os.replace(temp_path, index_path)
+            events.append(dict(op=UPSERT, video_id=video['id'], last_modified=video.get('lastModified'),
+                               index_path=index_path, synced_at=time.time()))
+            self._mark_synced(video)
+            n_fetched += 1
+            # the feed is written before the state, so a crash repeats changes rather than losing them
+            if len(events) >= self.flush_every:
+                self.change_feed.append(events)
+                self._checkpoint()
+                events = []
+        self.change_feed.append(events)
+        return n_fetched, n_failed
@@ -0,0 +1,261 @@
+"""
+Tracks many in-flight Video Indexer jobs from a single scheduler thread instead of one sleeping polling loop each.
+Indexing states are polled in batches, one Videos/Search request per batch of videos, and PromptContent per video.
+A video that is still processing is polled less and less often, and a Video Indexer callback received by the optional
+local HTTP listener completes it at once.
+"""
+import heapq
+import random
+import socket
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+INDEXING = 'indexing'
+PROMPT_CONTENT = 'prompt_content'
+
+DONE_STATES = {'Processed'}
+FAILED_STATES = {'Failed', 'Quarantined'}
+
+# PromptContent responses while it is still being generated, or when the request may succeed later
+PROMPT_CONTENT_RETRY_STATUS_CODES = {202, 404, 408, 429, 500, 502, 503, 504}
+
+
+class IndexingFailedError(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, kind: str, video_id: str, poll_secs: float):
+        self.kind = kind
+        self.video_id = video_id
+        self.future = Future()
+        self.poll_secs = poll_secs
+        self.last_progress = None
+        self.n_polls = 0
+        self.started_at = time.monotonic()
+
+
+class IndexingCompletionTracker:
+    """
+    Hands out futures that resolve when a video's indexing or its PromptContent generation finished.
+    """
+    def __init__(self, vi_wrapper, min_poll_secs: float = 5, max_poll_secs: float = 120, backoff_factor: float = 1.5,
+                 batch_size: int = 50, listener_port: int = None, listener_host: str = '127.0.0.1',
+                 public_callback_url: str = None, prompt_content_timeout_secs: float = 3600):
+        """
+        :param vi_wrapper: the VideoIndexerWrapper to poll through
+        :param min_poll_secs: the first poll delay, and the delay once a job made progress
+        :param max_poll_secs: the longest delay between two polls of a job
+        :param backoff_factor: how much the delay grows while a job made no progress
+        :param batch_size: the number of videos whose indexing state is polled with one request
+        :param listener_port: start a local HTTP listener for the Video Indexer callbacks on this port, 0 for any port
+        :param listener_host: the interface the listener binds to, the loopback one by default, reachable through a tunnel.
+            '0.0.0.0' accepts the callbacks from any host.
+        :param public_callback_url: the URL Video Indexer reaches the listener at, e.g. behind a tunnel. Defaults to
+            the listener's local address.
+        :param prompt_content_timeout_secs: how long a PromptContent is polled for before its future fails with a
+            TimeoutError, None to poll until it is generated
+        """
+        self.vi_wrapper = vi_wrapper
+        self.min_poll_secs = min_poll_secs
+        self.max_poll_secs = max_poll_secs
+        self.backoff_factor = backoff_factor
+        self.batch_size = batch_size
+        self.prompt_content_timeout_secs = prompt_content_timeout_secs
+        self.n_requests = 0
+        self.n_callbacks = 0
+        self._jobs = dict()
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='indexing-tracker', daemon=True)
+        self._thread.start()
+
+        self.callback_url = None
+        self._listener = None
+        if listener_port is not None:
+            self._listener = self._start_listener(listener_host, listener_port)
+            callback_host = socket.gethostname() if listener_host in ('', '0.0.0.0') else listener_host
+            self.callback_url = public_callback_url or \
+                f'http://{callback_host}:{self._listener.server_address[1]}/callback'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def track_indexing(self, video_id: str) -> Future:
+        """
+        :return: a future of the video's search result, with its state, once indexed. It raises IndexingFailedError
+            when the indexing failed.
+        """
+        return self._track(INDEXING, video_id)
+
+    def track_prompt_content(self, video_id: str) -> Future:
+        """
+        :return: a future of the video's PromptContent dict, once generated. It raises IndexingFailedError when the
+            request fails for good, and TimeoutError after prompt_content_timeout_secs.
+        """
+        return self._track(PROMPT_CONTENT, video_id)
+
+    def _track(self, kind: str, video_id: str) -> Future:
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('The tracker is closed')
+            job = self._jobs.get((kind, video_id))
+            if job is None:
+                job = _Job(kind, video_id, self.min_poll_secs)
+                self._jobs[(kind, video_id)] = job
+                # the first poll is immediate, the job might have finished already
+                heapq.heappush(self._schedule, (time.monotonic(), kind, video_id))
+                self._condition.notify()
+            return job.future
+
+    def n_pending(self) -> int:
+        with self._condition:
+            return len(self._jobs)
+
+    def notify(self, video_id: str, state: str):
+        """
+        Complete the indexing of a video from a Video Indexer callback.
+        """
+        with self._condition:
+            self.n_callbacks += 1
+            job = self._jobs.get((INDEXING, video_id))
+        if job is not None:
+            self._on_indexing_state(job, dict(id=video_id, state=state))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._schedule or self._schedule[0][0] > time.monotonic()):
+                    self._condition.wait(timeout=self._schedule[0][0] - time.monotonic() if self._schedule else None)
+                if self._stopped:
+                    return
+                # the jobs due soon are polled now too, so they share the batched requests
+                horizon = time.monotonic() + self.min_poll_secs / 2
+                due = []
+                while self._schedule and self._schedule[0][0] <= horizon:
+                    _, kind, video_id = heapq.heappop(self._schedule)
+                    job = self._jobs.get((kind, video_id))
+                    if job is not None:
+                        due.append(job)
+            try:
+                self._poll(due)
+            except Exception as e:
+                print(f'Failed to poll {len(due)} jobs: {e}')
+            with self._condition:
+                for job in due:
+                    if not job.future.done():
+                        job.n_polls += 1
+                        heapq.heappush(self._schedule, (time.monotonic() + self._next_delay(job), job.kind,
+                                                        job.video_id))
+
+    def _poll(self, jobs):
+        indexing_jobs = [job for job in jobs if job.kind == INDEXING]
+        for start in range(0, len(indexing_jobs), self.batch_size):
+            batch = indexing_jobs[start:start + self.batch_size]
+            self.n_requests += 1
+            videos_state = self.vi_wrapper.get_videos_state([job.video_id for job in batch])
+            if videos_state is None:
+                continue
+            for job in batch:
+                video = videos_state.get(job.video_id)
+                if video is not None:
+                    self._on_indexing_state(job, video)
+
+        for job in jobs:
+            if job.kind != PROMPT_CONTENT:
+                continue
+            self.n_requests += 1
+            response = self.vi_wrapper.get_prompt_content(job.video_id)
+            if response is not None and response.status_code == 200:
+                self._complete(job, result=response.json())
+            elif response is not None and response.status_code not in PROMPT_CONTENT_RETRY_STATUS_CODES:
+                self._complete(job, error=IndexingFailedError(
+                    f'Getting the prompt content of video {job.video_id} failed with status {response.status_code}'))
+            elif self.prompt_content_timeout_secs is not None and \
+                    time.monotonic() - job.started_at > self.prompt_content_timeout_secs:
+                self._complete(job, error=TimeoutError(
+                    f'The prompt content of video {job.video_id} was not generated after {job.n_polls + 1} polls'))
+
+    def _on_indexing_state(self, job: _Job, video: dict):
+        state = video.get('state')
+        if state in DONE_STATES:
+            self._complete(job, result=video)
+        elif state in FAILED_STATES:
+            self._complete(job, error=IndexingFailedError(f'Indexing video {job.video_id} ended in state {state}'))
+        elif video.get('processingProgress') != job.last_progress:
+            # progress resets the backoff
+            job.last_progress = video.get('processingProgress')
+            job.poll_secs = self.min_poll_secs
+
+    def _complete(self, job: _Job, result=None, error: Exception = None):
+        with self._condition:
+            if self._jobs.get((job.kind, job.video_id)) is job:
+                del self._jobs[(job.kind, job.video_id)]
+        try:
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        except InvalidStateError:
+            # completed by both a callback and a poll, or cancelled by close()
+            pass
+
+    def _next_delay(self, job: _Job) -> float:
+        delay = job.poll_secs
+        job.poll_secs = min(self.max_poll_secs, job.poll_secs * self.backoff_factor)
+        # jitter so the jobs tracked together do not stay in lockstep
+        return delay * random.uniform(0.9, 1.1)
+
+    def _start_listener(self, host: str, port: int):
+        tracker = self
+
+        class CallbackHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                query = parse_qs(urlparse(self.path).query)
+                video_id = query.get('id', [None])[0]
+                state = query.get('state', [None])[0]
+                if video_id is None or state is None:
+                    self.send_response(400)
+                else:
+                    tracker.notify(video_id, state)
+                    self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = _handle
+            do_POST = _handle
+
+        listener = ThreadingHTTPServer((host, port), CallbackHandler)
+        listener.daemon_threads = True
+        threading.Thread(target=listener.serve_forever, name='indexing-callbacks', daemon=True).start()
+        return listener
+
+    def stats(self) -> dict:
+        with self._condition:
+            return dict(pending=len(self._jobs), requests=self.n_requests, callbacks=self.n_callbacks)
+
+    def close(self):
+        """
+        Stop polling and cancel the pending futures.
+        """
+        with self._condition:
+            self._stopped = True
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+            self._condition.notify()
+        for job in jobs:
+            job.future.cancel()
+        if self._listener is not None:
+            self._listener.shutdown()
+            self._listener.server_close()
+        self._thread.join()
@@ -0,0 +1,124 @@
+"""
+A durable checkpoint of bulk jobs, e.g. crawling the face impressions or indexing the keyframes of a whole account.
+Every (item, stage) pair, e.g. a video id and 'keyframes_download', has a status in a SQLite database. The done pairs
+are loaded into memory once, so a restarted job skips the completed work with a set lookup instead of checking files
+on disk. Items a crashed run left in progress are not done, so they are simply processed again.
+The database is in WAL mode, so the face impression crawler, the co-embeddings indexer and the dashboard uploader can
+share one manifest file, even from separate processes.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+
+MANIFEST_FILE_NAME = 'job_manifest.sqlite'
+
+
+class JobManifest:
+    def __init__(self, path: str):
+        """
+        :param path: the SQLite database file, created when missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # a commit is durable against a crash of the process, only a power loss can lose the last ones
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS items (item_id TEXT NOT NULL, stage TEXT NOT NULL, '
+                                 'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, detail TEXT, '
+                                 'updated_at REAL NOT NULL, PRIMARY KEY (item_id, stage)) WITHOUT ROWID')
+        self._connection.commit()
+        self._done = set(self._connection.execute('SELECT item_id, stage FROM items WHERE status = ?', (DONE,)))
+        self.n_resumed = self._connection.execute('SELECT COUNT(*) FROM items WHERE status = ?',
+                                                  (IN_PROGRESS,)).fetchone()[0]
+        if self.n_resumed:
+            print(f'Resuming {self.n_resumed} items left in progress in {path}')
+
+    @classmethod
+    def in_directory(cls, working_dir: str) -> 'JobManifest':
+        """
+        :return: the manifest shared by the jobs writing to working_dir
+        """
+        os.makedirs(working_dir, exist_ok=True)
+        return cls(os.path.join(working_dir, MANIFEST_FILE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_done(self, item_id: str, stage: str) -> bool:
+        return (item_id, stage) in self._done
+
+    def start(self, item_id: str, stage: str):
+        self._set(item_id, stage, IN_PROGRESS, None, attempt=True)
+
+    def done(self, item_id: str, stage: str, detail=None):
+        """
+        :param detail: a JSON-serializable result of the stage, e.g. what a later stage resumes from
+        """
+        self._set(item_id, stage, DONE, detail)
+
+    def failed(self, item_id: str, stage: str, error=None):
+        self._set(item_id, stage, FAILED, None if error is None else str(error))
+
+    def _set(self, item_id: str, stage: str, status: str, detail, attempt: bool = False):
+        detail = None if detail is None else json.dumps(detail)
+        with self._lock:
+            self._connection.execute(
+                'INSERT INTO items (item_id, stage, status, attempts, detail, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (item_id, stage) DO UPDATE SET status = excluded.status, '
+                'attempts = attempts + excluded.attempts, detail = COALESCE(excluded.detail, detail), '
+                'updated_at = excluded.updated_at',
+                (item_id, stage, status, int(attempt), detail, time.time()))
+            self._connection.commit()
+            if status == DONE:
+                self._done.add((item_id, stage))
+            else:
+                self._done.discard((item_id, stage))
+
+    def detail(self, item_id: str, stage: str):
+        """
+        :return: the detail recorded with the item's stage, None when there is none
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT detail FROM items WHERE item_id = ? AND stage = ?',
+                                           (item_id, stage)).fetchone()
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def status(self, item_id: str, stage: str) -> str:
+        with self._lock:
+            row = self._connection.execute('SELECT status FROM items WHERE item_id = ? AND stage = ?',
+                                           (item_id, stage)).fetchone()
+        return PENDING if row is None else row[0]
+
+    def items(self, stage: str, status: str = DONE):
+        """
+        :return: the ids of the items whose stage has the given status
+        """
+        with self._lock:
+            return [item_id for item_id, in self._connection.execute(
+                'SELECT item_id FROM items WHERE stage = ? AND status = ?', (stage, status))]
+
+    def stats(self) -> dict:
+        """
+        :return: the number of items by stage and status
+        """
+        stats = dict()
+        with self._lock:
+            for stage, status, count in self._connection.execute(
+                    'SELECT stage, status, COUNT(*) FROM items GROUP BY stage, status'):
+                stats.setdefault(stage, dict())[status] = count
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
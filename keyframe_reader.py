@@ -0,0 +1,184 @@
+"""
+Streams the keyframes out of a Video Indexer KeyframesThumbnails zip one member at a time, without extracting it.
+Seekable sources, e.g. a downloaded zip, are read through their central directory. Non-seekable ones, e.g. an HTTP
+response body, are parsed sequentially from their local file headers, so the first keyframe is available as soon as
+its bytes arrived.
+"""
+import struct
+import zipfile
+import zlib
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+LOCAL_FILE_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP64_EXTRA_ID = 0x0001
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+READ_SIZE = 64 * 1024
+
+
+def _is_wanted(name: str, suffixes) -> bool:
+    return not name.endswith('/') and (suffixes is None or name.lower().endswith(suffixes))
+
+
+def iter_zip_members(source, suffixes=IMAGE_SUFFIXES):
+    """
+    :param source: a zip file path, or a binary file-like object
+    :param suffixes: the member name suffixes to yield, all the files when None
+    :return: a generator of (member name, member bytes)
+    """
+    if isinstance(source, str) or (hasattr(source, 'seekable') and source.seekable()):
+        yield from _iter_seekable(source, suffixes)
+    else:
+        yield from _iter_stream(source, suffixes)
+
+
+def _iter_seekable(source, suffixes):
+    with zipfile.ZipFile(source, 'r') as zip_file:
+        for info in zip_file.infolist():
+            if _is_wanted(info.filename, suffixes):
+                yield info.filename, zip_file.read(info)
+
+
+class _StreamReader:
+    """
+    Reads exact byte counts from a stream, with a pushback buffer for the bytes read past a compressed member.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = b''
+
+    def read(self, size: int) -> bytes:
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def read_some(self) -> bytes:
+        if self.pending:
+            data, self.pending = self.pending, b''
+            return data
+        return self.stream.read(READ_SIZE)
+
+    def unread(self, data: bytes):
+        self.pending = data + self.pending
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, uncompressed_size: int):
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            values = extra[offset + 4:offset + 4 + size]
+            # the zip64 field only holds the sizes that overflowed, uncompressed first
+            if uncompressed_size == 0xFFFFFFFF and len(values) >= 8:
+                uncompressed_size, = struct.unpack_from('<Q', values, 0)
+                values = values[8:]
+            if compressed_size == 0xFFFFFFFF and len(values) >= 8:
+                compressed_size, = struct.unpack_from('<Q', values, 0)
+            break
+        offset += 4 + size
+    return compressed_size, uncompressed_size
+
+
+def _inflate(reader: _StreamReader) -> bytes:
+    """
+    Inflate a deflated member of unknown size, pushing back the bytes read past its end.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    parts = []
+    while not decompressor.eof:
+        chunk = reader.read_some()
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated deflate stream')
+        parts.append(decompressor.decompress(chunk))
+    reader.unread(decompressor.unused_data)
+    return b''.join(parts)
+
+
+def _read_stored_until_descriptor(reader: _StreamReader, zip64: bool):
+    """
+    Read a stored member of unknown size, up to the signed data descriptor whose size and CRC-32 match the bytes
+    read so far.
+    :return: the member's bytes and CRC-32
+    """
+    descriptor = struct.Struct('<4sIQQ' if zip64 else '<4sIII')
+    data = bytearray()
+    search_from = 0
+    while True:
+        position = data.find(DATA_DESCRIPTOR_SIGNATURE, search_from)
+        if position < 0 or len(data) - position < descriptor.size:
+            chunk = reader.read_some()
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated stored zip member')
+            search_from = max(0, position if position >= 0 else len(data) - 3)
+            data += chunk
+            continue
+        _, crc, compressed_size, _ = descriptor.unpack_from(data, position)
+        if compressed_size == position and zlib.crc32(data[:position]) == crc:
+            reader.unread(bytes(data[position + descriptor.size:]))
+            return bytes(data[:position]), crc
+        search_from = position + 1
+
+
+def _has_zip64_extra(extra: bytes) -> bool:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            return True
+        offset += 4 + size
+    return False
+
+
+def _read_data_descriptor(reader: _StreamReader, zip64: bool) -> int:
+    """
+    :return: the member's CRC-32 from the data descriptor following its data
+    """
+    signature = reader.read(4)
+    if signature != DATA_DESCRIPTOR_SIGNATURE:
+        # the descriptor signature is optional
+        reader.unread(signature)
+    descriptor = reader.read(20 if zip64 else 12)
+    crc, = struct.unpack_from('<I', descriptor, 0)
+    return crc
+
+
+def _iter_stream(stream, suffixes):
+    reader = _StreamReader(stream)
+    while True:
+        header = reader.read(LOCAL_FILE_HEADER.size)
+        if len(header) < LOCAL_FILE_HEADER.size or header[:4] != LOCAL_FILE_HEADER_SIGNATURE:
+            # the central directory, or the end of the stream
+            return
+        (_, _, flags, method, _, _, crc, compressed_size, uncompressed_size, name_length,
+         extra_length) = LOCAL_FILE_HEADER.unpack(header)
+        name = reader.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read(extra_length)
+        if compressed_size == 0xFFFFFFFF or uncompressed_size == 0xFFFFFFFF:
+            compressed_size, uncompressed_size = _zip64_sizes(extra, compressed_size, uncompressed_size)
+        if flags & FLAG_ENCRYPTED:
+            raise zipfile.BadZipFile(f'Encrypted zip member: {name}')
+        has_data_descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+
+        if method == zipfile.ZIP_DEFLATED and has_data_descriptor:
+            data = _inflate(reader)
+            crc = _read_data_descriptor(reader, _has_zip64_extra(extra))
+        elif method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(reader.read(compressed_size), -zlib.MAX_WBITS)
+        elif method == zipfile.ZIP_STORED and has_data_descriptor:
+            data, crc = _read_stored_until_descriptor(reader, _has_zip64_extra(extra))
+        elif method == zipfile.ZIP_STORED:
+            data = reader.read(compressed_size)
+        else:
+            raise zipfile.BadZipFile(f'Cannot stream zip member {name} with compression method {method}')
+        if zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile(f'Bad CRC-32 for zip member {name}')
+        if _is_wanted(name, suffixes):
+            yield name, data
@@ -0,0 +1,143 @@
+"""
+A streaming multipart/form-data request body. The file is read chunk by chunk while the request is sent, so memory stays
+flat regardless of the file size.
+"""
+import mmap
+import os
+import time
+import uuid
+
+from tqdm import tqdm
+
+
+class MultipartFileStream:
+    """
+    A file-like body holding a single file field. requests takes the Content-Length from __len__ and pulls the data
+    through read(), so the body is never built in memory. With use_mmap the file is served as memoryview slices of a
+    memory-mapped view instead of being copied into read buffers.
+    """
+    def __init__(self, file_path: str, field_name: str = 'file', use_mmap: bool = False, show_progress: bool = True,
+                 progress_callback=None):
+        """
+        :param file_path: the file to upload
+        :param field_name: the form field name of the file
+        :param use_mmap: serve the file from a memory-mapped view
+        :param show_progress: show a tqdm bar with the upload rate
+        :param progress_callback: called with (bytes_sent, total_bytes, bytes_per_sec) after every read
+        """
+        self.file_path = file_path
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        file_name = os.path.basename(file_path).replace('"', '')
+        self._preamble = (f'--{self.boundary}\r\n'
+                          f'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+                          f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self._epilogue = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.file_size = os.path.getsize(file_path)
+        self.total_bytes = len(self._preamble) + self.file_size + len(self._epilogue)
+        self.progress_callback = progress_callback
+        self._file = open(file_path, 'rb')
+        self._mmap = None
+        if use_mmap and self.file_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self._released_until = 0
+        self._view = memoryview(self._mmap) if self._mmap is not None else None
+        self._bar = tqdm(total=self.total_bytes, unit='B', unit_scale=True, desc=file_name) if show_progress else None
+        self._position = 0
+        self._start_time = None
+
+    def __len__(self):
+        return self.total_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def bytes_per_sec(self) -> float:
+        if self._start_time is None:
+            return 0.0
+        return self._position / max(time.perf_counter() - self._start_time, 1e-9)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        """
+        Only rewinding is supported, e.g. to resend the body on a retry
+        """
+        if offset != 0 or whence != os.SEEK_SET:
+            raise ValueError('MultipartFileStream can only be rewound to its start')
+        self._position = 0
+        self._start_time = None
+        self._released_until = 0
+        self._file.seek(0)
+        if self._bar is not None:
+            self._bar.reset()
+        return 0
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1):
+        if self._start_time is None:
+            self._start_time = time.perf_counter()
+        if size is None or size < 0:
+            size = self.total_bytes - self._position
+        chunks = []
+        remaining = size
+        while remaining > 0 and self._position < self.total_bytes:
+            chunk = self._read_part(remaining)
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            self._position += len(chunk)
+        self._report(size - remaining)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def _read_part(self, size: int):
+        """
+        Read from the part the current position falls in: the preamble, the file or the epilogue.
+        """
+        file_start = len(self._preamble)
+        file_end = file_start + self.file_size
+        if self._position < file_start:
+            return self._preamble[self._position:min(file_start, self._position + size)]
+        if self._position < file_end:
+            n_bytes = min(size, file_end - self._position)
+            if self._view is not None:
+                offset = self._position - file_start
+                self._release_sent_pages(offset)
+                return self._view[offset:offset + n_bytes]
+            return self._file.read(n_bytes)
+        offset = self._position - file_end
+        return self._epilogue[offset:offset + size]
+
+    def _release_sent_pages(self, offset: int):
+        """
+        Drop the mapped pages that were already sent so they do not add up in the resident set.
+        """
+        release_until = offset - offset % mmap.PAGESIZE
+        if hasattr(mmap, 'MADV_DONTNEED') and release_until > self._released_until:
+            self._mmap.madvise(mmap.MADV_DONTNEED, self._released_until, release_until - self._released_until)
+            self._released_until = release_until
+
+    def _report(self, n_bytes: int):
+        if self._bar is not None:
+            self._bar.update(n_bytes)
+        if self.progress_callback is not None:
+            self.progress_callback(self._position, self.total_bytes, self.bytes_per_sec)
+
+    def close(self):
+        if self._bar is not None:
+            self._bar.close()
+            self._bar = None
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
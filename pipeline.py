@@ -0,0 +1,295 @@
+"""
+A multi-item pipeline of independent stages connected by bounded queues.
+Every stage runs on its own pool of worker threads, so while one video's blobs are uploaded the next video's keyframes
+are downloaded. A full queue blocks the stage in front of it, which bounds the items held in memory. A stage that
+only waits, e.g. for a video's indexing, can return a future and hand the item on once it resolves instead of holding
+a worker. Every stage reports its throughput, queue depth, utilization and queue wait and service latency histograms, and the stage with
+the highest utilization is the bottleneck.
+"""
+import bisect
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+LATENCY_BUCKETS_SECS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000)
+
+_END = object()
+
+
+def then(future: Future, fn) -> Future:
+    """
+    :return: a future of fn applied to the result of future, failing with the exception of either
+    """
+    chained = Future()
+
+    def on_done(_):
+        try:
+            chained.set_result(fn(future.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+class LatencyHistogram:
+    """
+    Counts latencies into fixed, roughly logarithmic buckets, so it costs the same memory for any number of items.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS_SECS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def observe(self, secs: float):
+        self.counts[bisect.bisect_left(self.bounds, secs)] += 1
+        self.n += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def percentile(self, q: float) -> float:
+        """
+        :return: the upper bound of the bucket holding the q-th quantile, the maximum for the last bucket
+        """
+        if self.n == 0:
+            return 0.0
+        rank = q * self.n
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max_secs
+        return self.max_secs
+
+    def to_dict(self) -> dict:
+        buckets = {f'<={bound}s': count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f'>{self.bounds[-1]}s'] = self.counts[-1]
+        return dict(n=self.n, avg_secs=self.total_secs / self.n if self.n else 0.0, p50_secs=self.percentile(0.5),
+                    p95_secs=self.percentile(0.95), max_secs=self.max_secs, buckets=buckets)
+
+
+class Stage:
+    def __init__(self, name: str, do_work, n_workers: int = 1, max_queue_size: int = 8, max_pending: int = 0):
+        """
+        :param name: the stage name in the metrics
+        :param do_work: maps an item to the item handed to the next stage, or to None to drop it. An exception drops
+            the item too and counts it as failed. It can also return a Future of that item.
+        :param n_workers: the number of items the stage works on concurrently
+        :param max_queue_size: the number of items waiting for the stage before the stage in front of it blocks
+        :param max_pending: the number of returned futures awaited at once without holding a worker, the workers block
+            while that many are pending. A worker waits for the future it got when 0.
+        """
+        self.name = name
+        self.do_work = do_work
+        self.n_workers = n_workers
+        self.max_queue_size = max_queue_size
+        self.max_pending = max_pending
+        self._queue = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self.n_processed = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+        self.n_busy = 0
+        self.n_pending = 0
+        self.busy_secs = 0.0
+        self.max_queue_depth = 0
+        self.wait_latency = LatencyHistogram()
+        self.service_latency = LatencyHistogram()
+        self._n_running_workers = self.n_workers
+        self._pending_slots = threading.Semaphore(self.max_pending) if self.max_pending > 0 else None
+        # the resolved futures, handed to the next stage by a forwarding thread so their callbacks never block
+        self._resolved = queue.Queue()
+
+    def put(self, item, started_at: float):
+        self._queue.put((item, started_at, time.perf_counter()))
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def metrics(self, elapsed_secs: float) -> dict:
+        with self._lock:
+            return dict(n_workers=self.n_workers, processed=self.n_processed, dropped=self.n_dropped,
+                        failed=self.n_failed, busy_workers=self.n_busy, pending=self.n_pending,
+                        queue_depth=self._queue.qsize(),
+                        max_queue_depth=self.max_queue_depth,
+                        items_per_sec=self.n_processed / elapsed_secs if elapsed_secs else 0.0,
+                        utilization=self.busy_secs / (self.n_workers * elapsed_secs) if elapsed_secs else 0.0,
+                        wait_latency=self.wait_latency.to_dict(), service_latency=self.service_latency.to_dict())
+
+
+class Pipeline:
+    def __init__(self, stages, max_output_queue_size: int = 64):
+        """
+        :param stages: the Stages, in order
+        :param max_output_queue_size: the number of finished items waiting for the caller before the last stage blocks
+        """
+        self.stages = stages
+        self.max_output_queue_size = max_output_queue_size
+        self.end_to_end_latency = LatencyHistogram()
+        self._start_time = None
+        self._end_time = None
+        self._output = None
+
+    def run(self, items):
+        """
+        Push the items through all the stages. One run at a time.
+        :param items: the input items, consumed as the first stage has room for them
+        :return: a generator of the items that went through all the stages, in completion order
+        """
+        for stage in self.stages:
+            stage._reset()
+        self.end_to_end_latency = LatencyHistogram()
+        self._output = queue.Queue(maxsize=self.max_output_queue_size)
+        self._start_time = time.perf_counter()
+        self._end_time = None
+        workers = [threading.Thread(target=self._feed, args=(items,), name='pipeline-feeder', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            workers.extend(threading.Thread(target=self._work, args=(i,), name=f'pipeline-{stage.name}-{j}',
+                                            daemon=True) for j in range(stage.n_workers))
+            if stage.max_pending > 0:
+                workers.append(threading.Thread(target=self._forward, args=(i,),
+                                                name=f'pipeline-{stage.name}-forwarder', daemon=True))
+        for worker in workers:
+            worker.start()
+        while True:
+            entry = self._output.get()
+            if entry is _END:
+                break
+            item, started_at = entry
+            self.end_to_end_latency.observe(time.perf_counter() - started_at)
+            yield item
+        for worker in workers:
+            worker.join()
+        self._end_time = time.perf_counter()
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                self.stages[0].put(item, time.perf_counter())
+        except Exception as e:
+            print(f'Failed to read the pipeline input: {e}')
+        for _ in range(self.stages[0].n_workers):
+            self.stages[0]._queue.put(_END)
+
+    def _work(self, stage_index: int):
+        stage = self.stages[stage_index]
+        while True:
+            entry = stage._queue.get()
+            if entry is _END:
+                break
+            item, started_at, enqueued_at = entry
+            if stage._pending_slots is not None:
+                stage._pending_slots.acquire()
+            dequeued_at = time.perf_counter()
+            with stage._lock:
+                stage.n_busy += 1
+                stage.wait_latency.observe(dequeued_at - enqueued_at)
+            try:
+                result = stage.do_work(item)
+                failed = False
+                if isinstance(result, Future) and stage._pending_slots is None:
+                    result = result.result()
+            except Exception as e:
+                print(f'Stage {stage.name} failed on {item}: {e}')
+                result, failed = None, True
+            with stage._lock:
+                stage.n_busy -= 1
+                stage.busy_secs += time.perf_counter() - dequeued_at
+                if isinstance(result, Future):
+                    stage.n_pending += 1
+            if isinstance(result, Future):
+                result.add_done_callback(
+                    lambda future, entry=(item, started_at, dequeued_at): stage._resolved.put((future,) + entry))
+                continue
+            if stage._pending_slots is not None:
+                stage._pending_slots.release()
+            self._complete(stage_index, result, failed, started_at, dequeued_at)
+
+        # the last worker of a stage to finish ends the next stage, once the pending futures were handed on
+        with stage._lock:
+            stage._n_running_workers -= 1
+            is_last_worker = stage._n_running_workers == 0
+        if is_last_worker:
+            if stage._pending_slots is not None:
+                for _ in range(stage.max_pending):
+                    stage._pending_slots.acquire()
+                stage._resolved.put(_END)
+            next_stage = self.stages[stage_index + 1] if stage_index + 1 < len(self.stages) else None
+            if next_stage is not None:
+                for _ in range(next_stage.n_workers):
+                    next_stage._queue.put(_END)
+            else:
+                self._output.put(_END)
+
+    def _forward(self, stage_index: int):
+        """
+        Hand the items of a stage's resolved futures on, blocking on a full next stage instead of in the callbacks.
+        """
+        stage = self.stages[stage_index]
+        while True:
+            entry = stage._resolved.get()
+            if entry is _END:
+                break
+            future, item, started_at, dequeued_at = entry
+            try:
+                result = future.result()
+                failed = False
+            except Exception as e:
+                print(f'Stage {stage.name} failed on {item}: {e}')
+                result, failed = None, True
+            with stage._lock:
+                stage.n_pending -= 1
+            self._complete(stage_index, result, failed, started_at, dequeued_at)
+            stage._pending_slots.release()
+
+    def _complete(self, stage_index: int, result, failed: bool, started_at: float, dequeued_at: float):
+        stage = self.stages[stage_index]
+        with stage._lock:
+            stage.service_latency.observe(time.perf_counter() - dequeued_at)
+            if failed:
+                stage.n_failed += 1
+            else:
+                stage.n_processed += 1
+                if result is None:
+                    stage.n_dropped += 1
+        if result is None:
+            return
+        if stage_index + 1 < len(self.stages):
+            self.stages[stage_index + 1].put(result, started_at)
+        else:
+            self._output.put((result, started_at))
+
+    def metrics(self) -> dict:
+        """
+        :return: the metrics of every stage by name, so far when the run is in progress, and the end-to-end latency
+        """
+        if self._start_time is None:
+            elapsed_secs = 0.0
+        else:
+            elapsed_secs = (self._end_time or time.perf_counter()) - self._start_time
+        return dict(elapsed_secs=elapsed_secs, end_to_end_latency=self.end_to_end_latency.to_dict(),
+                    stages={stage.name: stage.metrics(elapsed_secs) for stage in self.stages})
+
+    def bottleneck(self) -> str:
+        """
+        :return: the name of the stage with the highest utilization
+        """
+        stages = self.metrics()['stages']
+        return max(stages, key=lambda name: stages[name]['utilization'])
+
+    def report(self):
+        metrics = self.metrics()
+        print(f'Pipeline ran for {metrics["elapsed_secs"]:.1f}s, end-to-end latency p50 '
+              f'{metrics["end_to_end_latency"]["p50_secs"]}s p95 {metrics["end_to_end_latency"]["p95_secs"]}s')
+        for name, stage in metrics['stages'].items():
+            print(f'  {name}: {stage["processed"]} processed ({stage["items_per_sec"]:.2f}/s), {stage["failed"]} failed, '
+                  f'{stage["n_workers"]} workers at {stage["utilization"]:.0%}, max queue depth '
+                  f'{stage["max_queue_depth"]}, wait p95 {stage["wait_latency"]["p95_secs"]}s, service p50 '
+                  f'{stage["service_latency"]["p50_secs"]}s p95 {stage["service_latency"]["p95_secs"]}s')
+        print(f'  bottleneck: {self.bottleneck()}')
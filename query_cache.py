@@ -0,0 +1,100 @@
+"""
+An in-process cache of search results, keyed on the normalized query, the index name and the search options.
+Entries expire after a TTL and the least recently used ones are evicted beyond the entry count and memory caps.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryResultCache:
+    def __init__(self, max_entries: int = 1024, ttl_secs: float = 300, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_entries: the maximal number of cached queries
+        :param ttl_secs: how long a result stays valid
+        :param max_bytes: the maximal estimated size of the cached results, measured as their JSON length
+        """
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._keys_by_index = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, index_name: str, options: dict = None) -> tuple:
+        """
+        Queries differing only in case or whitespace share a key.
+        """
+        normalized_query = ' '.join((query or '').lower().split())
+        normalized_options = json.dumps(options or {}, sort_keys=True, default=str)
+        return index_name, normalized_query, normalized_options
+
+    def get(self, key: tuple):
+        """
+        :return: a copy of the cached results, None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # callers such as the rank fusion update the result dicts in place
+            return [dict(result) for result in entry[0]]
+
+    def put(self, key: tuple, results: list):
+        n_bytes = len(json.dumps(results, default=str))
+        if n_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = ([dict(result) for result in results], time.monotonic() + self.ttl_secs, n_bytes)
+            self._keys_by_index.setdefault(key[0], set()).add(key)
+            self.n_bytes += n_bytes
+            while len(self._entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_index(self, index_name: str):
+        """
+        Drop the cached results of an index, e.g. after documents were uploaded to it.
+        """
+        with self._lock:
+            for key in list(self._keys_by_index.get(index_name, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_index.clear()
+            self.n_bytes = 0
+
+    def _remove(self, key: tuple):
+        _, _, n_bytes = self._entries.pop(key)
+        self.n_bytes -= n_bytes
+        index_keys = self._keys_by_index.get(key[0])
+        index_keys.discard(key)
+        if not index_keys:
+            del self._keys_by_index[key[0]]
+
+    def stats(self) -> dict:
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return dict(entries=len(self._entries), bytes=self.n_bytes, hits=self.hits, misses=self.misses,
+                        hit_rate=self.hits / n_lookups if n_lookups else 0.0, evictions=self.evictions,
+                        expirations=self.expirations, invalidations=self.invalidations)
@@ -0,0 +1,139 @@
+"""
+Rank fusion of search results from several indexes, e.g. keyframes and prompt content.
+All the fusions make a single pass over the results, merge the duplicates of a video segment and select the top k
+with a heap instead of sorting all the hits.
+"""
+import heapq
+from operator import itemgetter
+
+DEFAULT_DEDUPE_BY = ('video_id', 'segment_id')
+
+
+def _key_getter(dedupe_by):
+    """
+    :return: a function of a result to the tuple of its dedupe_by fields
+    """
+    fields = tuple(dedupe_by)
+    if len(fields) == 1:
+        field, = fields
+        return lambda result: result.get(field)
+    if len(fields) == 2:
+        first, second = fields
+        return lambda result: (result.get(first), result.get(second))
+    return lambda result: tuple(result.get(field) for field in fields)
+
+
+def _top_k(fused: dict, top_k: int, score_field: str):
+    """
+    :param fused: [score, first result, ...] entries by key
+    :return: copies of the top k results carrying their fused score, in descending score order
+    """
+    top = heapq.nlargest(top_k, fused.values(), key=itemgetter(0))
+    return [dict(entry[1], **{score_field: entry[0]}) for entry in top]
+
+
+def reciprocal_rank_fusion(result_lists, top_k: int = 10, k: int = 60, weights=None, dedupe_by=DEFAULT_DEDUPE_BY,
+                           score_field: str = 'relevance_score'):
+    """
+    Reciprocal rank fusion: a result scores sum(weight / (k + rank)) over the lists it appears in. Only ranks are used,
+    so lists with incomparable score scales fuse well.
+    :param result_lists: ranked lists of result dicts
+    :param top_k: the number of fused results to return
+    :param k: the rank smoothing constant
+    :param weights: an optional weight per list
+    :param dedupe_by: the result fields identifying a duplicate, e.g. ('video_id',) to fuse per video
+    :param score_field: the field the fused score is written to
+    :return: the top k fused results
+    """
+    key_of = _key_getter(dedupe_by)
+    # [score, first result, index of the last list the key was seen in] by key
+    fused = dict()
+    for list_index, results in enumerate(result_lists):
+        weight = weights[list_index] if weights is not None else 1.0
+        rank = 0
+        for result in results:
+            key = key_of(result)
+            entry = fused.get(key)
+            if entry is None:
+                rank += 1
+                fused[key] = [weight / (k + rank), result, list_index]
+            elif entry[2] != list_index:
+                rank += 1
+                entry[0] += weight / (k + rank)
+                entry[2] = list_index
+    return _top_k(fused, top_k, score_field)
+
+
+def weighted_score_fusion(result_lists, top_k: int = 10, weights=None, normalize: str = 'max',
+                          dedupe_by=DEFAULT_DEDUPE_BY, score_field: str = 'relevance_score'):
+    """
+    Weighted score fusion: a result scores the weighted sum of its normalized scores over the lists it appears in.
+    :param result_lists: ranked lists of result dicts carrying score_field
+    :param top_k: the number of fused results to return
+    :param weights: an optional weight per list
+    :param normalize: 'max' to divide every list by its top score, 'minmax' to scale it to [0, 1], None for raw scores
+    :param dedupe_by: the result fields identifying a duplicate
+    :param score_field: the field holding the input scores and the fused score
+    :return: the top k fused results
+    """
+    key_of = _key_getter(dedupe_by)
+    fused = dict()
+    for list_index, results in enumerate(result_lists):
+        weight = weights[list_index] if weights is not None else 1.0
+        # the best ranked occurrence of every key in the list
+        unique_results = dict()
+        for result in results:
+            unique_results.setdefault(key_of(result), result)
+        if not unique_results:
+            continue
+        scores = [result.get(score_field) or 0.0 for result in unique_results.values()]
+        offset, scale = 0.0, 1.0
+        if normalize == 'max':
+            scale = max(scores) or 1.0
+        elif normalize == 'minmax':
+            offset = min(scores)
+            scale = (max(scores) - offset) or 1.0
+        factor = weight / scale
+        for (key, result), score in zip(unique_results.items(), scores):
+            score = (score - offset) * factor
+            entry = fused.get(key)
+            if entry is None:
+                fused[key] = [score, result]
+            else:
+                entry[0] += score
+    return _top_k(fused, top_k, score_field)
+
+
+def occurrence_fusion(result_lists, top_k: int = 10, dedupe_by=DEFAULT_DEDUPE_BY,
+                      score_field: str = 'relevance_score', occurrence_field: str = 'video_id'):
+    """
+    The original fusion: a result's best score is multiplied by the number of results of its video across the lists.
+    :return: the top k fused results
+    """
+    key_of = _key_getter(dedupe_by)
+    occurrences = dict()
+    best = dict()
+    for results in result_lists:
+        for result in results:
+            video_id = result.get(occurrence_field)
+            occurrences[video_id] = occurrences.get(video_id, 0) + 1
+            key = key_of(result)
+            score = result.get(score_field) or 0.0
+            entry = best.get(key)
+            if entry is None or score > entry[0]:
+                best[key] = [score, result]
+    fused = {key: [score * occurrences[result.get(occurrence_field)], result]
+             for key, (score, result) in best.items()}
+    return _top_k(fused, top_k, score_field)
+
+
+FUSIONS = dict(rrf=reciprocal_rank_fusion, weighted=weighted_score_fusion, occurrence=occurrence_fusion)
+
+
+def fuse(result_lists, method: str = 'rrf', top_k: int = 10, **kwargs):
+    """
+    Fuse result lists with one of the FUSIONS methods: 'rrf', 'weighted' or 'occurrence'.
+    """
+    if method not in FUSIONS:
+        raise ValueError(f'Unknown fusion method: {method}, expected one of {list(FUSIONS)}')
+    return FUSIONS[method](result_lists, top_k=top_k, **kwargs)
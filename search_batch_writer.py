@@ -0,0 +1,191 @@
+"""
+A buffered batch writer for Azure AI Search documents. Documents are grouped by count and JSON size, batches are
+uploaded concurrently, and only the documents the service rejected with a retriable status are retried.
+"""
+import json
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import AzureError, HttpResponseError
+
+# per-document statuses the service documents as retriable
+RETRIABLE_STATUS_CODES = {409, 422, 429, 503}
+# the longest JSON number a float serializes to, e.g. -2.2250738585072014e-308
+MAX_NUMBER_JSON_BYTES = 24
+
+
+def estimate_json_bytes(value) -> int:
+    """
+    Estimate the size of a value sent as JSON, which the SDK serializes to ASCII. Numeric lists, e.g. embeddings, are
+    estimated from their length alone, and the other values are upper-bounded up to the escapes of ASCII strings.
+    """
+    if isinstance(value, str):
+        return len(value) + 2 if value.isascii() else len(json.dumps(value))
+    if isinstance(value, (bool, int, float)) or value is None:
+        return MAX_NUMBER_JSON_BYTES
+    if isinstance(value, dict):
+        return 2 + sum(estimate_json_bytes(str(key)) + estimate_json_bytes(item) + 2 for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], (int, float)):
+            return 2 + len(value) * (MAX_NUMBER_JSON_BYTES + 1)
+        return 2 + sum(estimate_json_bytes(item) + 1 for item in value)
+    return estimate_json_bytes(str(value))
+
+
+class SearchBatchWriter:
+    """
+    Buffers documents for a single index and uploads them in batches of at most max_batch_size documents and about
+    max_batch_bytes of JSON. A batch is flushed once a threshold is reached and on close(), with up to
+    max_concurrent_flushes batches in flight; add() blocks when more batches are waiting, which bounds the memory.
+    """
+    def __init__(self, search_client, max_batch_size: int = 1000, max_batch_bytes: int = 8 * 1024 * 1024,
+                 max_concurrent_flushes: int = 4, max_retries: int = 3, retry_delay_secs: float = 1.0,
+                 key_field: str = None, on_flush=None):
+        """
+        :param search_client: the SearchClient of the index
+        :param max_batch_size: the maximal number of documents in a batch, the service accepts up to 1000
+        :param max_batch_bytes: the maximal estimated JSON size of a batch, the service accepts up to 16MB. A batch the
+            service rejects as too large is uploaded in halves.
+        :param max_concurrent_flushes: the number of batches uploaded concurrently
+        :param max_retries: how many times a failed document is retried
+        :param retry_delay_secs: the base delay of the jittered exponential backoff between retries
+        :param key_field: the index key field, used to match the per-document results to the documents. The results
+            are matched by position when not given, AzureAISearchWrapper.batch_writer() reads it from the index.
+        :param on_flush: called with the list of uploaded documents after every successful batch
+        """
+        self.search_client = search_client
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.retry_delay_secs = retry_delay_secs
+        self.key_field = key_field
+        self.on_flush = on_flush
+        self.failed = []
+        self.n_uploaded = 0
+        self.n_batches = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_flushes)
+        self._in_flight = threading.BoundedSemaphore(2 * max_concurrent_flushes)
+        self._futures = []
+        self._start_time = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, document: dict):
+        document_bytes = estimate_json_bytes(document)
+        if self._buffer and (len(self._buffer) >= self.max_batch_size or
+                             self._buffer_bytes + document_bytes > self.max_batch_bytes):
+            self.flush()
+        self._buffer.append(document)
+        self._buffer_bytes += document_bytes
+
+    def add_many(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def flush(self):
+        """
+        Upload the buffered documents in the background.
+        """
+        if not self._buffer:
+            return
+        batch = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._in_flight.acquire()
+        future = self._executor.submit(self._upload_batch, batch)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        self._futures = [pending for pending in self._futures if not pending.done()] + [future]
+
+    def close(self):
+        """
+        Flush the remaining documents and wait for all the batches.
+        :return: the (document, error message) pairs that failed for good
+        """
+        try:
+            self.flush()
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True)
+        if self.failed:
+            print(f'Failed to upload {len(self.failed)} documents, e.g.: {self.failed[0][1]}')
+        return self.failed
+
+    def stats(self) -> dict:
+        elapsed_secs = time.time() - self._start_time
+        with self._lock:
+            return dict(uploaded=self.n_uploaded, failed=len(self.failed), batches=self.n_batches,
+                        documents_per_sec=self.n_uploaded / elapsed_secs if elapsed_secs else 0.0)
+
+    def _upload_batch(self, batch: list):
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0, self.retry_delay_secs * 2 ** attempt))
+            try:
+                results = self.search_client.upload_documents(documents=pending)
+            except HttpResponseError as e:
+                if e.status_code == 413 and len(pending) > 1:
+                    # the batch is too large for the service, upload it in halves
+                    middle = len(pending) // 2
+                    self._upload_batch(pending[:middle])
+                    self._upload_batch(pending[middle:])
+                    return
+                if e.status_code not in RETRIABLE_STATUS_CODES or attempt == self.max_retries:
+                    self._record(succeeded=[], failed=[(document, str(e)) for document in pending])
+                    return
+                continue
+            except AzureError as e:
+                # connection and timeout errors, the documents may not have reached the service
+                if attempt == self.max_retries:
+                    self._record(succeeded=[], failed=[(document, str(e)) for document in pending])
+                    return
+                continue
+            except Exception as e:
+                print(f'Failed to upload a batch of {len(pending)} documents: {e}')
+                self._record(succeeded=[], failed=[(document, str(e)) for document in pending])
+                return
+            succeeded, retriable, failed = self._match_results(pending, results)
+            if attempt == self.max_retries:
+                failed += retriable
+                retriable = []
+            self._record(succeeded, failed)
+            if not retriable:
+                return
+            pending = [document for document, _ in retriable]
+
+    def _match_results(self, documents: list, results: list):
+        """
+        :return: the succeeded documents, and the retriable and permanent (document, error message) failures
+        """
+        if self.key_field is not None:
+            documents_by_key = {str(document.get(self.key_field)): document for document in documents}
+            pairs = [(documents_by_key.get(result.key), result) for result in results]
+        else:
+            pairs = list(zip(documents, results))
+        succeeded, retriable, failed = [], [], []
+        for document, result in pairs:
+            if result.succeeded:
+                succeeded.append(document)
+            elif result.status_code in RETRIABLE_STATUS_CODES:
+                retriable.append((document, result.error_message))
+            else:
+                failed.append((document, result.error_message))
+        return succeeded, retriable, failed
+
+    def _record(self, succeeded: list, failed: list):
+        with self._lock:
+            self.n_batches += 1
+            self.n_uploaded += len(succeeded)
+            self.failed.extend(failed)
+        if succeeded and self.on_flush is not None:
+            self.on_flush(succeeded)
@@ -0,0 +1,195 @@
+"""
+A columnar, array-backed table of video segments: the compact counterpart of a list of VideoSegmentIndex objects.
+Repeated strings such as the video ids are interned into small integer codes, the times are float arrays and the
+content vectors are rows of a single float32 block, so a segment costs its data and a few bytes of bookkeeping.
+"""
+import json
+import os
+from array import array
+
+import numpy as np
+
+from azure_ai_search_wrapper import VideoSegmentIndex
+
+
+class _InternedColumn:
+    """
+    A string column stored as codes into its distinct values.
+    """
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.code_by_value = {value: code for code, value in enumerate(self.values)}
+        self.codes = array('I')
+
+    def append(self, value):
+        code = self.code_by_value.get(value)
+        if code is None:
+            code = len(self.values)
+            self.code_by_value[value] = code
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, row: int):
+        return self.values[self.codes[row]]
+
+
+class SegmentTable:
+    """
+    Holds the fields of VideoSegmentIndex column by column. Rows are appended, and read back as VideoSegmentIndex
+    objects, as upload documents, or as the whole vector block without copying it.
+    """
+    INTERNED_COLUMNS = ('location', 'account_id', 'video_id')
+    STRING_COLUMNS = ('segment_id', 'prompt', 'image_path')
+    TIME_COLUMNS = ('start_time', 'end_time')
+
+    def __init__(self, dim: int, initial_capacity: int = 1024):
+        """
+        :param dim: the content vector dimension
+        :param initial_capacity: the number of preallocated vector rows, the block doubles when full
+        """
+        self.dim = dim
+        self._interned = {column: _InternedColumn() for column in self.INTERNED_COLUMNS}
+        self._strings = {column: [] for column in self.STRING_COLUMNS}
+        self._times = {column: array('d') for column in self.TIME_COLUMNS}
+        self._vectors = np.empty((max(initial_capacity, 1), dim), dtype=np.float32)
+        self._n_rows = 0
+
+    def __len__(self):
+        return self._n_rows
+
+    @classmethod
+    def from_segments(cls, segments, dim: int = None):
+        """
+        :param segments: VideoSegmentIndex objects
+        """
+        segments = list(segments)
+        if dim is None:
+            dim = len(segments[0].content_vector) if segments else 0
+        table = cls(dim, initial_capacity=len(segments))
+        for segment in segments:
+            table.append_segment(segment)
+        return table
+
+    def append(self, location, account_id, video_id, segment_id, start_time, end_time, prompt, image_path,
+               content_vector):
+        """
+        :return: the row of the new segment
+        """
+        if self._n_rows == len(self._vectors):
+            vectors = np.empty((2 * len(self._vectors), self.dim), dtype=np.float32)
+            vectors[:self._n_rows] = self._vectors[:self._n_rows]
+            self._vectors = vectors
+        row = self._n_rows
+        self._vectors[row] = content_vector
+        self._interned['location'].append(location)
+        self._interned['account_id'].append(account_id)
+        self._interned['video_id'].append(video_id)
+        self._strings['segment_id'].append(segment_id)
+        self._strings['prompt'].append(prompt)
+        self._strings['image_path'].append(image_path)
+        self._times['start_time'].append(start_time)
+        self._times['end_time'].append(end_time)
+        self._n_rows += 1
+        return row
+
+    def append_segment(self, segment: VideoSegmentIndex):
+        return self.append(segment.location, segment.account_id, segment.video_id, segment.segment_id,
+                           segment.start_time, segment.end_time, segment.prompt, segment.image_path,
+                           segment.content_vector)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        A (n, dim) view of the content vectors, valid until the next append
+        """
+        return self._vectors[:self._n_rows]
+
+    def column(self, name: str):
+        """
+        :return: a column as a list of strings, or the array('d') itself for the time columns
+        """
+        if name in self._times:
+            return self._times[name]
+        if name in self._strings:
+            return self._strings[name]
+        interned = self._interned[name]
+        return [interned.values[code] for code in interned.codes]
+
+    def keys(self):
+        """
+        :return: the (video_id, segment_id) of every row
+        """
+        return list(zip(self.column('video_id'), self._strings['segment_id']))
+
+    def __getitem__(self, row: int) -> VideoSegmentIndex:
+        if not -self._n_rows <= row < self._n_rows:
+            raise IndexError(f'Row {row} is out of range for {self._n_rows} segments')
+        row %= self._n_rows
+        return VideoSegmentIndex(location=self._interned['location'][row],
+                                 account_id=self._interned['account_id'][row],
+                                 video_id=self._interned['video_id'][row],
+                                 thumbnail_id=self._strings['segment_id'][row],
+                                 start_time=self._times['start_time'][row],
+                                 end_time=self._times['end_time'][row],
+                                 prompt=self._strings['prompt'][row],
+                                 image_path=self._strings['image_path'][row],
+                                 content_vector=self._vectors[row].tolist())
+
+    def __iter__(self):
+        for row in range(self._n_rows):
+            yield self[row]
+
+    def iter_documents(self):
+        """
+        Yield the upload documents one at a time, the same dicts as VideoSegmentIndex.to_dict(), so a batch writer
+        never holds more than a batch of them.
+        """
+        locations, account_ids, video_ids = (self._interned[column] for column in self.INTERNED_COLUMNS)
+        segment_ids, prompts, image_paths = (self._strings[column] for column in self.STRING_COLUMNS)
+        start_times, end_times = (self._times[column] for column in self.TIME_COLUMNS)
+        vectors = self.vectors
+        for row in range(self._n_rows):
+            yield dict(video_id=video_ids[row], segment_id=segment_ids[row], start_time=start_times[row],
+                       end_time=end_times[row], prompt=prompts[row], image_path=image_paths[row],
+                       content_vector=vectors[row].tolist(), location=locations[row], account_id=account_ids[row])
+
+    def save(self, folder: str):
+        """
+        Write the vector block and the time and code arrays straight from their buffers, and the strings as JSON.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'vectors.npy'), self.vectors)
+        for column, values in self._times.items():
+            with open(os.path.join(folder, f'{column}.f64'), 'wb') as f:
+                values.tofile(f)
+        for column, interned in self._interned.items():
+            with open(os.path.join(folder, f'{column}.u32'), 'wb') as f:
+                interned.codes.tofile(f)
+        strings = dict(self._strings, **{f'{column}_values': interned.values
+                                         for column, interned in self._interned.items()})
+        with open(os.path.join(folder, 'segments.json'), 'w') as f:
+            json.dump(dict(dim=self.dim, n_rows=self._n_rows, strings=strings), f)
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool = True):
+        """
+        :param mmap: memory-map the vector block read-only, appending copies it into memory
+        """
+        with open(os.path.join(folder, 'segments.json'), 'r') as f:
+            metadata = json.load(f)
+        table = cls(metadata['dim'])
+        table._n_rows = metadata['n_rows']
+        table._vectors = np.load(os.path.join(folder, 'vectors.npy'), mmap_mode='r' if mmap else None)
+        if table._n_rows == 0:
+            table._vectors = np.empty((1, table.dim), dtype=np.float32)
+        for column in cls.TIME_COLUMNS:
+            with open(os.path.join(folder, f'{column}.f64'), 'rb') as f:
+                table._times[column].fromfile(f, table._n_rows)
+        for column in cls.INTERNED_COLUMNS:
+            interned = _InternedColumn(metadata['strings'][f'{column}_values'])
+            with open(os.path.join(folder, f'{column}.u32'), 'rb') as f:
+                interned.codes.fromfile(f, table._n_rows)
+            table._interned[column] = interned
+        for column in cls.STRING_COLUMNS:
+            table._strings[column] = metadata['strings'][column]
+        return table
@@ -1,133 +1,203 @@
 import os
-import time, json, zipfile
+import json
+from concurrent.futures import Future, wait
 
+from blob_upload_stage import BlobUploadStage
+from indexing_tracker import IndexingCompletionTracker
+from pipeline import Pipeline, Stage, then
 from video_indexer_wrapper import VideoIndexerWrapper
 from azure.storage.blob import BlobServiceClient, BlobClient
 from azure.search.documents import SearchClient
 from azure.identity import DefaultAzureCredential
 from config_manager import load_config
 
+# the indexing stage only waits on the completion tracker, its futures are awaited for many videos at once without
+# holding a worker each
+PIPELINE_STAGE_DEFAULTS = dict(upload=dict(n_workers=2, max_queue_size=8),
+                               indexing=dict(n_workers=1, max_queue_size=8, max_pending=64),
+                               prompt=dict(n_workers=8, max_queue_size=8),
+                               blob_upload=dict(n_workers=4, max_queue_size=4))
+
 
 class SemanticSearchIndexer:
     def __init__(self, config):
         self.video_indexer_wrapper = VideoIndexerWrapper(**config['vi'])
+        # one scheduler tracks the indexing of all the videos, config['tracker'] can enable the callback listener
+        self.completion_tracker = IndexingCompletionTracker(self.video_indexer_wrapper, **config.get('tracker', {}))
         credential = DefaultAzureCredential()
         ais_params = config['ais']
         ais_params['credential'] = credential
         self.search_client = SearchClient(**ais_params)
         self.account_url = config['storage']['sa_url']
         self.blob_service_client = BlobServiceClient(account_url=self.account_url, credential=credential)
+        # the keyframes and prompt sections of all the videos are uploaded by one bounded pool of workers
+        self.blob_upload_stage = BlobUploadStage(self.blob_service_client, **config.get('blob_upload', {}))
+        self.pipeline_config = config.get('pipeline', {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stop the completion tracker and its listener, and wait for the pending blob uploads
+        """
+        self.completion_tracker.close()
+        self.blob_upload_stage.close()
+        self.video_indexer_wrapper.close()
 
     def index_media_file(self, media_asset_url: str, working_dir: str):
         """
         Index a media asset file in Azure AI Video Indexer, download its keyframes and Prompt Content into a blob.
-        :param working_dir: local directory to store the extracted data
+        :param working_dir: unused, the keyframes and prompt sections are uploaded from memory
         :param media_asset_url: the media asset URL
         :return: None
         """
+        job = VideoJob(media_asset_url)
+        for _, do_work in self.pipeline_steps():
+            result = do_work(job)
+            if isinstance(result, Future):
+                result.result()
+        self.blob_upload_stage.report()
+        print('Data uploaded successfully!')
+
+    def index_media_files(self, media_asset_urls, working_dir: str, stages_config: dict = None):
+        """
+        Index many media asset files with the steps of index_media_file running as pipeline stages, so the videos
+        overlap, e.g. one video's keyframes are uploaded while the next video waits for its indexing.
+        :param media_asset_urls: the media asset URLs
+        :param working_dir: unused, the keyframes and prompt sections are uploaded from memory
+        :param stages_config: the n_workers and max_queue_size by stage name, defaults to config['pipeline']
+        :return: the VideoJobs that were uploaded to the blob storage, and the pipeline with the stage metrics
+        """
+        stages_config = stages_config if stages_config is not None else self.pipeline_config
+        stages = [Stage(name, do_work, **{**PIPELINE_STAGE_DEFAULTS[name], **stages_config.get(name, {})})
+                  for name, do_work in self.pipeline_steps()]
+        video_pipeline = Pipeline(stages)
+        indexed_videos = list(video_pipeline.run(VideoJob(media_asset_url) for media_asset_url in media_asset_urls))
+        video_pipeline.report()
+        self.blob_upload_stage.report()
+        return indexed_videos, video_pipeline
+
+    def pipeline_steps(self):
+        """
+        :return: the (stage name, step) pairs of indexing a video, each step advances a VideoJob
+        """
+        return [('upload', self._upload_step), ('indexing', self._indexing_step), ('prompt', self._prompt_step),
+                ('blob_upload', self._blob_upload_step)]
+
+    def _upload_step(self, job):
         # Upload a video to Video Indexer
-        video_response = self.video_indexer_wrapper.upload_video(media_asset_url)
-        if 'ErrorType' in video_response:
+        video_response = self.video_indexer_wrapper.upload_video(job.media_asset_url,
+                                                                 callback_url=self.completion_tracker.callback_url)
+        if video_response is not None and 'ErrorType' in video_response:
             message = video_response['Message']
-            video_id = message[52:62]
+            job.video_id = message[52:62]
         elif video_response is None or 'id' not in video_response:
             print(f'Failed to upload the video.')
             raise Exception(f'Failed to upload the video. Message: {video_response}')
         else:
-            video_id = video_response['id']
+            job.video_id = video_response['id']
+        return job
+
+    def _indexing_step(self, job):
+        # Wait for the indexing, the tracker polls all the pending videos together or gets a callback
+        def on_indexed(indexed_video):
+            print(f'Video state: {indexed_video["state"]}')
+            return job
 
-        # Get the indexed
-        indexed_video = self.video_indexer_wrapper.get_video_index(video_id)
-        if indexed_video['state'] == 'Processing':
-            print(f'Video is not processed yet. Starting polling...')
-            while indexed_video['state'] == 'Processing':
-                time.sleep(15)
-                indexed_video = self.video_indexer_wrapper.get_video_index(video_id)
-                print(f'Video state: {indexed_video["state"]}')
+        return then(self.completion_tracker.track_indexing(job.video_id), on_indexed)
 
+    def _prompt_step(self, job):
         # create a prompt content
-        prompt_content = try_get_prompt(self.video_indexer_wrapper, video_id)
-
-        # Extract prompt content and keyframes
-        prompt_sections = prompt_content['sections']
-
-        # Extract keyframes - get the artifacts
-        keyframes = extract_keyframes(self.video_indexer_wrapper, video_id, working_dir)
-
-        # Upload the extracted keyframes
-        for keyframe in keyframes:
-            keyframe_name = os.path.basename(keyframe)
-            blob_client = self.blob_service_client.get_blob_client(video_id, blob=keyframe_name)
-            # Create a new blob and upload the extracted data
-            # blob_client = self.blob_service_client.get_blob_client(container=video_id, blob=keyframe)
-            with open(keyframe, 'rb') as data:
-                blob_client.upload_blob(data, overwrite=True)
-
-        # Upload the extracted prompt content sections
-        for prompt_section in prompt_sections:
-            # create a JSON file for each prompt section
+        job.prompt_content = try_get_prompt(self.video_indexer_wrapper, job.video_id, self.completion_tracker)
+        return job
+
+    def _blob_upload_step(self, job):
+        video_id = job.video_id
+
+        # Upload the keyframes concurrently as they are streamed out of the artifact zip, the zip is parsed no faster
+        # than the blobs are uploaded and only the keyframes in flight are held in memory
+        keyframes = extract_keyframes(self.video_indexer_wrapper, video_id, None)
+        upload_futures = [self.blob_upload_stage.submit(video_id, os.path.basename(keyframe), data)
+                          for keyframe, data in keyframes]
+
+        # Upload the prompt content sections as JSON blobs, serialized in memory
+        prompt_content = job.prompt_content
+        for prompt_section in prompt_content['sections']:
             json_file_name = f'{video_id}_{prompt_section["id"]}.json'
-            json_section_path = f'{working_dir}/{json_file_name}'
-            with open(json_section_path, 'w') as f:
-                prompt_section_metadata = dict(video_id=video_id, segment_id=prompt_section['id'],
-                                               video_name=prompt_content['name'], content=prompt_section['content'],
-                                               start_time=prompt_section['start'], end_time=prompt_section['end'])
-                json.dump(prompt_section_metadata, f)
-            # Create a new blob and upload the extracted data
-            blob_client = self.blob_service_client.get_blob_client(video_id, blob=json_file_name)
-            with open(json_section_path, 'rb') as data:
-                blob_client.upload_blob(data, overwrite=True)
+            prompt_section_metadata = dict(video_id=video_id, segment_id=prompt_section['id'],
+                                           video_name=prompt_content['name'], content=prompt_section['content'],
+                                           start_time=prompt_section['start'], end_time=prompt_section['end'])
+            upload_futures.append(self.blob_upload_stage.submit(video_id, json_file_name,
+                                                                json.dumps(prompt_section_metadata).encode('utf-8')))
+
+        wait(upload_futures)
+        errors = [future.exception() for future in upload_futures if future.exception() is not None]
+        if errors:
+            raise Exception(f'Failed to upload {len(errors)} of the {len(upload_futures)} blobs of video {video_id}, '
+                            f'e.g.: {errors[0]}')
+        job.n_blobs = len(upload_futures)
+        return job
+
+
+class VideoJob:
+    """
+    The state of a video going through the indexing steps.
+    """
+    __slots__ = ('media_asset_url', 'video_id', 'prompt_content', 'n_blobs')
 
-        print('Data uploaded successfully!')
+    def __init__(self, media_asset_url: str):
+        self.media_asset_url = media_asset_url
+        self.video_id = None
+        self.prompt_content = None
+        self.n_blobs = 0
+
+    def __repr__(self):
+        return f'VideoJob({self.media_asset_url}, video_id={self.video_id})'
 
 
-def try_get_prompt(vi_client, video_id):
+def try_get_prompt(vi_client, video_id, completion_tracker=None):
     """
     Get the prompt content of the video if exists. Otherwise, create it and return the prompt content.
     :param vi_client:
     :param video_id: the video id
+    :param completion_tracker: the IndexingCompletionTracker to wait with, a private one when not given
     :return: prompt content dict.
     """
-    prompt_content = None
     prompt_content_response = vi_client.get_prompt_content(video_id)
-    if prompt_content_response is None or prompt_content_response.status != 200:
-        print(f'Failed to get prompt content for video: {video_id}')
-        vi_client.create_prompt_content(video_id)
-        prompt_content_response = vi_client.get_prompt_content(video_id)
-        while prompt_content_response is not None and prompt_content_response.status != 200:
-            time.sleep(15)
-            prompt_content = json.loads(prompt_content_response.read())
-    if prompt_content is None:
-        prompt_content = json.loads(prompt_content_response.read())
-    return prompt_content
+    if prompt_content_response is not None and prompt_content_response.status_code == 200:
+        return prompt_content_response.json()
 
+    print(f'Failed to get prompt content for video: {video_id}')
+    vi_client.create_prompt_content(video_id)
+    if completion_tracker is not None:
+        return completion_tracker.track_prompt_content(video_id).result()
+    with IndexingCompletionTracker(vi_client) as private_tracker:
+        return private_tracker.track_prompt_content(video_id).result()
 
-def extract_keyframes(vi_client, video_id, working_dir):
-    kf_video_id_to_zip, failed_video_ids = vi_client.download_keyframes([dict(id=video_id)], working_dir)
-
-    # unzip the file into a temp directory
-    temp_directory = kf_video_id_to_zip[video_id][:-4]
 
-    # os.system(f'unzip {temp_directory}.zip -d {temp_directory}')
-    # Create the extract directory if it doesn't exist
-    os.makedirs(temp_directory, exist_ok=True)
-
-    # Open the zip file
-    with zipfile.ZipFile(kf_video_id_to_zip[video_id], 'r') as zip_ref:
-        # Extract all the contents to the specified directory
-        zip_ref.extractall(temp_directory)
-    # upload images to Azure AI Search
-    return [os.path.join(temp_directory, fp) for fp in os.listdir(temp_directory) if fp.endswith('.jpg')]
+def extract_keyframes(vi_client, video_id, working_dir):
+    """
+    Stream the keyframes of a video out of its artifact zip, one at a time, without extracting it to disk.
+    :param vi_client: the Video Indexer client
+    :param video_id: the video id
+    :param working_dir: unused, the keyframes are not written to disk
+    :return: a generator of (keyframe file name, image bytes)
+    """
+    return vi_client.iter_keyframes(video_id)
 
 
 def main():
     config = load_config()
-    example_video = config['main']['demo_video_path']
-    semantic_search_indexer = SemanticSearchIndexer(config).index_media_file(example_video, config['main']['workingDir'])
     working_dir = config['main']['workingDir']
+    media_asset_urls = config['main'].get('media_asset_urls', [config['main']['demo_video_path']])
 
-    # index a video
-    semantic_search_indexer.index_media_file(example_video, working_dir)
+    # index the videos
+    with SemanticSearchIndexer(config) as semantic_search_indexer:
+        semantic_search_indexer.index_media_files(media_asset_urls, working_dir)
 
     # Initialize Search client
     search_client = SearchClient('YOUR_SERVICE_NAME', 'YOUR_INDEX_NAME', 'YOUR_ADMIN_KEY')
@@ -0,0 +1,134 @@
+import io
+import os
+import threading
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from artifact_downloader import ArtifactDownloader, content_range_start, is_valid_zip
+from http_session import HttpSession
+from throttling import RetryPolicy
+
+
+def make_zip(n_members: int = 8, member_bytes: int = 50_000) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zip_file:
+        for i in range(n_members):
+            zip_file.writestr(f'KeyFrame_{i}.jpg', os.urandom(member_bytes))
+    return data.getvalue()
+
+
+class ArtifactServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, artifact: bytes):
+        super().__init__(('127.0.0.1', 0), ArtifactHandler)
+        self.artifact = artifact
+        # the number of bytes the next full response is cut after, None to send it all
+        self.cut_after = None
+        # send a range starting at 0 whatever range was requested
+        self.ignore_range_start = False
+        self.ranges = []
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        artifact = self.server.artifact
+        requested_range = self.headers.get('Range')
+        self.server.ranges.append(requested_range)
+        start = 0
+        if requested_range is not None:
+            start = 0 if self.server.ignore_range_start else int(requested_range.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(artifact) - 1}/{len(artifact)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(artifact) - start))
+        self.end_headers()
+        if requested_range is None and self.server.cut_after is not None:
+            self.wfile.write(artifact[:self.server.cut_after])
+            self.server.cut_after = None
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(artifact[start:])
+
+
+@pytest.fixture
+def server():
+    server = ArtifactServer(make_zip())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(server):
+    url = f'http://127.0.0.1:{server.server_port}/artifact.zip'
+    http = HttpSession(pool_size=2)
+    yield ArtifactDownloader(http, lambda key: url, n_workers=2, chunk_size=16 * 1024,
+                             retry_policy=RetryPolicy(max_attempts=3, base_delay_secs=0.01))
+    http.close()
+
+
+def test_content_range_start():
+    assert content_range_start('bytes 1000-1999/2000') == 1000
+    assert content_range_start('bytes 0-9/*') == 0
+    assert content_range_start(None) is None
+    assert content_range_start('bytes */2000') is None
+
+
+def test_resumes_from_the_part_file(server, downloader, tmp_path):
+    path = str(tmp_path / 'video.zip')
+    with open(f'{path}.part', 'wb') as f:
+        f.write(server.artifact[:100_000])
+
+    assert downloader.download('video', path) == path
+    with open(path, 'rb') as f:
+        assert f.read() == server.artifact
+    assert server.ranges == ['bytes=100000-']
+    assert downloader.n_resumed == 1
+    assert downloader.n_bytes == len(server.artifact) - 100_000
+    assert not os.path.exists(f'{path}.part')
+
+
+def test_resumes_an_interrupted_transfer(server, downloader, tmp_path):
+    path = str(tmp_path / 'video.zip')
+    server.cut_after = 150_000
+
+    assert downloader.download('video', path) == path
+    assert is_valid_zip(path)
+    assert server.ranges[0] is None
+    assert server.ranges[-1].startswith('bytes=') and downloader.n_resumed == 1
+
+
+def test_restarts_when_the_content_range_does_not_match(server, downloader, tmp_path):
+    path = str(tmp_path / 'video.zip')
+    with open(f'{path}.part', 'wb') as f:
+        f.write(server.artifact[:100_000])
+    server.ignore_range_start = True
+
+    assert downloader.download('video', path) == path
+    with open(path, 'rb') as f:
+        assert f.read() == server.artifact
+    assert server.ranges == ['bytes=100000-', None]
+    assert downloader.n_resumed == 0
+
+
+def test_skips_a_valid_artifact_on_disk(server, downloader, tmp_path):
+    path = str(tmp_path / 'video.zip')
+    with open(path, 'wb') as f:
+        f.write(server.artifact)
+
+    paths, failed = downloader.download_all([('video', path)])
+    assert paths == dict(video=path) and failed == []
+    assert server.ranges == [] and downloader.n_skipped == 1
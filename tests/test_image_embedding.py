@@ -0,0 +1,104 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from image_embedding import EmbeddingCache, ImageEmbeddingStage, TinyImageEmbedder
+
+
+def make_jpegs(n_images: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(n_images):
+        image = Image.fromarray(rng.integers(0, 255, (48, 64, 3), dtype=np.uint8))
+        data = io.BytesIO()
+        image.save(data, 'JPEG', quality=90)
+        images.append((f'KeyFrame_{i}.jpg', data.getvalue()))
+    return images
+
+
+def embed(stage: ImageEmbeddingStage, images):
+    return np.stack([embedding for _, embedding in stage.embed(images)])
+
+
+def test_tiny_embedder_is_deterministic():
+    images = make_jpegs(5)
+    with ImageEmbeddingStage(TinyImageEmbedder(dim=32), batch_size=2) as first, \
+            ImageEmbeddingStage(TinyImageEmbedder(dim=32), batch_size=2, n_decode_workers=1) as second:
+        first_embeddings = embed(first, images)
+        second_embeddings = embed(second, images)
+    assert first_embeddings.shape == (5, 32)
+    assert np.array_equal(first_embeddings, second_embeddings)
+    assert np.allclose(np.linalg.norm(first_embeddings, axis=1), 1.0)
+
+
+def test_tiny_embedder_does_not_depend_on_the_batching():
+    images = make_jpegs(5)
+    with ImageEmbeddingStage(TinyImageEmbedder(), batch_size=1) as one_by_one, \
+            ImageEmbeddingStage(TinyImageEmbedder(), batch_size=5) as batched:
+        # the matrix product may round differently with the batch shape
+        assert np.allclose(embed(one_by_one, images), embed(batched, images), atol=1e-6)
+
+
+def test_tiny_embedder_seed_changes_the_projection():
+    images = make_jpegs(2)
+    with ImageEmbeddingStage(TinyImageEmbedder(seed=0)) as first, ImageEmbeddingStage(TinyImageEmbedder(seed=1)) as second:
+        assert not np.allclose(embed(first, images), embed(second, images))
+    assert TinyImageEmbedder(seed=0).name != TinyImageEmbedder(seed=1).name
+
+
+def test_embedding_cache_round_trip(tmp_path):
+    cache_path = str(tmp_path / 'embeddings.bin')
+    embeddings = {f'hash{i}': np.full(4, i, dtype=np.float32) for i in range(3)}
+    cache = EmbeddingCache('tiny', cache_path)
+    for content_hash, embedding in embeddings.items():
+        cache.put(content_hash, embedding)
+    cache.save()
+
+    reloaded = EmbeddingCache('tiny', cache_path)
+    assert len(reloaded) == 3
+    for content_hash, embedding in embeddings.items():
+        assert np.array_equal(reloaded.get(content_hash), embedding)
+    assert reloaded.get('missing') is None
+
+
+def test_embedding_cache_appends_only_the_new_embeddings(tmp_path):
+    cache_path = tmp_path / 'embeddings.bin'
+    cache = EmbeddingCache('tiny', str(cache_path))
+    cache.put('hash0', np.zeros(4, dtype=np.float32))
+    cache.save()
+    first_bytes = cache_path.read_bytes()
+    cache.put('hash0', np.zeros(4, dtype=np.float32))
+    cache.put('hash1', np.ones(4, dtype=np.float32))
+    assert cache.n_unsaved == 1
+    cache.save()
+
+    saved_bytes = cache_path.read_bytes()
+    assert saved_bytes.startswith(first_bytes)
+    # a record cut by an interrupted save is dropped
+    cache_path.write_bytes(saved_bytes + b'partial')
+    reloaded = EmbeddingCache('tiny', str(cache_path))
+    assert len(reloaded) == 2 and np.array_equal(reloaded.get('hash1'), np.ones(4))
+    assert cache_path.read_bytes() == saved_bytes
+
+
+def test_embedding_cache_ignores_another_embedder(tmp_path):
+    cache_path = str(tmp_path / 'embeddings.bin')
+    cache = EmbeddingCache('tiny', cache_path)
+    cache.put('hash', np.ones(4, dtype=np.float32))
+    cache.save()
+
+    assert len(EmbeddingCache('clip', cache_path)) == 0
+
+
+def test_stage_reuses_the_cached_embeddings(tmp_path):
+    cache_path = str(tmp_path / 'embeddings.bin')
+    images = make_jpegs(4)
+    with ImageEmbeddingStage(TinyImageEmbedder(), cache_path=cache_path) as first:
+        first_embeddings = embed(first, images)
+    assert first.stats() == dict(embedded=4, cached=0, cache_size=4)
+
+    with ImageEmbeddingStage(TinyImageEmbedder(), cache_path=cache_path) as second:
+        second_embeddings = embed(second, images)
+    assert second.stats() == dict(embedded=0, cached=4, cache_size=4)
+    assert np.array_equal(first_embeddings, second_embeddings)
@@ -0,0 +1,107 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from multipart_stream import MultipartFileStream
+
+
+class SinkServer(ThreadingHTTPServer):
+    """
+    Keeps the headers and the body of every request it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SinkHandler)
+        self.requests = []
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((dict(self.headers), body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def parse_multipart(content_type: str, body: bytes):
+    """
+    :return: the headers and the content of every part of a multipart/form-data body
+    """
+    boundary = content_type.split('boundary=')[1].encode()
+    first, *parts, last = body.split(b'--' + boundary)
+    assert first == b'' and last == b'--\r\n'
+    parsed = []
+    for part in parts:
+        assert part.startswith(b'\r\n') and part.endswith(b'\r\n')
+        headers, content = part[2:-2].split(b'\r\n\r\n', 1)
+        parsed.append((headers.decode(), content))
+    return parsed
+
+
+@pytest.fixture
+def sink():
+    server = SinkServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    path = tmp_path / 'chunk.ts'
+    # the boundary-like and CRLF bytes must go through untouched
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 17) + b'\r\n--\r\n')
+    return str(path)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_uploads_the_file_as_a_single_form_field(sink, video_file, use_mmap):
+    progress = []
+    with MultipartFileStream(video_file, field_name='file', use_mmap=use_mmap, show_progress=False,
+                             progress_callback=lambda sent, total, _: progress.append((sent, total))) as stream:
+        response = requests.post(f'http://127.0.0.1:{sink.server_port}/upload', data=stream,
+                                 headers={'Content-Type': stream.content_type})
+    assert response.status_code == 200
+
+    (headers, body), = sink.requests
+    assert int(headers['Content-Length']) == len(body) == stream.total_bytes
+    assert 'Transfer-Encoding' not in headers
+    (part_headers, content), = parse_multipart(headers['Content-Type'], body)
+    assert 'name="file"; filename="chunk.ts"' in part_headers
+    with open(video_file, 'rb') as f:
+        assert content == f.read()
+    assert progress[-1] == (stream.total_bytes, stream.total_bytes)
+
+
+def test_rewinding_resends_the_same_body(video_file):
+    with MultipartFileStream(video_file, use_mmap=True, show_progress=False) as stream:
+        first = stream.read(1000) + stream.read()
+        assert stream.read(10) == b''
+        stream.seek(0)
+        assert stream.tell() == 0
+        assert bytes(stream.read()) == first
+        with pytest.raises(ValueError):
+            stream.seek(10)
+
+
+def test_empty_file(sink, tmp_path):
+    path = tmp_path / 'empty.ts'
+    path.write_bytes(b'')
+    with MultipartFileStream(str(path), use_mmap=True, show_progress=False) as stream:
+        requests.post(f'http://127.0.0.1:{sink.server_port}/upload', data=stream,
+                      headers={'Content-Type': stream.content_type})
+
+    (headers, body), = sink.requests
+    (_, content), = parse_multipart(headers['Content-Type'], body)
+    assert content == b''
@@ -0,0 +1,129 @@
+"""
+Client side throttling for the Video Indexer API: an adaptive token bucket shared by all the calls of a wrapper, and a
+retry policy that treats throttling, expired tokens, transient and permanent failures differently.
+"""
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+OK = 'ok'
+THROTTLED = 'throttled'
+AUTH_EXPIRED = 'auth_expired'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+
+def classify_status(status_code) -> str:
+    """
+    Map a response status code to an error class, None stands for a request that failed without a response.
+    """
+    if status_code is None:
+        return TRANSIENT
+    if status_code < 400:
+        return OK
+    if status_code == 429:
+        return THROTTLED
+    if status_code == 401:
+        return AUTH_EXPIRED
+    if status_code == 408 or status_code >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header given either in seconds or as an HTTP date.
+    :return: the number of seconds to wait, None if the header is missing or malformed
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    A token bucket whose rate grows additively on successes and shrinks multiplicatively on throttling (AIMD), so the
+    callers converge to the account quota. A Retry-After pauses all the callers until it passes.
+    """
+    def __init__(self, requests_per_sec: float = 10.0, burst: int = None, min_requests_per_sec: float = 0.5,
+                 max_requests_per_sec: float = 50.0, increase_per_sec: float = 0.5, decrease_factor: float = 0.5):
+        self.rate = requests_per_sec
+        self.burst = burst or max(1, int(requests_per_sec))
+        self.min_rate = min_requests_per_sec
+        self.max_rate = max_requests_per_sec
+        self.increase_per_sec = increase_per_sec
+        self.decrease_factor = decrease_factor
+        self.n_throttled = 0
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Take a token, possibly in advance, and return how long the caller has to wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= 1
+            wait_secs = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait_secs, self._paused_until - now)
+
+    def acquire(self):
+        wait_secs = self._reserve()
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+
+    async def acquire_async(self):
+        wait_secs = self._reserve()
+        if wait_secs > 0:
+            await asyncio.sleep(wait_secs)
+
+    def on_success(self):
+        with self._lock:
+            # grows the rate by roughly increase_per_sec for every second of successful calls
+            self.rate = min(self.max_rate, self.rate + self.increase_per_sec / max(self.rate, 1.0))
+
+    def on_throttled(self, retry_after_secs: float = None):
+        with self._lock:
+            self.n_throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after_secs:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after_secs)
+
+
+class RetryPolicy:
+    """
+    How many times and how long to wait before retrying each error class.
+    """
+    def __init__(self, max_attempts: int = 6, base_delay_secs: float = 0.5, max_delay_secs: float = 60.0,
+                 max_auth_renewals: int = 1):
+        self.max_attempts = max_attempts
+        self.base_delay_secs = base_delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.max_auth_renewals = max_auth_renewals
+
+    def backoff_secs(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.max_delay_secs, self.base_delay_secs * 2 ** attempt))
+
+    def should_retry(self, error_class: str, attempt: int, n_auth_renewals: int) -> bool:
+        if error_class in (OK, PERMANENT) or attempt + 1 >= self.max_attempts:
+            return False
+        if error_class == AUTH_EXPIRED:
+            return n_auth_renewals < self.max_auth_renewals
+        return True
@@ -0,0 +1,117 @@
+"""
+Downloads face thumbnails concurrently, bounded per video and across the whole account.
+The ids already on disk are listed once into an in-memory set instead of checking every file, and every thumbnail is
+written to a temp file that is renamed into place, so an interrupted run never leaves a truncated image behind.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+class ThumbnailFetcher:
+    def __init__(self, get_thumbnail, target_folder_path: str, max_in_flight: int = 16, max_per_video: int = 4):
+        """
+        :param get_thumbnail: returns the image bytes of (video_id, thumbnail_id), None on failure. The requests share
+            the caller's token, which a single worker renews when it expires.
+        :param target_folder_path: where the {thumbnail_id}.jpg files are written
+        :param max_in_flight: the maximal number of concurrent downloads across all the videos
+        :param max_per_video: the maximal number of concurrent downloads of a single video
+        """
+        self.get_thumbnail = get_thumbnail
+        self.target_folder_path = target_folder_path
+        self.max_per_video = max_per_video
+        os.makedirs(target_folder_path, exist_ok=True)
+        self.downloaded_ids = {entry.name[:-len('.jpg')] for entry in os.scandir(target_folder_path)
+                               if entry.is_file() and entry.name.endswith('.jpg')}
+        self.n_downloaded = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # the slots of the videos with downloads in flight and their number of downloads
+        self._video_slots = dict()
+        self._video_n_pending = dict()
+        # the future of every thumbnail being downloaded, shared by all the callers asking for it
+        self._pending = dict()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def thumbnail_path(self, thumbnail_id: str) -> str:
+        return os.path.join(self.target_folder_path, f'{thumbnail_id}.jpg')
+
+    def submit(self, video_id: str, thumbnail_ids):
+        """
+        Start downloading the thumbnails that are not on disk yet, blocking while the video or the account is at its
+        concurrency bound.
+        :return: the futures of the thumbnail paths, None for the failed ones, including those of the thumbnails
+            another call is already downloading
+        """
+        futures = []
+        for thumbnail_id in thumbnail_ids:
+            with self._lock:
+                if thumbnail_id in self.downloaded_ids:
+                    continue
+                if thumbnail_id in self._pending:
+                    futures.append(self._pending[thumbnail_id])
+                    continue
+                future = self._pending[thumbnail_id] = Future()
+                video_slots = self._video_slots.get(video_id)
+                if video_slots is None:
+                    video_slots = self._video_slots[video_id] = threading.BoundedSemaphore(self.max_per_video)
+                self._video_n_pending[video_id] = self._video_n_pending.get(video_id, 0) + 1
+            video_slots.acquire()
+            self._slots.acquire()
+            self._executor.submit(self._fetch, video_id, thumbnail_id, video_slots, future)
+            futures.append(future)
+        return futures
+
+    def fetch(self, video_id: str, thumbnail_ids):
+        """
+        Download the thumbnails of a video that are not on disk yet.
+        :return: the paths of the video's thumbnails on disk
+        """
+        wait(self.submit(video_id, thumbnail_ids))
+        return [self.thumbnail_path(thumbnail_id) for thumbnail_id in thumbnail_ids
+                if thumbnail_id in self.downloaded_ids]
+
+    def _fetch(self, video_id: str, thumbnail_id: str, video_slots, future: Future):
+        file_path = self.thumbnail_path(thumbnail_id)
+        try:
+            image = self.get_thumbnail(video_id, thumbnail_id)
+            if image is not None:
+                temp_path = f'{file_path}.part'
+                with open(temp_path, 'wb') as f:
+                    f.write(image)
+                os.replace(temp_path, file_path)
+        except Exception as e:
+            print(e)
+            image = None
+        with self._lock:
+            del self._pending[thumbnail_id]
+            if image is None:
+                self.n_failed += 1
+            else:
+                self.downloaded_ids.add(thumbnail_id)
+                self.n_downloaded += 1
+            # the slots of a video are dropped with its last download
+            self._video_n_pending[video_id] -= 1
+            if self._video_n_pending[video_id] == 0:
+                del self._video_n_pending[video_id]
+                del self._video_slots[video_id]
+        video_slots.release()
+        self._slots.release()
+        if image is None:
+            print(f'Failed to download thumbnail {thumbnail_id} for video {video_id}')
+        future.set_result(None if image is None else file_path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(downloaded=self.n_downloaded, failed=self.n_failed, on_disk=len(self.downloaded_ids),
+                        pending=len(self._pending))
+
+    def close(self, wait_for_pending: bool = True):
+        self._executor.shutdown(wait=wait_for_pending)
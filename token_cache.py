@@ -0,0 +1,86 @@
+"""
+Access token lifetime helpers: read a token's expiry, persist tokens between short-lived runs and refresh them ahead of
+their expiry on a background thread.
+"""
+import base64
+import json
+import os
+import threading
+import time
+
+
+def jwt_expires_on(token: str, default_lifetime_secs: float = 3600) -> float:
+    """
+    Read the 'exp' claim of a JWT without validating it.
+    :param token: the JWT, optionally prefixed with 'Bearer '
+    :param default_lifetime_secs: the lifetime to assume from now when the token cannot be decoded
+    :return: the expiry as a POSIX timestamp
+    """
+    try:
+        payload = token.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_lifetime_secs
+
+
+class TokenCache:
+    """
+    A JSON file of access tokens keyed by account, readable by the current user only.
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+
+    def _read_all(self) -> dict:
+        if not os.path.isfile(self.cache_path):
+            return dict()
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Ignoring unreadable token cache {self.cache_path}: {e}')
+            return dict()
+
+    def load(self, key: str, min_ttl_secs: float = 0):
+        """
+        :return: a (token, expires_on) tuple, None if there is no token that stays valid for min_ttl_secs
+        """
+        entry = self._read_all().get(key)
+        if entry is None or entry['expires_on'] - min_ttl_secs <= time.time():
+            return None
+        return entry['token'], entry['expires_on']
+
+    def save(self, key: str, token: str, expires_on: float):
+        entries = self._read_all()
+        entries[key] = dict(token=token, expires_on=expires_on)
+        temp_path = f'{self.cache_path}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.cache_path)
+
+
+class BackgroundRefresher:
+    """
+    A daemon thread that calls refresh() once next_refresh_at() is reached, and retries failures after a short delay.
+    """
+    def __init__(self, refresh, next_refresh_at, retry_delay_secs: float = 30):
+        self.refresh = refresh
+        self.next_refresh_at = next_refresh_at
+        self.retry_delay_secs = retry_delay_secs
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(max(0.0, self.next_refresh_at() - time.time())):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'Background token refresh failed: {e}')
+                self._stop_event.wait(self.retry_delay_secs)
@@ -0,0 +1,206 @@
+"""
+Cuts a continuous MPEG-TS byte stream, e.g. streamlink writing to stdout, into fixed-duration .ts files.
+Cuts happen on 188-byte packet boundaries at a random access point of the video once the segment duration elapsed in
+stream time (PCR), and every segment starts with the latest PAT and PMT so it can be decoded on its own.
+"""
+import os
+import time
+from datetime import datetime
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+PCR_CLOCK_HZ = 27000000
+PCR_WRAP = (1 << 33) * 300
+# MPEG-1/2, MPEG-4 part 2, H.264, HEVC, CAVS, AVS2 and VC-1 video
+VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1B, 0x24, 0x42, 0xD2, 0xEA}
+
+
+def _parse_pcr(packet):
+    """
+    :return: the packet's PCR in 27MHz ticks and whether it is a random access point
+    """
+    adaptation_field_control = (packet[3] >> 4) & 0x3
+    if not adaptation_field_control & 0x2 or packet[4] == 0:
+        return None, False
+    flags = packet[5]
+    random_access = bool(flags & 0x40)
+    if not flags & 0x10 or packet[4] < 7:
+        return None, random_access
+    pcr_base = (packet[6] << 25) | (packet[7] << 17) | (packet[8] << 9) | (packet[9] << 1) | (packet[10] >> 7)
+    pcr_extension = ((packet[10] & 0x1) << 8) | packet[11]
+    return pcr_base * 300 + pcr_extension, random_access
+
+
+def _payload(packet):
+    adaptation_field_control = (packet[3] >> 4) & 0x3
+    if not adaptation_field_control & 0x1:
+        return b''
+    if adaptation_field_control & 0x2:
+        return packet[5 + packet[4]:]
+    return packet[4:]
+
+
+def _parse_pat_pmt_pids(packet):
+    """
+    :return: the PMT PIDs listed in a PAT packet whose section fits in the packet
+    """
+    payload = _payload(packet)
+    if not payload:
+        return set()
+    section = payload[1 + payload[0]:]
+    if len(section) < 8:
+        return set()
+    section_length = ((section[1] & 0x0F) << 8) | section[2]
+    # skip the 8-byte header, stop before the CRC32
+    programs = section[8:min(len(section), 3 + section_length) - 4]
+    pmt_pids = set()
+    for offset in range(0, len(programs) - 3, 4):
+        program_number = (programs[offset] << 8) | programs[offset + 1]
+        if program_number != 0:
+            pmt_pids.add(((programs[offset + 2] & 0x1F) << 8) | programs[offset + 3])
+    return pmt_pids
+
+
+def _parse_pmt_pids(packet):
+    """
+    :return: the PCR PID and the video PIDs listed in a PMT packet whose section fits in the packet, None and an empty
+        set when it does not parse
+    """
+    payload = _payload(packet)
+    if not payload:
+        return None, set()
+    section = payload[1 + payload[0]:]
+    if len(section) < 12:
+        return None, set()
+    section_length = ((section[1] & 0x0F) << 8) | section[2]
+    pcr_pid = ((section[8] & 0x1F) << 8) | section[9]
+    program_info_length = ((section[10] & 0x0F) << 8) | section[11]
+    # skip the 12-byte header and the program descriptors, stop before the CRC32
+    streams = section[12 + program_info_length:min(len(section), 3 + section_length) - 4]
+    video_pids = set()
+    offset = 0
+    while offset + 5 <= len(streams):
+        if streams[offset] in VIDEO_STREAM_TYPES:
+            video_pids.add(((streams[offset + 1] & 0x1F) << 8) | streams[offset + 2])
+        offset += 5 + (((streams[offset + 3] & 0x0F) << 8) | streams[offset + 4])
+    return pcr_pid, video_pids
+
+
+class TsSegmenter:
+    """
+    Writes the fed TS packets into consecutive segment files of about segment_secs each.
+    """
+    def __init__(self, output_folder: str, segment_secs: float, on_segment=None):
+        """
+        :param output_folder: where the segments are written
+        :param segment_secs: the target segment duration
+        :param on_segment: called with (segment_path, duration_secs) once a segment is complete
+        """
+        self.output_folder = output_folder
+        self.segment_secs = segment_secs
+        self.on_segment = on_segment
+        self.n_segments = 0
+        self._buffer = bytearray()
+        self._pat_packet = None
+        self._pmt_pids = set()
+        self._pmt_packets = dict()
+        # the PIDs whose random access points are cut points by PMT PID: the video ones, else the PCR one
+        self._random_access_pids = dict()
+        self._file = None
+        self._part_path = None
+        self._segment_start_pcr = None
+        self._segment_start_time = None
+        self._last_pcr = None
+        self._seen_random_access = False
+
+    def consume(self, stream, read_size: int = TS_PACKET_SIZE * 1024):
+        """
+        Segment a binary stream until it ends, then complete the last segment.
+        """
+        try:
+            while True:
+                data = stream.read(read_size)
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            self.close()
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        offset = 0
+        while len(self._buffer) - offset >= TS_PACKET_SIZE:
+            if self._buffer[offset] != SYNC_BYTE:
+                # lost sync, skip to the next sync byte
+                next_sync = self._buffer.find(SYNC_BYTE, offset + 1)
+                offset = next_sync if next_sync >= 0 else len(self._buffer)
+                continue
+            self._on_packet(bytes(self._buffer[offset:offset + TS_PACKET_SIZE]))
+            offset += TS_PACKET_SIZE
+        del self._buffer[:offset]
+
+    def _on_packet(self, packet: bytes):
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        payload_unit_start = bool(packet[1] & 0x40)
+        if pid == PAT_PID and payload_unit_start:
+            self._pat_packet = packet
+            self._pmt_pids = _parse_pat_pmt_pids(packet)
+        elif pid in self._pmt_pids and payload_unit_start:
+            self._pmt_packets[pid] = packet
+            pcr_pid, video_pids = _parse_pmt_pids(packet)
+            if video_pids or pcr_pid is not None:
+                self._random_access_pids[pid] = video_pids or {pcr_pid}
+
+        pcr, random_access = _parse_pcr(packet)
+        # e.g. every audio frame is flagged as a random access point, cutting there would start without a key frame.
+        # Streams without a PMT are cut on the random access points of any PID.
+        if random_access and self._random_access_pids:
+            random_access = any(pid in pids for pids in self._random_access_pids.values())
+        self._seen_random_access |= random_access
+        if pcr is not None:
+            self._last_pcr = pcr
+        # streams that never flag random access points are cut on any payload start
+        cut_point = random_access or (not self._seen_random_access and payload_unit_start)
+        if self._file is None or (cut_point and self._elapsed_secs() >= self.segment_secs):
+            # a PAT starting the segment makes repeating the cached tables redundant
+            self._start_segment(repeat_tables=pid != PAT_PID)
+        if pcr is not None and self._segment_start_pcr is None:
+            self._segment_start_pcr = pcr
+        self._file.write(packet)
+
+    def _elapsed_secs(self) -> float:
+        """
+        The segment duration in stream time, or in wall-clock time for streams without PCR
+        """
+        if self._segment_start_pcr is None or self._last_pcr is None:
+            return time.monotonic() - self._segment_start_time
+        return ((self._last_pcr - self._segment_start_pcr) % PCR_WRAP) / PCR_CLOCK_HZ
+
+    def _start_segment(self, repeat_tables: bool = True):
+        self._complete_segment()
+        now_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self._part_path = os.path.join(self.output_folder, f'{now_str}_{self.n_segments:06d}.ts.part')
+        self._file = open(self._part_path, 'wb')
+        self._segment_start_time = time.monotonic()
+        self._segment_start_pcr = self._last_pcr
+        if repeat_tables and self._pat_packet is not None:
+            self._file.write(self._pat_packet)
+            for pmt_packet in self._pmt_packets.values():
+                self._file.write(pmt_packet)
+
+    def _complete_segment(self):
+        if self._file is None:
+            return
+        duration_secs = self._elapsed_secs()
+        self._file.close()
+        self._file = None
+        # the segment appears under its final name only once complete
+        segment_path = self._part_path[:-len('.part')]
+        os.replace(self._part_path, segment_path)
+        self.n_segments += 1
+        if self.on_segment is not None:
+            self.on_segment(segment_path, duration_secs)
+
+    def close(self):
+        self._complete_segment()
@@ -0,0 +1,307 @@
+"""
+A local vector index over segment embeddings, e.g. the content_vector of VideoSegmentIndex, for offline evaluation and
+low-latency re-ranking without a round trip to Azure AI Search.
+The vectors live in one contiguous float32 matrix. Search is exact by default, scoring query batches against blocks
+of rows, and approximate once an IVF (inverted file) partition was trained: only the rows of the nprobe clusters
+closest to a query are scored.
+"""
+import json
+import os
+import numpy as np
+
+METRICS = ('cosine', 'dot')
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k_rows(scores: np.ndarray, top_k: int):
+    """
+    :param scores: a (n_queries, n_candidates) score matrix
+    :return: the column indices of the top k scores per query in descending score order, and the scores
+    """
+    if scores.shape[1] > top_k:
+        columns = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, columns, axis=1)
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def _save_npy(path: str, array: np.ndarray):
+    """
+    Write the array next to path and move it over path, so an index memory-mapped from path is never overwritten
+    while it is being read.
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+
+class LocalVectorIndex:
+    """
+    Maps ids, e.g. (video_id, segment_id) tuples, to vectors. Adding an existing id replaces its vector, deleted rows
+    are masked out until compact() reclaims them.
+    """
+    def __init__(self, dim: int, metric: str = 'cosine', initial_capacity: int = 1024,
+                 block_rows: int = 65536):
+        """
+        :param dim: the vector dimension
+        :param metric: 'cosine' or 'dot'. Cosine vectors are normalized once when added.
+        :param initial_capacity: the number of preallocated rows, the matrix doubles when full
+        :param block_rows: the number of rows scored at once by the exact search, which bounds its memory
+        """
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric: {metric}, expected one of {METRICS}')
+        self.dim = dim
+        self.metric = metric
+        self.block_rows = block_rows
+        self._vectors = np.empty((max(initial_capacity, 1), dim), dtype=np.float32)
+        self._alive = np.zeros(len(self._vectors), dtype=bool)
+        self._ids = []
+        self._row_by_id = dict()
+        self._n_rows = 0
+        # IVF state: the centroids, the cluster of every row and the rows of every cluster
+        self._centroids = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._cluster_rows = None
+        self._cluster_rows_dirty = False
+
+    def __len__(self):
+        return len(self._row_by_id)
+
+    def __contains__(self, item_id):
+        return item_id in self._row_by_id
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    @classmethod
+    def from_segments(cls, segments, metric: str = 'cosine'):
+        """
+        Index a SegmentTable, or VideoSegmentIndex objects or their dicts, by (video_id, segment_id).
+        """
+        if hasattr(segments, 'vectors'):
+            index = cls(dim=segments.dim, metric=metric, initial_capacity=len(segments))
+            index.add(segments.keys(), segments.vectors)
+            return index
+        segments = [segment if isinstance(segment, dict) else segment.to_dict() for segment in segments]
+        vectors = np.asarray([segment['content_vector'] for segment in segments], dtype=np.float32)
+        index = cls(dim=vectors.shape[1], metric=metric, initial_capacity=len(segments))
+        index.add([(segment['video_id'], segment['segment_id']) for segment in segments], vectors)
+        return index
+
+    def add(self, ids, vectors):
+        """
+        Add or replace vectors.
+        :param ids: one id per vector
+        :param vectors: a (n, dim) array-like
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = list(ids)
+        if len(ids) != len(vectors):
+            raise ValueError(f'Got {len(ids)} ids for {len(vectors)} vectors')
+        # the last occurrence of a repeated id wins
+        last_position = {item_id: position for position, item_id in enumerate(ids)}
+        if len(last_position) != len(ids):
+            positions = sorted(last_position.values())
+            ids = [ids[position] for position in positions]
+            vectors = vectors[positions]
+        self.delete([item_id for item_id in ids if item_id in self._row_by_id])
+        if self.metric == 'cosine':
+            vectors = _normalize_rows(vectors)
+        self._reserve(self._n_rows + len(vectors))
+        rows = slice(self._n_rows, self._n_rows + len(vectors))
+        self._vectors[rows] = vectors
+        self._alive[rows] = True
+        for row, item_id in enumerate(ids, start=self._n_rows):
+            self._row_by_id[item_id] = row
+        self._ids.extend(ids)
+        if self.is_trained:
+            self._assignments = np.concatenate([self._assignments, self._assign(vectors)])
+            self._cluster_rows_dirty = True
+        self._n_rows += len(vectors)
+
+    def delete(self, ids):
+        """
+        :return: the number of deleted ids, unknown ids are ignored
+        """
+        n_deleted = 0
+        for item_id in ids:
+            row = self._row_by_id.pop(item_id, None)
+            if row is not None:
+                self._alive[row] = False
+                n_deleted += 1
+        return n_deleted
+
+    def compact(self):
+        """
+        Drop the deleted rows from the matrix.
+        """
+        alive_rows = np.flatnonzero(self._alive[:self._n_rows])
+        if len(alive_rows) == self._n_rows:
+            return
+        self._vectors = np.ascontiguousarray(self._vectors[alive_rows])
+        self._alive = np.ones(len(alive_rows), dtype=bool)
+        self._ids = [self._ids[row] for row in alive_rows]
+        self._row_by_id = {item_id: row for row, item_id in enumerate(self._ids)}
+        self._n_rows = len(alive_rows)
+        if self.is_trained:
+            self._assignments = self._assignments[alive_rows]
+            self._cluster_rows_dirty = True
+
+    def _reserve(self, n_rows: int):
+        if n_rows <= len(self._vectors):
+            return
+        capacity = max(n_rows, 2 * len(self._vectors))
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self._n_rows] = self._vectors[:self._n_rows]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._n_rows] = self._alive[:self._n_rows]
+        self._vectors, self._alive = vectors, alive
+
+    def train_ivf(self, n_clusters: int = None, n_iterations: int = 10, sample_size: int = 65536, seed: int = 0):
+        """
+        Partition the vectors with k-means so search can scan only the clusters closest to a query. Vectors added
+        later are assigned to the trained clusters, retrain once the data drifted.
+        :param n_clusters: the number of clusters, sqrt(n) by default
+        :param n_iterations: the number of k-means iterations
+        :param sample_size: the number of vectors the centroids are trained on
+        :param seed: the random seed of the sampling and of the initial centroids
+        """
+        alive_rows = np.flatnonzero(self._alive[:self._n_rows])
+        if len(alive_rows) == 0:
+            raise ValueError('Cannot train an IVF partition of an empty index')
+        n_clusters = min(n_clusters or max(1, int(np.sqrt(len(alive_rows)))), len(alive_rows))
+        rng = np.random.default_rng(seed)
+        sample = self._vectors[rng.choice(alive_rows, min(sample_size, len(alive_rows)), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+        for _ in range(n_iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assignments, minlength=n_clusters)
+            # sum the members of every cluster in one pass over the sample sorted by cluster,
+            # empty clusters keep their previous centroid
+            order = np.argsort(assignments, kind='stable')
+            non_empty = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids[non_empty] = sums / counts[non_empty, None]
+            if self.metric == 'cosine':
+                centroids = _normalize_rows(centroids)
+        self._centroids = centroids.astype(np.float32)
+        self._assignments = self._assign(self._vectors[:self._n_rows])
+        self._cluster_rows_dirty = True
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), self.block_rows):
+            block = vectors[start:start + self.block_rows]
+            assignments[start:start + len(block)] = np.argmax(block @ self._centroids.T, axis=1)
+        return assignments
+
+    def _get_cluster_rows(self):
+        if self._cluster_rows_dirty or self._cluster_rows is None:
+            order = np.argsort(self._assignments, kind='stable')
+            bounds = np.searchsorted(self._assignments[order], np.arange(len(self._centroids) + 1))
+            self._cluster_rows = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+            self._cluster_rows_dirty = False
+        return self._cluster_rows
+
+    def _prepare_queries(self, queries) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return _normalize_rows(queries) if self.metric == 'cosine' else queries
+
+    def search(self, queries, top_k: int = 10, nprobe: int = None, exact: bool = None):
+        """
+        :param queries: a query vector or a (n_queries, dim) batch of them
+        :param top_k: the number of results per query
+        :param nprobe: the number of closest clusters scanned by the approximate search
+        :param exact: force the exact search, the default when no IVF partition was trained
+        :return: a list of [(id, score)] per query in descending score order
+        """
+        queries = self._prepare_queries(queries)
+        if exact or (exact is None and not self.is_trained):
+            rows, scores = self._search_exact(queries, top_k)
+        else:
+            rows, scores = self._search_ivf(queries, top_k, nprobe or 8)
+        return [[(self._ids[row], float(score)) for row, score in zip(query_rows, query_scores)
+                 if score != -np.inf]
+                for query_rows, query_scores in zip(rows, scores)]
+
+    def _search_exact(self, queries: np.ndarray, top_k: int):
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, self._n_rows, self.block_rows):
+            stop = min(start + self.block_rows, self._n_rows)
+            scores = queries @ self._vectors[start:stop].T
+            scores[:, ~self._alive[start:stop]] = -np.inf
+            columns, scores = _top_k_rows(scores, top_k)
+            # merge the block's top k into the running top k
+            best_rows = np.concatenate([best_rows, columns + start], axis=1)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            columns, best_scores = _top_k_rows(best_scores, top_k)
+            best_rows = np.take_along_axis(best_rows, columns, axis=1)
+        return best_rows, best_scores
+
+    def _search_ivf(self, queries: np.ndarray, top_k: int, nprobe: int):
+        cluster_rows = self._get_cluster_rows()
+        nprobe = min(nprobe, len(self._centroids))
+        probed_clusters, _ = _top_k_rows(queries @ self._centroids.T, nprobe)
+        results_rows, results_scores = [], []
+        for query, clusters in zip(queries, probed_clusters):
+            rows = np.concatenate([cluster_rows[cluster] for cluster in clusters])
+            rows = rows[self._alive[rows]]
+            scores = (self._vectors[rows] @ query)[None, :]
+            columns, scores = _top_k_rows(scores, top_k)
+            query_rows = rows[columns[0]]
+            query_scores = scores[0]
+            # pad so the batch stays rectangular when the probed clusters hold fewer than top_k rows
+            n_missing = top_k - len(query_rows)
+            results_rows.append(np.pad(query_rows, (0, n_missing)))
+            results_scores.append(np.pad(query_scores, (0, n_missing), constant_values=-np.inf))
+        return results_rows, results_scores
+
+    def save(self, folder: str):
+        """
+        Write the live vectors as .npy files that load() can memory-map. Every file is written to a temporary file
+        first and then replaces the previous one, so saving over the folder the index was memory-mapped from is safe.
+        """
+        self.compact()
+        os.makedirs(folder, exist_ok=True)
+        _save_npy(os.path.join(folder, 'vectors.npy'), self._vectors[:self._n_rows])
+        if self.is_trained:
+            _save_npy(os.path.join(folder, 'centroids.npy'), self._centroids)
+            _save_npy(os.path.join(folder, 'assignments.npy'), self._assignments)
+        temp_path = os.path.join(folder, 'index.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(dict(dim=self.dim, metric=self.metric, ids=self._ids), f)
+        os.replace(temp_path, os.path.join(folder, 'index.json'))
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool = True):
+        """
+        :param mmap: memory-map the vectors read-only instead of reading them, the pages are loaded on demand.
+            Adding vectors copies the matrix into memory.
+        """
+        with open(os.path.join(folder, 'index.json'), 'r') as f:
+            metadata = json.load(f)
+        index = cls(dim=metadata['dim'], metric=metadata['metric'])
+        mmap_mode = 'r' if mmap else None
+        index._vectors = np.load(os.path.join(folder, 'vectors.npy'), mmap_mode=mmap_mode)
+        index._n_rows = len(index._vectors)
+        index._alive = np.ones(index._n_rows, dtype=bool)
+        # JSON turns the (video_id, segment_id) tuples into lists
+        index._ids = [tuple(item_id) if isinstance(item_id, list) else item_id for item_id in metadata['ids']]
+        index._row_by_id = {item_id: row for row, item_id in enumerate(index._ids)}
+        centroids_path = os.path.join(folder, 'centroids.npy')
+        if os.path.isfile(centroids_path):
+            index._centroids = np.load(centroids_path)
+            index._assignments = np.load(os.path.join(folder, 'assignments.npy'))
+            index._cluster_rows_dirty = True
+        return index
@@ -1,21 +1,42 @@
 import os
+import threading
 import time
-import urllib.request
 import json
+from concurrent.futures import wait
 from typing import List
 
-import requests
 from tqdm import tqdm
-import urllib.parse
 from azure.identity.aio import DefaultAzureCredential
 import asyncio
+import aiohttp
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+
+from artifact_downloader import ArtifactDownloader
+from http_session import HttpSession
+from job_manifest import JobManifest
+from keyframe_reader import iter_zip_members
+from multipart_stream import MultipartFileStream
+from token_cache import TokenCache, BackgroundRefresher, jwt_expires_on
+from thumbnail_fetcher import ThumbnailFetcher
+from throttling import AdaptiveRateLimiter, RetryPolicy, classify_status, parse_retry_after, OK, THROTTLED, \
+    AUTH_EXPIRED, TRANSIENT, PERMANENT
+
+# the stages of the face impression crawl in the job manifest
+FACE_IMPRESSIONS_STAGE = 'face_impressions'
+FACE_THUMBNAILS_STAGE = 'face_thumbnails'
 
 
 class VideoIndexerWrapper:
-    def __init__(self, location=None, account_id=None, subscription_id=None, api_version=None, account_name=None, resource_group_name=None, azure_tenant_id=None):
+    def __init__(self, location=None, account_id=None, subscription_id=None, api_version=None, account_name=None, resource_group_name=None, azure_tenant_id=None,
+                 pool_size=10, connect_timeout_secs=5, read_timeout_secs=60, keep_alive=True,
+                 requests_per_sec=10, max_requests_per_sec=50, max_attempts=6,
+                 token_refresh_margin_secs=300, token_cache_path=None, background_token_refresh=True,
+                 api_url='https://api.videoindexer.ai', management_url='https://management.azure.com'):
         self.azure_access_token = None
+        self.azure_token_expires_on = 0
         self.vi_access_token = None
-        self.sleep_time_secs = 0
+        self.vi_token_expires_on = 0
         self.location = location
         self.account_id = account_id
         self.subscription_id = subscription_id
@@ -23,16 +44,44 @@ class VideoIndexerWrapper:
         self.account_name = account_name
         self.resource_group_name = resource_group_name
         self.azure_tenant_id = azure_tenant_id
-        self.get_azure_access_token()
-        self.get_vi_access_token()
+        self.api_url = api_url
+        self.management_url = management_url
+
+        # one keep-alive connection pool shared by all the calls of this wrapper
+        self.http = HttpSession(pool_size=pool_size, connect_timeout_secs=connect_timeout_secs,
+                                read_timeout_secs=read_timeout_secs, keep_alive=keep_alive)
+
+        # one token bucket shared by all the calls so the wrapper runs as close as possible to the account quota
+        self.rate_limiter = AdaptiveRateLimiter(requests_per_sec=requests_per_sec,
+                                                max_requests_per_sec=max_requests_per_sec)
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts)
+
+        # tokens are refreshed ahead of their expiry, and optionally cached on disk between short-lived runs
+        self.token_refresh_margin_secs = token_refresh_margin_secs
+        self.token_cache = TokenCache(token_cache_path) if token_cache_path else None
+        self._token_lock = threading.Lock()
+        self._thumbnail_fetchers = dict()
+        self._thumbnail_fetchers_lock = threading.Lock()
+        cached_vi_token = None
+        if self.token_cache is not None:
+            cached_vi_token = self.token_cache.load(self._token_cache_key(), token_refresh_margin_secs)
+        if cached_vi_token is not None:
+            self.vi_access_token, self.vi_token_expires_on = cached_vi_token
+        else:
+            self.renew_access_tokens(force=True)
+        self.token_refresher = None
+        if background_token_refresh:
+            self.token_refresher = BackgroundRefresher(
+                self.renew_access_tokens, lambda: self.vi_token_expires_on - self.token_refresh_margin_secs)
+            self.token_refresher.start()
 
     async def get_azure_access_token_async(self):
         # Azure credentials
-        credential = DefaultAzureCredential()
-
-        # get azure access token from async method
-        token = await credential.get_token("https://management.azure.com/.default", tenant_id=self.azure_tenant_id)
+        async with DefaultAzureCredential() as credential:
+            # get azure access token from async method
+            token = await credential.get_token("https://management.azure.com/.default", tenant_id=self.azure_tenant_id)
         self.azure_access_token = f"Bearer {token.token}"
+        self.azure_token_expires_on = token.expires_on
 
     def get_azure_access_token(self):
         asyncio.run(self.get_azure_access_token_async())
@@ -44,7 +93,7 @@ class VideoIndexerWrapper:
             'Authorization': self.azure_access_token
         }
 
-        url = f"https://management.azure.com/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group_name}/providers/Microsoft.VideoIndexer/accounts/{self.account_name}/generateAccessToken?api-version={self.api_version}"
+        url = f"{self.management_url}/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group_name}/providers/Microsoft.VideoIndexer/accounts/{self.account_name}/generateAccessToken?api-version={self.api_version}"
 
         # adding body
         body = {
@@ -52,43 +101,128 @@ class VideoIndexerWrapper:
             "scope": "Account"
         }
 
-        body = json.dumps(body)
-        body = body.encode('utf-8')
-        req = urllib.request.Request(url, data=body, headers=hdr, method='POST')
-        req.get_method = lambda: 'POST'
-        response = urllib.request.urlopen(req)
-        response_access_token_bytes = response.read()
-        response_access_token = json.loads(response_access_token_bytes.decode())
-        access_token = response_access_token["accessToken"]
+        response = self.http.request('POST', url, operation='generateAccessToken', json=body, headers=hdr)
+        response.raise_for_status()
+        access_token = response.json()["accessToken"]
         self.vi_access_token = access_token
+        self.vi_token_expires_on = jwt_expires_on(access_token)
         return
 
-    def renew_access_tokens(self):
-        self.get_azure_access_token()
-        self.get_vi_access_token()
+    def _token_cache_key(self):
+        return f'{self.location}/{self.account_id}'
+
+    def renew_access_tokens(self, stale_vi_access_token=None, force=False):
+        """
+        Renew the tokens that are about to expire. Concurrent callers share a single renewal: a caller whose token was
+        already replaced while it waited for the renewal lock returns without renewing again.
+        :param stale_vi_access_token: the VI access token the caller found invalid
+        :param force: renew both tokens even if they are not about to expire
+        :return: None
+        """
+        with self._token_lock:
+            if stale_vi_access_token is not None and stale_vi_access_token != self.vi_access_token:
+                return
+            refresh_before = time.time() + self.token_refresh_margin_secs
+            if not force and stale_vi_access_token is None and self.vi_token_expires_on > refresh_before:
+                return
+            if force or stale_vi_access_token is not None or self.azure_token_expires_on <= refresh_before:
+                self.get_azure_access_token()
+            self.get_vi_access_token()
+            if self.token_cache is not None:
+                self.token_cache.save(self._token_cache_key(), self.vi_access_token, self.vi_token_expires_on)
+
+    def _vi_request(self, method, path, operation, params=None, idempotent=None, **kwargs):
+        """
+        Send a request to the Video Indexer account API through the shared connection pool.
+        Every attempt waits for the shared rate limiter. Throttled and transient failures are retried with backoff,
+        an expired access token is renewed and permanent failures are returned as is.
+        :param method: the HTTP method
+        :param path: the path under the account, e.g. Videos/{video_id}/Index
+        :param operation: the name to aggregate the call latency under
+        :param params: query parameters, the access token is added to them
+        :param idempotent: whether the request can be sent again once the service may have processed it, by default
+            all but POSTs. A non-idempotent request, e.g. a video upload, is only retried when it was throttled, its
+            token expired or the connection could not be opened; a server error or a connection lost after sending
+            it is returned or raised, so it is not processed twice.
+        :return: the response
+        """
+        url = f"{self.api_url}/{self.location}/Accounts/{self.account_id}/{path}"
+        if idempotent is None:
+            idempotent = method != 'POST'
+        n_auth_renewals = 0
+        for attempt in range(self.retry_policy.max_attempts):
+            self.rate_limiter.acquire()
+            # the token may have been renewed by a previous attempt
+            attempt_params = dict(params or {}, accessToken=self.vi_access_token)
+            if attempt > 0 and hasattr(kwargs.get('data'), 'seek'):
+                # resend a streamed body from its start
+                kwargs['data'].seek(0)
+            response = None
+            try:
+                response = self.http.request(method, url, operation=operation, params=attempt_params, **kwargs)
+                error_class = classify_status(response.status_code)
+                if error_class == TRANSIENT and not idempotent:
+                    error_class = PERMANENT
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # a refused or timed out connection never carried the request
+                sent = not isinstance(e, requests.ConnectTimeout) and \
+                    not isinstance(getattr(e.args[0] if e.args else None, 'reason', None), ConnectTimeoutError)
+                if (sent and not idempotent) or not self.retry_policy.should_retry(TRANSIENT, attempt,
+                                                                                      n_auth_renewals):
+                    raise
+                error_class = TRANSIENT
+
+            if not self.retry_policy.should_retry(error_class, attempt, n_auth_renewals):
+                if error_class == OK:
+                    self.rate_limiter.on_success()
+                return response
+            if error_class == THROTTLED:
+                retry_after_secs = parse_retry_after(response.headers.get('Retry-After'))
+                self.rate_limiter.on_throttled(retry_after_secs or self.retry_policy.backoff_secs(attempt))
+            elif error_class == AUTH_EXPIRED:
+                n_auth_renewals += 1
+                self.renew_access_tokens(stale_vi_access_token=attempt_params['accessToken'])
+            else:
+                time.sleep(self.retry_policy.backoff_secs(attempt))
+        return response
+
+    def get_http_stats(self) -> dict:
+        """
+        Per-operation latencies and the connection reuse counters of the shared pool
+        :return: a dict with 'operations' and 'connections' stats
+        """
+        return dict(operations=self.http.stats.snapshot(), connections=self.http.connection_stats())
+
+    def close(self):
+        """
+        Stop the background token refresh and release the pooled connections
+        """
+        if self.token_refresher is not None:
+            self.token_refresher.stop()
+        for thumbnail_fetcher in self._thumbnail_fetchers.values():
+            thumbnail_fetcher.close()
+        self.http.close()
 
-    def list_videos_single_page(self, next_page_skip) -> dict:
+    def list_videos_single_page(self, next_page_skip=None) -> dict:
         # list videos
         videos = []
         try:
-            url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos?pageSize=200&accessToken={self.vi_access_token}"
+            params = dict(pageSize=200)
             if next_page_skip is not None:
-                url += f"&skip={next_page_skip}"
+                params['skip'] = next_page_skip
 
             hdr = {
                 'Cache-Control': 'no-cache',
                 'Ocp-Apim-Subscription-Key': self.subscription_id,
             }
 
-            req = urllib.request.Request(url, headers=hdr)
+            response = self._vi_request('GET', 'Videos', 'list_videos', params=params, headers=hdr)
+            if response.status_code != 200:
+                print(response.status_code)
+                print(f'Error: {response.status_code}')
+            response.raise_for_status()
 
-            req.get_method = lambda: 'GET'
-            response = urllib.request.urlopen(req)
-            if response.getcode() != 200:
-                print(response.getcode())
-                print(f'Error: {response.getcode()}')
-
-            videos = json.loads(response.read())
+            videos = response.json()
 
         except Exception as e:
             print(e)
@@ -98,24 +232,41 @@ class VideoIndexerWrapper:
         video_index = None
 
         try:
-            url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos/{video_id}/Index?accessToken={self.vi_access_token}"
             headers = {
                 'Cache-Control': 'no-cache',
                 'Ocp-Apim-Subscription-Key': self.subscription_id
             }
 
-            req = urllib.request.Request(url, headers=headers)
-            req.get_method = lambda: 'GET'
-            response = urllib.request.urlopen(req)
-            response_code = response.getcode()
-            video_index = json.loads(response.read())
+            response = self._vi_request('GET', f'Videos/{video_id}/Index', 'get_video_index', headers=headers)
+            response_code = response.status_code
 
             if response_code != 200:
-                print(f'Error: response code: {response_code}, video_id: {video_id}, response: {video_index}')
+                print(f'Error: response code: {response_code}, video_id: {video_id}, response: {response.text}')
+            response.raise_for_status()
+            video_index = response.json()
         except Exception as e:
             print(e)
         return video_index
 
+    def get_videos_state(self, video_ids):
+        """
+        Get the indexing state of many videos with a single search request instead of downloading their indexes
+        :param video_ids: the video ids, up to a page of them
+        :return: the search results, with their state and processingProgress, by video id, None on failure
+        """
+        try:
+            hdr = {
+                'Cache-Control': 'no-cache',
+                'Ocp-Apim-Subscription-Key': self.subscription_id,
+            }
+            response = self._vi_request('GET', 'Videos/Search', 'get_videos_state',
+                                        params=dict(id=list(video_ids), pageSize=len(video_ids)), headers=hdr)
+            response.raise_for_status()
+            return {video['id']: video for video in response.json()['results']}
+        except Exception as e:
+            print(e)
+            return None
+
     def list_all_indexed_videos(self):
         """
         list all indexed videos and download their thumbnails
@@ -131,19 +282,150 @@ class VideoIndexerWrapper:
             all_indexed_videos+=videos['results']
         return all_indexed_videos
 
-    def get_n_unknown_face_ids(self, n_unknown_face_ids, working_dir):
+    async def _vi_request_async(self, session, path, operation, params=None):
+        """
+        Send a GET request to the Video Indexer account API through an aiohttp session, with the same rate limiting
+        and retry policy as _vi_request.
+        :return: the parsed JSON response, None on failure
+        """
+        url = f"{self.api_url}/{self.location}/Accounts/{self.account_id}/{path}"
+        headers = {
+            'Cache-Control': 'no-cache',
+            'Ocp-Apim-Subscription-Key': self.subscription_id
+        }
+        # unlike requests, aiohttp rejects None values instead of dropping them
+        headers = {key: value for key, value in headers.items() if value is not None}
+        n_auth_renewals = 0
+        for attempt in range(self.retry_policy.max_attempts):
+            await self.rate_limiter.acquire_async()
+            attempt_params = dict(params or {}, accessToken=self.vi_access_token)
+            status_code = None
+            retry_after_secs = None
+            start_time = time.perf_counter()
+            try:
+                async with session.get(url, params=attempt_params, headers=headers) as response:
+                    status_code = response.status
+                    error_class = classify_status(status_code)
+                    if error_class == OK:
+                        self.rate_limiter.on_success()
+                        try:
+                            return await response.json(content_type=None)
+                        except ValueError as e:
+                            # a malformed body is not retried, the same request would get it again
+                            print(f'Error: invalid JSON response, path: {path}: {e}')
+                            return None
+                    retry_after_secs = parse_retry_after(response.headers.get('Retry-After'))
+                    error_message = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error_class = TRANSIENT
+                error_message = repr(e)
+            finally:
+                self.http.stats.record(operation, time.perf_counter() - start_time, status_code)
+
+            if not self.retry_policy.should_retry(error_class, attempt, n_auth_renewals):
+                print(f'Error: response code: {status_code}, path: {path}, response: {error_message}')
+                return None
+            if error_class == THROTTLED:
+                self.rate_limiter.on_throttled(retry_after_secs or self.retry_policy.backoff_secs(attempt))
+            elif error_class == AUTH_EXPIRED:
+                n_auth_renewals += 1
+                # the token renewal blocks on its own event loop
+                await asyncio.to_thread(self.renew_access_tokens, attempt_params['accessToken'])
+            else:
+                await asyncio.sleep(self.retry_policy.backoff_secs(attempt))
+        return None
+
+    async def iter_video_indexes_async(self, max_in_flight=16, page_size=200, videos=None):
+        """
+        Stream the account listing page by page and fetch the video indexes concurrently, at most max_in_flight at a
+        time. Results are yielded as soon as they complete so callers can persist them while the crawl continues.
+        :param max_in_flight: the maximal number of concurrent index requests
+        :param page_size: the listing page size
+        :param videos: the videos to fetch the indexes of, e.g. the changed ones, instead of the whole account listing
+        :return: an async generator of (video, video_index) tuples in completion order, video_index is None on failure
+        """
+        # bounded queues apply backpressure on the listing and on the fetchers when the caller is slow
+        pending_videos = asyncio.Queue(maxsize=2 * max_in_flight)
+        results = asyncio.Queue(maxsize=2 * max_in_flight)
+        connector = aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.http.timeout[0], sock_read=self.http.timeout[1])
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def list_pages():
+                try:
+                    if videos is not None:
+                        for video in videos:
+                            await pending_videos.put(video)
+                        return
+                    skip = 0
+                    while True:
+                        page = await self._vi_request_async(session, 'Videos', 'list_videos',
+                                                            params=dict(pageSize=page_size, skip=skip))
+                        if page is None or not page.get('results'):
+                            break
+                        for video in page['results']:
+                            await pending_videos.put(video)
+                        skip += len(page['results'])
+                        if page.get('nextPage', {}).get('done', True):
+                            break
+                finally:
+                    for _ in range(max_in_flight):
+                        await pending_videos.put(None)
+
+            async def fetch_indexes():
+                try:
+                    while True:
+                        video = await pending_videos.get()
+                        if video is None:
+                            return
+                        try:
+                            video_index = await self._vi_request_async(session, f'Videos/{video["id"]}/Index',
+                                                                       'get_video_index')
+                        except Exception as e:
+                            # a failed video is yielded without its index instead of stopping this fetcher
+                            print(f'Failed to get the index of video {video["id"]}: {e!r}')
+                            video_index = None
+                        await results.put((video, video_index))
+                finally:
+                    await results.put(None)
+
+            tasks = [asyncio.create_task(list_pages())]
+            tasks += [asyncio.create_task(fetch_indexes()) for _ in range(max_in_flight)]
+            try:
+                n_running_fetchers = max_in_flight
+                while n_running_fetchers > 0:
+                    result = await results.get()
+                    if result is None:
+                        n_running_fetchers -= 1
+                        continue
+                    yield result
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_n_unknown_face_ids(self, n_unknown_face_ids, working_dir, manifest: JobManifest = None):
         """
         list videos page by page and get their video index while counting the number of unknown face ids
+        :param manifest: the checkpoint of the crawled videos, by default the one in working_dir
         :return: first n unknown face ids
         """
-        unknown_face_ids = []
         video_face_impressions = []
+        owns_manifest = manifest is None
+        manifest = manifest if manifest is not None else JobManifest.in_directory(working_dir)
 
         # load existing video face impressions
-        for file in os.listdir(working_dir):
-            if file.endswith(".jpg"):
-                thumbnail_id = os.path.basename(file).split('.')[0]
-                unknown_face_ids.append(thumbnail_id)
+        thumbnail_fetcher = self.get_thumbnail_fetcher(working_dir)
+        unknown_face_ids = list(thumbnail_fetcher.downloaded_ids)
+        thumbnail_futures = []
+
+        # resume the thumbnail downloads of the videos a previous run crawled but did not finish
+        for video_id in manifest.items(FACE_IMPRESSIONS_STAGE):
+            if not manifest.is_done(video_id, FACE_THUMBNAILS_STAGE):
+                thumbnail_ids = manifest.detail(video_id, FACE_IMPRESSIONS_STAGE) or []
+                unknown_face_ids.extend(thumbnail_id for thumbnail_id in thumbnail_ids
+                                        if thumbnail_id not in thumbnail_fetcher.downloaded_ids)
+                thumbnail_futures += self._submit_face_thumbnails(thumbnail_fetcher, manifest, video_id, thumbnail_ids)
 
         skip_batch = 200
         batch_counter = 1
@@ -156,27 +438,23 @@ class VideoIndexerWrapper:
             for video in videos['results']:
                 video_id = video['id']
                 video_thumbnail_ids_json = os.path.join(working_dir, f'{video_id}.json')
-                if os.path.exists(video_thumbnail_ids_json):
+                if manifest.is_done(video_id, FACE_IMPRESSIONS_STAGE):
                     continue
 
-                # sleep to avoid throttling
-                time.sleep(self.sleep_time_secs)
-
-                # get video index and check if it has faces
+                # get video index and check if it has faces, throttling and token renewal are handled by the wrapper
                 video_index = self.get_video_index(video_id)
-
-                # retry once if access token expired
                 if video_index is None:
-                    self.renew_access_tokens()
-                    video_index = self.get_video_index(video_id)
+                    continue
 
-                if video_index is None or \
-                    'videos' not in video_index or \
-                        len(video_index['videos'][0]) == 0 or \
-                        video_index['videos'][0] is None or \
+                if 'videos' not in video_index or \
+                        not video_index['videos'] or \
+                        not video_index['videos'][0] or \
                         'insights' not in video_index['videos'][0] or \
                         video_index['videos'][0]['insights'] is None or \
                         'faces' not in video_index['videos'][0]['insights']:
+                    # no faces, nothing to fetch again on the next run
+                    manifest.done(video_id, FACE_IMPRESSIONS_STAGE, [])
+                    manifest.done(video_id, FACE_THUMBNAILS_STAGE)
                     continue
 
                 faces = video_index['videos'][0]['insights']['faces']
@@ -187,9 +465,11 @@ class VideoIndexerWrapper:
                 # serialize video face thumbnail ids to json
                 with open(video_thumbnail_ids_json, 'w') as f:
                     f.write(video_impressions.tojson())
+                manifest.done(video_id, FACE_IMPRESSIONS_STAGE, video_impressions.unknown_face_thumbnail_ids)
 
-                # download all thumbnails
-                self.get_video_face_impressions(video['id'], working_dir, video_impressions.unknown_face_thumbnail_ids)
+                # download the thumbnails in the background while the next videos are listed
+                thumbnail_futures += self._submit_face_thumbnails(thumbnail_fetcher, manifest, video_id,
+                                                                  video_impressions.unknown_face_thumbnail_ids)
                 if len(unknown_face_ids) >= n_unknown_face_ids:
                     break
             if len(unknown_face_ids) >= n_unknown_face_ids:
@@ -203,8 +483,44 @@ class VideoIndexerWrapper:
                 print(f'Failed to get next page of videos: {videos}. Stopping.')
                 break
 
+        wait(thumbnail_futures)
+        print(f'Thumbnails: {thumbnail_fetcher.stats()}')
+        print(f'Manifest: {manifest.stats()}')
+        if owns_manifest:
+            manifest.close()
         return unknown_face_ids
 
+    @staticmethod
+    def _submit_face_thumbnails(thumbnail_fetcher: ThumbnailFetcher, manifest: JobManifest, video_id: str,
+                                thumbnail_ids):
+        """
+        Download a video's face thumbnails in the background, the video's thumbnails are checkpointed once all of them
+        are on disk.
+        :return: the thumbnail futures
+        """
+        manifest.start(video_id, FACE_THUMBNAILS_STAGE)
+        futures = thumbnail_fetcher.submit(video_id, thumbnail_ids)
+        if not futures:
+            manifest.done(video_id, FACE_THUMBNAILS_STAGE)
+            return futures
+
+        lock = threading.Lock()
+        remaining = [len(futures)]
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            if all(thumbnail_id in thumbnail_fetcher.downloaded_ids for thumbnail_id in thumbnail_ids):
+                manifest.done(video_id, FACE_THUMBNAILS_STAGE)
+            else:
+                manifest.failed(video_id, FACE_THUMBNAILS_STAGE, 'some thumbnails failed to download')
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return futures
+
     def get_video_indexer_thumbnail_api(self, video_id, thumbnail_id, target_folder_path: str):
         """
         Get video face impression for the given face thumbnail id
@@ -213,11 +529,16 @@ class VideoIndexerWrapper:
         :param thumbnail_id: a GUID from to Video Indexer
         :return: the image path of the thumbnail
         """
-        file_path = f'{target_folder_path}/{thumbnail_id}.jpg'
-        if os.path.exists(file_path):
-            return file_path
+        image_paths = self.get_thumbnail_fetcher(target_folder_path).fetch(video_id, [thumbnail_id])
+        return image_paths[0] if image_paths else None
 
-        url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos/{video_id}/Thumbnails/{thumbnail_id}?accessToken={self.vi_access_token}"
+    def get_thumbnail_bytes(self, video_id, thumbnail_id):
+        """
+        Download a thumbnail image
+        :param video_id:
+        :param thumbnail_id: a GUID from to Video Indexer
+        :return: the image bytes, None on failure
+        """
         headers = {
             # Request headers
             'Content-Type': 'application/json',
@@ -226,22 +547,31 @@ class VideoIndexerWrapper:
 
         response_code = None
         try:
-            req = urllib.request.Request(url, headers=headers)
-            req.get_method = lambda: 'GET'
-            response = urllib.request.urlopen(req)
-            response_code = response.getcode()
-            video_indexer_thumbnail_id = response.read()
-
-            # save the thumbnail to an image file
-            with open(file_path, 'wb') as f:
-                f.write(video_indexer_thumbnail_id)
+            response = self._vi_request('GET', f'Videos/{video_id}/Thumbnails/{thumbnail_id}', 'get_thumbnail',
+                                        headers=headers)
+            response_code = response.status_code
+            response.raise_for_status()
+            return response.content
         except Exception as e:
             print(e)
-
-        if response_code != 200:
             print(f'Error: {response_code}')
             return None
-        return file_path
+
+    def get_thumbnail_fetcher(self, target_folder_path: str, max_in_flight: int = 16,
+                              max_per_video: int = 4) -> ThumbnailFetcher:
+        """
+        The concurrent thumbnail fetcher of a folder, created once so its set of downloaded ids is listed once
+        :param target_folder_path: where the thumbnails are written
+        :param max_in_flight: the maximal number of concurrent thumbnail downloads of the account
+        :param max_per_video: the maximal number of concurrent thumbnail downloads of a single video
+        """
+        target_folder_path = os.path.abspath(target_folder_path)
+        with self._thumbnail_fetchers_lock:
+            if target_folder_path not in self._thumbnail_fetchers:
+                self._thumbnail_fetchers[target_folder_path] = ThumbnailFetcher(
+                    self.get_thumbnail_bytes, target_folder_path, max_in_flight=max_in_flight,
+                    max_per_video=max_per_video)
+            return self._thumbnail_fetchers[target_folder_path]
 
     def get_video_face_impressions(self, video_id: str, target_folder_path: str, face_thumbnail_ids: List[str]):
         """
@@ -249,22 +579,23 @@ class VideoIndexerWrapper:
         :param target_folder_path:
         :param video_id:
         :param face_thumbnail_ids: a list of GUID values known to Video Indexer of thumbnail ids
-        :return:
+        :return: the paths of the downloaded thumbnails
         """
-        for thumbnail_id in face_thumbnail_ids:
-            image_path = self.get_video_indexer_thumbnail_api(video_id, thumbnail_id, target_folder_path)
-            if image_path is None:
-                self.renew_access_tokens()
-                image_path = self.get_video_indexer_thumbnail_api(video_id, thumbnail_id, target_folder_path)
-            if image_path is None:
-                print(f'Failed to download thumbnail {thumbnail_id} for video {video_id}')
-                continue
+        # the thumbnails are downloaded concurrently, an expired token is renewed once by the request layer and
+        # shared by all the workers
+        return self.get_thumbnail_fetcher(target_folder_path).fetch(video_id, face_thumbnail_ids)
 
     def upload_video(self, video_path, privacy='Private', priority='Low', language='auto', indexing_preset='Default',
                      streaming_preset='Default', send_success_email='false',
-                     use_managed_identity_to_download_video='false', prevent_duplicates='false'):
+                     use_managed_identity_to_download_video='false', prevent_duplicates='false', use_mmap=False,
+                     show_progress=True, progress_callback=None, callback_url=None):
         """
-        Upload the video to the Azure Video Indexer
+        Upload the video to the Azure Video Indexer. The file is streamed in chunks, so memory stays flat whatever its
+        size.
+        :param callback_url: notified by Video Indexer once the indexing finished, e.g. an IndexingCompletionTracker
+        :param progress_callback: called with (bytes_sent, total_bytes, bytes_per_sec) while uploading
+        :param show_progress: show a progress bar with the upload rate
+        :param use_mmap: stream the file from a memory-mapped view
         :param prevent_duplicates:
         :param use_managed_identity_to_download_video:
         :param send_success_email:
@@ -278,13 +609,18 @@ class VideoIndexerWrapper:
         """
         video_name = os.path.basename(video_path)
 
-        # Open the video file in binary mode
-        with open(video_path, 'rb') as video_file:
-            video_data = video_file.read()
-
         # Make the POST request to the API
-        endpoint_url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos?name={video_name}&privacy={privacy}&priority={priority}&language={language}&fileName=&indexingPreset={indexing_preset}&streamingPreset={streaming_preset}&sendSuccessEmail={send_success_email}&useManagedIdentityToDownloadVideo={use_managed_identity_to_download_video}&preventDuplicates={prevent_duplicates}&accessToken={self.vi_access_token}"
-        response = requests.post(endpoint_url, files={"file": video_data})
+        params = dict(name=video_name, privacy=privacy, priority=priority, language=language, fileName='',
+                      indexingPreset=indexing_preset, streamingPreset=streaming_preset,
+                      sendSuccessEmail=send_success_email,
+                      useManagedIdentityToDownloadVideo=use_managed_identity_to_download_video,
+                      preventDuplicates=prevent_duplicates)
+        if callback_url is not None:
+            params['callbackUrl'] = callback_url
+        with MultipartFileStream(video_path, 'file', use_mmap=use_mmap, show_progress=show_progress,
+                                 progress_callback=progress_callback) as body:
+            response = self._vi_request('POST', 'Videos', 'upload_video', params=params, data=body,
+                                        headers={'Content-Type': body.content_type})
 
         # return the response
         return response.json()
@@ -296,63 +632,65 @@ class VideoIndexerWrapper:
         :return:
         """
         # Make the GET request to the API
-        endpoint_url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos/{video_id}/ArtifactUrl?type={artifact_type}&accessToken={self.vi_access_token}"
-        response = requests.get(endpoint_url)
+        response = self._vi_request('GET', f'Videos/{video_id}/ArtifactUrl', 'get_video_artifacts',
+                                    params=dict(type=artifact_type))
 
         # return the response
         return response
 
-    def download_keyframes(self, indexed_videos, working_directory):
+    def iter_keyframes(self, video_id):
         """
-        Download videos' artifacts, unzip, copy keyframes and delete zip
-        :param indexed_videos:
-        :param working_directory:
-        :return:
+        Stream the keyframes of a video straight from the artifact zip download, without writing it to disk
+        :param video_id: the video id
+        :return: a generator of (keyframe file name, image bytes), empty when the artifact is unavailable
         """
-        kf_video_id_to_zip = dict()
-        failed_video_ids = []
-
-        # download artifacts
-        for video in indexed_videos:
-            video_id = video['id']
+        artifacts_response = self.get_video_artifacts(video_id, 'KeyframesThumbnails')
+        if artifacts_response.status_code != 200:
+            print(f'Error: {artifacts_response.status_code}')
+            return
+        kf_url = artifacts_response.json()
+        with self.http.request('GET', kf_url, operation='download_artifact', stream=True) as response:
+            if response.status_code != 200:
+                print(f'Error: {response.status_code}')
+                return
+            response.raw.decode_content = True
+            yield from iter_zip_members(response.raw)
+            # drain the central directory so the connection goes back to the pool
+            response.raw.read()
+
+    def download_keyframes(self, indexed_videos, working_directory, n_workers=4):
+        """
+        Download videos' keyframes zips concurrently, resuming interrupted transfers and skipping valid zips
+        :param indexed_videos: the videos, as listed by list_all_indexed_videos
+        :param working_directory: where the {video_id}.zip files are written
+        :param n_workers: the number of concurrent downloads
+        :return: the zip path by video id, and the ids of the videos whose keyframes failed to download
+        """
+        def resolve_keyframes_url(video_id):
             artifacts_response = self.get_video_artifacts(video_id, 'KeyframesThumbnails')
             if artifacts_response.status_code != 200:
                 print(f'Error: {artifacts_response.status_code}')
-                continue
-            kf_url = artifacts_response.json()
-
-            # download keyframes zip from url to working directory
-            zip_file_path = os.path.join(working_directory, f'{video_id}.zip')
-            urllib.request.urlretrieve(kf_url, zip_file_path)
+                return None
+            return artifacts_response.json()
 
-            if os.path.exists(zip_file_path):
-                print(f'Downloaded keyframes zip for video {video_id} to {zip_file_path}')
-                kf_video_id_to_zip[video_id] = zip_file_path
-            else:
-                print(f'Failed to download keyframes zip for video {video_id} to {zip_file_path}')
-                failed_video_ids.append(video_id)
-                continue
+        downloader = ArtifactDownloader(self.http, resolve_keyframes_url, n_workers=n_workers)
+        items = [(video['id'], os.path.join(working_directory, f'{video["id"]}.zip')) for video in indexed_videos]
+        kf_video_id_to_zip, failed_video_ids = downloader.download_all(items)
         print(f'Done downloading all keyframes for {len(kf_video_id_to_zip)} videos. Failed to download keyframes for {len(failed_video_ids)} videos')
         return kf_video_id_to_zip, failed_video_ids
 
     def create_prompt_content(self, video_id):
-        import urllib.request
-
         try:
-            url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos/{video_id}/PromptContent?modelName=Llama2&promptStyle=Full&accessToken={self.vi_access_token}"
-
             hdr = {
                 # Request headers
                 'Cache-Control': 'no-cache',
                 'Ocp-Apim-Subscription-Key': self.subscription_id,
             }
 
-            req = urllib.request.Request(url, headers=hdr)
-
-            req.get_method = lambda: 'POST'
-            response = urllib.request.urlopen(req)
-            print(response.getcode())
-            print(response.read())
+            response = self._vi_request('POST', f'Videos/{video_id}/PromptContent', 'create_prompt_content',
+                                        params=dict(modelName='Llama2', promptStyle='Full'), headers=hdr)
+            print(response.status_code)
+            print(response.content)
         except Exception as e:
             print(e)
 
@@ -360,23 +698,16 @@ class VideoIndexerWrapper:
         """
         Get the prompt content of the video
         :param video_id:
-        :return:
+        :return: the response, None if the request could not be sent
         """
-        import urllib.request
-
         try:
-            url = f"https://api.videoindexer.ai/{self.location}/Accounts/{self.account_id}/Videos/{video_id}/PromptContent?accessToken={self.vi_access_token}"
-
             hdr = {
                 # Request headers
                 'Cache-Control': 'no-cache',
                 'Ocp-Apim-Subscription-Key': self.subscription_id,
             }
 
-            req = urllib.request.Request(url, headers=hdr)
-
-            req.get_method = lambda: 'GET'
-            response = urllib.request.urlopen(req)
+            response = self._vi_request('GET', f'Videos/{video_id}/PromptContent', 'get_prompt_content', headers=hdr)
             return response
         except Exception as e:
             print(e)
@@ -1,10 +1,14 @@
-import concurrent.futures
+import collections
+import queue
 import subprocess
 import os
+import threading
 import time
 from datetime import datetime
 
 from Utils import Semaphore
+from chunk_watcher import ChunkWatcher
+from ts_segmenter import TsSegmenter
 from video_indexer_wrapper import VideoIndexerWrapper
 
 
@@ -28,87 +32,260 @@ class Streamer:
         exit_code = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if exit_code.returncode != 0:
             raise Exception(f'failed serialize stream with exit code {exit_code}')
+        return output_video_path
 
+    def stream_to_segments(self, segment_secs: float, on_segment=None, stop_event=None):
+        """
+        Run a single long-lived streamlink process writing to stdout and cut its output into segment_secs .ts files
+        in-process, so the HLS playlist is negotiated once and no live content is lost between chunks.
+        A local HLS file server can be used as the stream, e.g. hls://http://localhost:8000/playlist.m3u8
+        :param segment_secs: the segment duration
+        :param on_segment: called with (segment_path, duration_secs) for every complete segment
+        :param stop_event: a threading.Event that terminates the streamlink process
+        :return: the number of segments written
+        """
+        command = [self.streamlink_path, self.STREAMURL, '360p', '--stdout']
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if stop_event is not None:
+            def terminate_on_stop():
+                stop_event.wait()
+                process.terminate()
 
-def serialize_live_stream(stream_url: str, video_duration: str, total_seconds: int, video_repo: str, num_iterations: int):
+            threading.Thread(target=terminate_on_stop, daemon=True).start()
+        segmenter = TsSegmenter(self.VIDEO_REPO, segment_secs, on_segment=on_segment)
+        try:
+            segmenter.consume(process.stdout)
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+        if return_code != 0 and (stop_event is None or not stop_event.is_set()):
+            raise Exception(f'failed serialize stream with exit code {return_code}')
+        return segmenter.n_segments
+
+
+class ChunkUploadQueue:
+    """
+    A bounded producer/consumer queue of finished video chunks, drained by n_workers upload threads so a slow upload
+    does not hold back the chunks behind it. put() blocks while the queue is full, which applies backpressure on the
+    recorder instead of piling up chunks on disk.
+    """
+    def __init__(self, vi_wrapper: VideoIndexerWrapper, n_workers: int = 2, max_queue_size: int = 8,
+                 language: str = 'auto', delete_after_upload: bool = True):
+        self.vi_wrapper = vi_wrapper
+        self.language = language
+        self.delete_after_upload = delete_after_upload
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = [threading.Thread(target=self._drain, name=f'chunk-uploader-{i}', daemon=True)
+                         for i in range(n_workers)]
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=1000)
+        self._start_time = None
+        self.max_queue_depth = 0
+        self.n_uploaded = 0
+        self.n_failed = 0
+        self.bytes_uploaded = 0
+
+    def start(self):
+        self._start_time = time.time()
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, chunk_path: str, finished_at: float = None):
+        """
+        Hand a finished chunk to the upload workers, blocks while the queue is full.
+        :param chunk_path: the chunk file
+        :param finished_at: when the chunk was closed, used for the end-to-end latency
+        """
+        self._queue.put((chunk_path, finished_at or time.time()))
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def close(self):
+        """
+        Wait for the queued chunks to be uploaded and stop the workers
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            chunk_path, finished_at = item
+            try:
+                chunk_size = os.path.getsize(chunk_path)
+                print(f"Uploading {chunk_path} to the Azure Video Indexer.")
+                response = self.vi_wrapper.upload_video(chunk_path, language=self.language, show_progress=False)
+                print(response)
+                if self.delete_after_upload:
+                    os.remove(chunk_path)
+                with self._lock:
+                    self.n_uploaded += 1
+                    self.bytes_uploaded += chunk_size
+                    self._latencies.append(time.time() - finished_at)
+            except Exception as e:
+                print(f'Failed to upload {chunk_path}: {e}')
+                with self._lock:
+                    self.n_failed += 1
+
+    def metrics(self) -> dict:
+        """
+        :return: the queue depth, the end-to-end chunk latency (closed to uploaded) and the upload throughput
+        """
+        with self._lock:
+            elapsed_secs = time.time() - self._start_time if self._start_time else 0.0
+            latencies = sorted(self._latencies)
+            return dict(queue_depth=self._queue.qsize(), max_queue_depth=self.max_queue_depth,
+                        chunks_uploaded=self.n_uploaded, chunks_failed=self.n_failed,
+                        avg_latency_secs=sum(latencies) / len(latencies) if latencies else 0.0,
+                        p95_latency_secs=latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+                        chunks_per_sec=self.n_uploaded / elapsed_secs if elapsed_secs else 0.0,
+                        bytes_per_sec=self.bytes_uploaded / elapsed_secs if elapsed_secs else 0.0)
+
+
+def serialize_live_stream(stream_url: str, video_duration: str, total_seconds: int, video_repo: str, num_iterations: int,
+                          chunk_queue: ChunkUploadQueue = None, overlap_secs: float = 1.0):
     """
     This function streams a live video and serializes the video to the Azure Video Indexer.
-    To avoid stream loss during encoding, use a Semaphore to chunk the video files.
-    :return:
+    To avoid stream loss during encoding, two warm recorders are double-buffered: the next recorder starts while the
+    previous one is still recording, so no stream time is lost between chunks.
+    :param chunk_queue: if given, every finished chunk is handed to it for upload
+    :param overlap_secs: how long consecutive recorders overlap to absorb the streamlink startup jitter
+    :return: the recording stats: the worker startup time and the estimated gap between consecutive chunks
     """
-    processors = Semaphore(2)
-    for i in range(num_iterations):
-        # Your code here
-        print(f"Iteration {i + 1}")
+    recorders = Semaphore(2, kind='thread')
+    worker_startup_secs = recorders.warm_up()
+    print(f"Recorders are warm after {worker_startup_secs:.3f} seconds.")
+    exit_times = []
+    exit_times_lock = threading.Lock()
+
+    def on_chunk_recorded(future):
+        if future.exception() is not None:
+            print(f"Recorder failed: {future.exception()}")
+            return
+        finished_at = time.time()
+        with exit_times_lock:
+            exit_times.append(finished_at)
+        if chunk_queue is not None:
+            chunk_queue.put(future.result(), finished_at=finished_at)
 
-        # Acquire the semaphore
-        start_time = time.time()
-        streamlink_id = (i % 2) + 1
+    next_start_time = time.time()
+    try:
+        for i in range(num_iterations):
+            print(f"Iteration {i + 1}")
 
-        # Stream the video and chunk the files
-        streamer = Streamer(streamlink_id, stream_url, video_repo, video_duration)
-        res = processors.parallelize([dict()], streamer.stream_video_and_chunk_files)
+            # start the next recorder one chunk duration, minus the overlap, after the previous one
+            wait_secs = next_start_time - time.time()
+            if wait_secs > 0:
+                time.sleep(wait_secs)
+            next_start_time = max(next_start_time, time.time()) + total_seconds - overlap_secs
 
-        end_time = time.time()
+            # Stream the video and chunk the files, blocks while both recorders are busy
+            streamlink_id = (i % 2) + 1
+            streamer = Streamer(streamlink_id, stream_url, video_repo, video_duration)
+            recorders.submit(streamer.stream_video_and_chunk_files).add_done_callback(on_chunk_recorded)
+    finally:
+        recorders.close()
 
-        # Wait for 5 seconds before the next iteration
-        streamming_time = end_time - start_time
-        if streamming_time < total_seconds:
-            time.sleep(total_seconds - streamming_time)
+    # a recorder exits right after recording total_seconds, so the chunk i+1 starts at exit(i+1) - total_seconds
+    exit_times.sort()
+    gaps = [later - earlier - total_seconds for earlier, later in zip(exit_times, exit_times[1:])]
+    stats = dict(worker_startup_secs=worker_startup_secs, chunks=len(exit_times),
+                 avg_gap_secs=sum(gaps) / len(gaps) if gaps else 0.0, max_gap_secs=max(gaps, default=0.0))
+    print(f"Recording stats: {stats}")
+    return stats
+
+
+def serialize_live_stream_gapless(stream_url: str, total_seconds: int, video_repo: str,
+                                  chunk_queue: ChunkUploadQueue = None, stop_event=None, num_iterations: int = None):
+    """
+    This function streams a live video through a single streamlink process and segments it in-process into chunks of
+    total_seconds, giving continuous coverage without per-chunk process startups.
+    :param chunk_queue: if given, every finished chunk is handed to it for upload
+    :param stop_event: a threading.Event to stop the recording
+    :param num_iterations: stop the recording after this number of chunks, only on stop_event or the stream's end
+        when None
+    :return: the number of recorded chunks
+    """
+    if num_iterations is not None and stop_event is None:
+        stop_event = threading.Event()
+    n_recorded = [0]
+
+    def on_segment(segment_path, duration_secs):
+        if num_iterations is not None and n_recorded[0] >= num_iterations:
+            # the segments flushed while streamlink terminates, left behind they would keep the next run from starting
+            os.remove(segment_path)
+            return
+        n_recorded[0] += 1
+        print(f"Recorded {segment_path} ({duration_secs:.2f} seconds).")
+        if chunk_queue is not None:
+            chunk_queue.put(segment_path)
+        if num_iterations is not None and n_recorded[0] >= num_iterations:
+            stop_event.set()
+
+    streamer = Streamer(1, stream_url, video_repo, total_seconds)
+    streamer.stream_to_segments(total_seconds, on_segment=on_segment, stop_event=stop_event)
+    return n_recorded[0]
 
 
 def upload_videos_to_video_indexer(location, account_id, subscription_id, api_version, account_name, total_seconds,
                                    resource_group_name, azure_tenant_id, video_folder_path, num_iterations,
-                                   language='auto'):
+                                   language='auto', n_workers=2, max_queue_size=8, use_inotify=None, settle_secs=2.0,
+                                   stop_event=None):
     """
-    This function uploads the video to the Azure Video Indexer.
+    This function uploads the videos written to a folder by an external recorder to the Azure Video Indexer.
+    A chunk is uploaded once the recorder closed it (inotify) or once its size settled (polling fallback), so
+    half-written segments are never uploaded.
     :param location: The region of the account,
     :param account_id: The account ID,
     :param subscription_id: The subscription ID,
     :param api_version: The version of the API,
     :param account_name: The name of the account,
-    :param total_seconds: The total number of seconds is calculated by converting hours to seconds (hours * 3600),
+    :param total_seconds: Unused, kept for the existing callers. Chunks are uploaded as soon as they are written, so
+        there is no startup wait based on the chunk length anymore,
     :param resource_group_name: The name of the resource group,
     :param azure_tenant_id: The Azure tenant ID,
     :param video_folder_path: The path to the video folder,
-    :param num_iterations: The number of iterations,
+    :param num_iterations: The number of chunks to upload,
+    :param language: The language of the videos,
+    :param n_workers: The number of concurrent uploads,
+    :param max_queue_size: The number of chunks waiting for upload before the folder watch blocks,
+    :param use_inotify: Whether to watch the folder with inotify, None to use it when available,
+    :param settle_secs: How long a polled chunk's size has to stay unchanged before it is uploaded,
+    :param stop_event: A threading.Event to stop watching the folder,
     :return: None
     """
     vi_wrapper = VideoIndexerWrapper(location=location, account_id=account_id, subscription_id=subscription_id,
                                      api_version=api_version, account_name=account_name,
                                      resource_group_name=resource_group_name, azure_tenant_id=azure_tenant_id)
+    chunk_queue = ChunkUploadQueue(vi_wrapper, n_workers=n_workers, max_queue_size=max_queue_size, language=language)
+    chunk_queue.start()
 
-    # Wait for the first video to be chunked
-    init_sleep_secs = 1 + 4*total_seconds
-    print(f"Waiting for the first video to be chunked - Going to sleep for a {init_sleep_secs} seconds.")
-    time.sleep(init_sleep_secs)
-    print("Waking up from the first sleep.")
-
-    # identify the video file
-    for i in range(num_iterations):
-        for video_ts in os.listdir(video_folder_path):
-            if not video_ts.endswith(".ts"):
-                continue
+    # identify the complete video files as they are closed
+    watcher = ChunkWatcher(video_folder_path, suffix='.ts', settle_secs=settle_secs, use_inotify=use_inotify)
+    try:
+        for i, video_path in enumerate(watcher.watch(stop_event)):
+            chunk_queue.put(video_path)
+            if i + 1 >= num_iterations:
+                break
+    finally:
+        chunk_queue.close()
+    print(f"All videos have been uploaded to the Azure Video Indexer: {chunk_queue.metrics()}")
 
-            # upload to video indexer
-            video_path = os.path.join(video_folder_path, video_ts)
-            print(f"Uploading {video_path} to the Azure Video Indexer.")
-            response = vi_wrapper.upload_video(video_path, language=language)
 
-            # Print the response
-            print(response)
-
-            # Delete the video file
-            os.remove(video_path)
-        time.sleep(1)
-    print("All videos have been uploaded to the Azure Video Indexer.")
-
-
-def run_download_and_upload(stream_url, video_duration, video_repo, num_iterations, config):
+def run_download_and_upload(stream_url, video_duration, video_repo, num_iterations, config, n_workers=2,
+                            max_queue_size=8, gapless=False):
     """
-    This function runs the download and upload of the video.
+    This function runs the download and upload of the video. Every recorded chunk is handed directly to a bounded
+    upload queue drained by n_workers uploaders.
     :param stream_url:
     :param video_duration:
+    :param gapless: record with a single streamlink process segmented in-process instead of a process per chunk
+    :param n_workers: the number of concurrent uploads
+    :param max_queue_size: the number of chunks waiting for upload before the recorder blocks
     :return:
     """
     num_files_in_working_repo = len(os.listdir(video_repo))
@@ -121,22 +298,21 @@ def run_download_and_upload(stream_url, video_duration, video_repo, num_iteratio
     hours, minutes, seconds = [int(part) for part in video_duration.split(":")]
     total_seconds = hours * 3600 + minutes * 60 + seconds
 
-    vi_config = config['vi']
-    vi_config['video_folder_path'] = video_repo
-    vi_config['num_iterations'] = num_iterations
-    vi_config['total_seconds'] = total_seconds
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_one = executor.submit(serialize_live_stream, stream_url, video_duration, total_seconds, video_repo,
-                                     num_iterations)
-        future_two = executor.submit(upload_videos_to_video_indexer, **vi_config)
-
-        concurrent.futures.wait([future_one, future_two], return_when=concurrent.futures.ALL_COMPLETED)
-
-        # Check for exceptions
-        if future_one.exception():
-            print(f"Exception in serialize_live_stream: {future_one.exception()}")
-        if future_two.exception():
-            print(f"Exception in upload_videos_to_video_indexer: {future_two.exception()}")
+    vi_config = dict(config['vi'])
+    language = vi_config.pop('language', 'auto')
+    vi_wrapper = VideoIndexerWrapper(**vi_config)
+    chunk_queue = ChunkUploadQueue(vi_wrapper, n_workers=n_workers, max_queue_size=max_queue_size, language=language)
+    chunk_queue.start()
+    try:
+        if gapless:
+            serialize_live_stream_gapless(stream_url, total_seconds, video_repo, chunk_queue,
+                                          num_iterations=num_iterations)
+        else:
+            serialize_live_stream(stream_url, video_duration, total_seconds, video_repo, num_iterations, chunk_queue)
+    except Exception as e:
+        print(f"Exception in serialize_live_stream: {e}")
+    finally:
+        chunk_queue.close()
+        vi_wrapper.close()
 
-    print("Both functions have completed.")
+    print(f"Both the recording and the uploads have completed: {chunk_queue.metrics()}")